@@ -0,0 +1,51 @@
+"""Times fix_doctype() per call, for the common doctypes (which are looked
+up in a table) and for an unusual one (which is parsed with the doctype
+grammar), against rebuilding the grammar on every call as it used to.
+
+Run with "python benchmarks/bench_doctype.py".
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+# So that it runs from a checkout, without strainer being installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from strainer.doctypes import DOCTYPE_XHTML1_STRICT
+from strainer.xhtmlify import fix_doctype, _doctype_grammar, _fix_doctype, \
+    _doctype_re
+
+BODY = '<html><head><title>x</title></head><body><p>Hello</p></body></html>'
+DOCUMENTS = [
+    ('XHTML 1.0 Strict', DOCTYPE_XHTML1_STRICT + BODY),
+    ('HTML5', '<!doctype html>\n' + BODY),
+    ('HTML 4.01', '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                  '"http://www.w3.org/TR/html4/strict.dtd">\n' + BODY),
+]
+
+
+def fix_doctype_uncached(html):
+    """fix_doctype() as it was, compiling the grammar on each call."""
+    _doctype_grammar()
+    m = _doctype_re.search(html)
+    return _fix_doctype(html, m)
+
+
+def bench(func, html, number=2000):
+    """Returns the time per call of func(html) in microseconds."""
+    best = min(timeit.repeat(lambda: func(html), number=number, repeat=3))
+    return best / number * 1e6
+
+
+def main():
+    print('%-18s %12s %12s' % ('doctype', 'before (us)', 'after (us)'))
+    for name, html in DOCUMENTS:
+        assert fix_doctype(html) == fix_doctype_uncached(html)
+        print('%-18s %12.2f %12.2f' % (
+            name, bench(fix_doctype_uncached, html, 200),
+            bench(fix_doctype, html)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Times xhtmlify() on deeply nested markup, such as the nested tables
+some page generators produce.  Each start tag is checked against the
+XHTML prohibitions (no <a> inside <a>, no <form> inside <button>, ...)
+and its parent, so the time per tag should stay the same as the depth
+grows, rather than growing with the number of open tags.
+
+Run with "python benchmarks/bench_nesting.py".
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+# So that it runs from a checkout, without strainer being installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from strainer.xhtmlify import xhtmlify
+
+DEPTHS = [10, 100, 300, 1000, 3000]
+
+
+def nested_tables(depth):
+    return ('<table><tr><td><a href="#">x</a><label>y</label>' * depth +
+            '</td></tr></table>' * depth)
+
+
+def nested_divs(depth):
+    return '<div><p>x</p><span>y</span>' * depth + '</div>' * depth
+
+
+def bench(html, number=3):
+    """Returns the time per start tag of xhtmlify(html) in microseconds."""
+    best = min(timeit.repeat(lambda: xhtmlify(html), number=number,
+                             repeat=3))
+    return best / number / html.count('</') * 1e6
+
+
+def main():
+    print('%-8s %18s %18s' % ('depth', 'tables (us/tag)', 'divs (us/tag)'))
+    for depth in DEPTHS:
+        print('%-8d %18.2f %18.2f' % (depth, bench(nested_tables(depth)),
+                                      bench(nested_divs(depth))))
+
+
+if __name__ == '__main__':
+    main()
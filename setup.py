@@ -66,9 +66,29 @@ As with all (or at least most) WSGI middleware, you can also combine them::
     >>> app = XHTMLValidatorMiddleware(app)
     >>> app = JSONValidatorMiddleware(app)
 
+Each layer buffers the whole response, though.  StrainerPipeline runs them
+as one, buffering once (pass None as the app of each filter)::
+
+    >>> from strainer.middleware import StrainerPipeline
+    >>> app = StrainerPipeline(app, [XHTMLifyMiddleware(None),
+    ...                              XHTMLValidatorMiddleware(None)])
+
 The middleware in this package buffer the output internally (this violates
 the PEP 333 specification, but it seems unavoidable), so it is best to use
 them near the top of the middleware stack.
+
+On Python 3, ``strainer.asgi`` has ASGI versions of the same middleware,
+which filter the response in an executor so as not to block the event loop::
+
+    >>> from strainer.asgi import XHTMLifyMiddleware
+    >>> app = XHTMLifyMiddleware(app)
+
+To check a whole directory tree of files at once, using a process per CPU::
+
+    python -m strainer --check wellformed /var/www/archive > results.jsonl
+
+The checks are xhtmlify (the default), wellformed, validate and json.  One
+JSON object is written per file, in order; see ``python -m strainer --help``.
 """,
       classifiers=[],
       keywords='html xhtml json wsgi',
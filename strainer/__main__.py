@@ -0,0 +1,5 @@
+import sys
+
+from strainer.batch import main
+
+sys.exit(main())
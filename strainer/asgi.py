@@ -0,0 +1,176 @@
+"""Provides ASGI versions of the middleware in strainer.middleware.
+
+These need Python 3.  The response body is collected from the app's
+"http.response.body" messages without blocking the event loop, and then
+filtered in an executor (by default the event loop's own), so that a slow
+xhtmlify() or validation doesn't hold up other connections::
+
+    >>> from strainer.asgi import XHTMLifyMiddleware
+    >>> app = XHTMLifyMiddleware(app, executor=executor)
+
+Responses which the middleware doesn't filter are streamed straight
+through, message by message.
+"""
+import asyncio
+import functools
+
+from . import middleware
+from .middleware import set_content_length, ResponseContext, run_filter
+from .middleware import get_content_type, parse_content_type
+from .metrics import timer
+
+
+__all__ = ['ASGIMiddleware', 'XHTMLValidatorMiddleware', 'XHTMLifyMiddleware',
+           'WellformednessCheckerMiddleware', 'JSONValidatorMiddleware',
+           'StrainerPipeline']
+
+
+def _environ(scope):
+    """Returns the parts of a WSGI environ that should_filter(), the
+       samplers and the result cache look at, for the ASGI scope."""
+    environ = {'REQUEST_METHOD': scope.get('method', 'GET'),
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope.get('path', ''),
+               'QUERY_STRING':
+                   scope.get('query_string', b'').decode('latin-1'),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'asgi.scope': scope}
+    for key, value in scope.get('headers', ()):
+        if key.lower() == b'host':
+            environ['HTTP_HOST'] = value.decode('latin-1')
+    server = scope.get('server')
+    if server:
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = \
+            server[0], str(server[1])
+    return environ
+
+
+def _decode_headers(headers):
+    return [(key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in headers]
+
+
+def _encode_headers(headers):
+    return [(key.encode('latin-1'), value.encode('latin-1'))
+            for key, value in headers]
+
+
+class ASGIMiddleware(object):
+    """Mixin which turns a strainer.middleware.BufferingMiddleware
+       subclass into ASGI middleware, using its should_filter() and
+       apply_filter() methods, and its metrics if they are set.  These
+       are passed the status code as a string (e.g. "200"), and the
+       headers as a list of (name, value) strings.  apply_filter() is run
+       by executor (a concurrent.futures.Executor, or None for the event
+       loop's default one).
+    """
+    def __init__(self, app, *args, executor=None, **kwargs):
+        super(ASGIMiddleware, self).__init__(app, *args, **kwargs)
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        environ = _environ(scope)
+        metrics = self.metrics
+        if (metrics is not None and metrics.path is not None and
+                environ['PATH_INFO'] == metrics.path):
+            await self._send_metrics(environ, send)
+            return
+        start = None
+        started = None  # when buffering started
+        chunks = []
+        size = 0
+        passed_through = False
+
+        async def buffering_send(message):
+            nonlocal start, started, size, passed_through
+            if passed_through:
+                await send(message)
+            elif message['type'] == 'http.response.start':
+                status = str(message['status'])
+                headers = _decode_headers(message.get('headers', []))
+                if self.should_filter(environ, status, headers):
+                    start = message
+                    started = timer()
+                else:
+                    passed_through = True
+                    await send(message)
+            elif message['type'] == 'http.response.body' and start:
+                chunks.append(message.get('body', b''))
+                size += len(chunks[-1])
+                more_body = message.get('more_body', False)
+                if self.max_size is not None and size > self.max_size:
+                    # Too big: send what there is, and the rest as it comes
+                    passed_through = True
+                    self.record_skip(parse_content_type(get_content_type(
+                        _decode_headers(start.get('headers', []))))[0])
+                    await send(start)
+                    await send({'type': 'http.response.body',
+                                'body': b''.join(chunks),
+                                'more_body': more_body})
+                    del chunks[:]
+                elif not more_body:
+                    response = b''.join(chunks)
+                    del chunks[:]
+                    await self._send_filtered(send, start, response,
+                                              environ, started)
+            else:
+                await send(message)
+
+        await self.app(scope, receive, buffering_send)
+
+    async def _send_filtered(self, send, start, response, environ, started):
+        headers = _decode_headers(start.get('headers', []))
+        context = ResponseContext(str(start['status']), headers, None,
+                                  response, environ)
+        if self.metrics is not None:
+            self.metrics.observe(self, context.content_type, 'buffer',
+                                 timer() - started)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, functools.partial(run_filter, self, context))
+        if context.body is not response:
+            context.headers = set_content_length(context.headers,
+                                                 context.body)
+        if context.headers is not headers:
+            start = dict(start, headers=_encode_headers(context.headers))
+        await send(start)
+        await send({'type': 'http.response.body', 'body': context.body})
+
+    async def _send_metrics(self, environ, send):
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started.append((int(status[:3]), _encode_headers(headers)))
+        body = b''.join(self.metrics(environ, start_response))
+        status, headers = started[0]
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+if hasattr(middleware, 'XHTMLValidatorMiddleware'):  # i.e. lxml is there
+    class XHTMLValidatorMiddleware(ASGIMiddleware,
+                                   middleware.XHTMLValidatorMiddleware):
+        """ASGI version of strainer.middleware.XHTMLValidatorMiddleware."""
+
+
+class XHTMLifyMiddleware(ASGIMiddleware, middleware.XHTMLifyMiddleware):
+    """ASGI version of strainer.middleware.XHTMLifyMiddleware."""
+
+
+class WellformednessCheckerMiddleware(
+        ASGIMiddleware, middleware.WellformednessCheckerMiddleware):
+    """ASGI version of strainer.middleware.WellformednessCheckerMiddleware."""
+
+
+class JSONValidatorMiddleware(ASGIMiddleware,
+                              middleware.JSONValidatorMiddleware):
+    """ASGI version of strainer.middleware.JSONValidatorMiddleware."""
+
+
+class StrainerPipeline(ASGIMiddleware, middleware.StrainerPipeline):
+    """ASGI version of strainer.middleware.StrainerPipeline.  The filters
+       are the WSGI middleware (strainer.middleware.XHTMLifyMiddleware
+       etc.), and are all run by one call in the executor."""
@@ -0,0 +1,242 @@
+"""Checks or converts many files at once, using several processes.
+
+Run it as "python -m strainer", e.g.::
+
+    python -m strainer --check wellformed --jobs 8 /var/www/archive
+
+Writes one JSON object per file to stdout, in the order the files were
+given (directories are walked in sorted order), followed by a summary of
+the throughput of each worker process on stderr.
+"""
+from __future__ import print_function
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import six
+
+from strainer.xhtmlify import xhtmlify, sniff_encoding, ValidationError, \
+    XHTMLifyStats
+
+
+__all__ = ['CHECKS', 'check_file', 'find_files', 'run', 'main']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+_xmldecl_re = re.compile(six.u(r'\A\ufeff?<\?xml[^>]*>'))
+
+DEFAULT_SUFFIXES = {
+    'xhtmlify': ('.html', '.htm', '.xhtml'),
+    'wellformed': ('.html', '.htm', '.xhtml'),
+    'validate': ('.html', '.htm', '.xhtml'),
+    'json': ('.json',),
+}
+
+
+def _decode(data, stats):
+    if stats is None:
+        return data.decode(sniff_encoding(data), 'replace')
+    start = timer()
+    encoding = sniff_encoding(data)
+    stats.add('sniff_encoding', timer() - start, len(data))
+    start = timer()
+    text = data.decode(encoding, 'replace')
+    stats.add('decode', timer() - start, len(data))
+    return text
+
+
+def _xhtmlify(data, stats=None):
+    try:
+        errors = xhtmlify(data, recover=True, stats=stats).errors
+    except ValidationError as e:  # e.g. a bad XML declaration
+        errors = [e]
+    return [str(e) for e in errors]
+
+
+def _wellformed(data, stats=None):
+    from strainer.wellformed import is_wellformed_xhtml
+    errors = []
+    text = _decode(data, stats)
+    is_wellformed_xhtml(text, record_error=errors.append)
+    return errors
+
+
+def _validate(data, stats=None):
+    from strainer.validate import validate_xhtml, XHTMLSyntaxError
+    text = _decode(data, stats)
+    # lxml won't parse text which has an encoding declaration
+    text = _xmldecl_re.sub('', text)
+    try:
+        validate_xhtml(text)
+    except XHTMLSyntaxError as e:
+        return [str(e)]
+    return []
+
+
+def _json(data, stats=None):
+    from strainer.validate import validate_json, JSONSyntaxError
+    try:
+        validate_json(data.decode('utf-8'))
+    except (JSONSyntaxError, UnicodeDecodeError) as e:
+        return [str(e)]
+    return []
+
+
+# Each check takes the bytes of a file, and an XHTMLifyStats or None, and
+# returns a list of error messages.
+CHECKS = {
+    'xhtmlify': _xhtmlify,
+    'wellformed': _wellformed,
+    'validate': _validate,
+    'json': _json,
+}
+
+
+def check_file(path, check='xhtmlify', stats=False):
+    """Runs CHECKS[check] on the file at path.  Returns a dict holding
+       the path, whether it passed ("ok"), the error messages, its size
+       and how long the check took, and the id of the process.  If stats
+       is True, it also holds the time taken by each stage of the check
+       ("stats", see XHTMLifyStats.as_dict())."""
+    file_stats = stats and XHTMLifyStats() or None
+    start = timer()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError) as e:
+        data = six.b('')
+        errors = [str(e)]
+    else:
+        try:
+            errors = CHECKS[check](data, file_stats)
+        except Exception as e:  # don't let one file stop a batch
+            errors = ['%s: %s' % (type(e).__name__, e)]
+    result = {'path': path, 'ok': not errors, 'errors': errors,
+              'bytes': len(data), 'seconds': timer() - start,
+              'worker': os.getpid()}
+    if file_stats is not None:
+        result['stats'] = file_stats.as_dict()
+    return result
+
+
+def find_files(paths, suffixes=None):
+    """Generates the files in paths, walking any directories (in sorted
+       order) for files ending with one of suffixes (or all files, if
+       suffixes is None)."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if suffixes is None or filename.lower().endswith(suffixes):
+                    yield os.path.join(dirpath, filename)
+
+
+def run(paths, check='xhtmlify', jobs=None, chunksize=16, stats=False):
+    """Generates the results of check_file() for each of paths, in order,
+       using jobs worker processes (by default one per CPU).  The paths
+       are sent to the workers chunksize at a time."""
+    func = functools.partial(check_file, check=check, stats=stats)
+    if jobs == 1:
+        for path in paths:
+            yield func(path)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(func, paths, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def summarize(stats, elapsed, out):
+    """Writes the number of files and bytes each worker processed, and
+       its throughput, to out."""
+    total_files = total_bytes = 0
+    for worker in sorted(stats):
+        files, nbytes, seconds = stats[worker]
+        total_files += files
+        total_bytes += nbytes
+        print('worker %d: %d files, %d bytes in %.2fs (%.1f files/s, '
+              '%.1f kB/s)' % (worker, files, nbytes, seconds,
+                              files / (seconds or 1e-9),
+                              nbytes / 1024.0 / (seconds or 1e-9)),
+              file=out)
+    print('total: %d files, %d bytes in %.2fs (%.1f files/s)' % (
+          total_files, total_bytes, elapsed, total_files / (elapsed or 1e-9)),
+          file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m strainer',
+        description='Check or convert (X)HTML and JSON files in parallel, '
+                    'writing a JSON object per file to stdout.')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='files, or directories to search')
+    parser.add_argument('-c', '--check', choices=sorted(CHECKS),
+                        default='xhtmlify',
+                        help='xhtmlify (the default): convert to XHTML and '
+                             'report problems; wellformed: parse with expat; '
+                             'validate: validate against the XHTML DTD '
+                             '(needs lxml); json: parse as JSON')
+    parser.add_argument('-f', '--files-from', metavar='FILE',
+                        help='read paths from FILE, one per line '
+                             '("-" for stdin)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='files to send to a worker at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--suffix', action='append', dest='suffixes',
+                        help='only check files in directories with this '
+                             'suffix (can be repeated; the default depends '
+                             'on the check)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print the summary")
+    parser.add_argument('--stats', action='store_true',
+                        help='time each stage of the checks, and print the '
+                             'totals after the summary')
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.files_from == '-':
+        paths.extend(line.rstrip('\r\n') for line in sys.stdin
+                     if line.strip())
+    elif args.files_from:
+        with open(args.files_from) as lines:
+            paths.extend(line.rstrip('\r\n') for line in lines
+                         if line.strip())
+    if not paths:
+        parser.error('no files given')
+    suffixes = tuple(args.suffixes or DEFAULT_SUFFIXES[args.check])
+
+    start = timer()
+    stats = {}  # worker pid -> [files, bytes, seconds]
+    stage_stats = XHTMLifyStats()
+    failed = 0
+    for result in run(find_files(paths, suffixes), args.check,
+                      args.jobs, args.chunksize, args.stats):
+        if args.stats:
+            stage_stats.merge(result.pop('stats'))
+        worker = stats.setdefault(result['worker'], [0, 0, 0.0])
+        worker[0] += 1
+        worker[1] += result['bytes']
+        worker[2] += result['seconds']
+        failed += not result['ok']
+        print(json.dumps(result, sort_keys=True))
+    if not args.quiet:
+        summarize(stats, timer() - start, sys.stderr)
+        if args.stats:
+            print(stage_stats.report(), file=sys.stderr)
+    return failed and 1 or 0
@@ -0,0 +1,37 @@
+"""Cooperative time limits for converting and checking documents."""
+import time
+
+
+__all__ = ['Deadline', 'DeadlineExceeded']
+
+# The CPU time used by the current thread, where Python can tell (3.7+)
+cpu_time = getattr(time, 'thread_time', None) or \
+    getattr(time, 'perf_counter', time.time)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a document takes longer to process than its Deadline
+       allows."""
+
+
+class Deadline(object):
+    """Allows seconds of CPU time for processing a document, starting now.
+
+       The time is that used by the thread which created the Deadline, so
+       only that thread should check it.  (Before Python 3.7 it is wall
+       clock time.)  Long-running loops call check() every so often, which
+       raises DeadlineExceeded once the time is up.
+    """
+    def __init__(self, seconds, clock=cpu_time):
+        self.seconds = seconds
+        self.clock = clock
+        self.end = clock() + seconds
+
+    def remaining(self):
+        """Returns the number of seconds left (negative if overrun)."""
+        return self.end - self.clock()
+
+    def check(self):
+        """Raises DeadlineExceeded if the time is up."""
+        if self.clock() >= self.end:
+            raise DeadlineExceeded('Took longer than %gs' % self.seconds)
@@ -0,0 +1,174 @@
+"""Measures what the middleware in strainer.middleware costs.
+
+Metrics are off unless a MiddlewareMetrics is set as the metrics of the
+middleware, either for all of them at once::
+
+    >>> from strainer.middleware import BufferingMiddleware
+    >>> from strainer.metrics import MiddlewareMetrics
+    >>> BufferingMiddleware.metrics = MiddlewareMetrics(path='/_strainer')
+
+or on a single instance.  snapshot() returns everything recorded so far,
+and, if path is given, a GET of that path through any of the middleware
+returns the snapshot as JSON.
+"""
+import json
+import threading
+import time
+
+import six
+
+
+__all__ = ['Histogram', 'MiddlewareMetrics']
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    """Counts durations in buckets whose bounds grow in powers of two:
+       bucket i holds those under 2**i microseconds (and at least half
+       that), and the last bucket holds everything longer.
+    """
+    size = 32  # 2**31 microseconds is about 36 minutes
+
+    def __init__(self):
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = int(seconds * 1e6).bit_length()
+        self.buckets[min(i, self.size - 1)] += 1
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Returns an upper bound on the q quantile (0 < q <= 1) of the
+           durations, in seconds: the top of the bucket it falls in, or
+           the longest duration if that is less.  Returns None if there
+           are no durations."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets[:-1]):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        """Returns the histogram as a dict.  buckets maps the upper bound
+           of each bucket which isn't empty, in microseconds (as a string,
+           or "inf"), to its count."""
+        last = self.size - 1
+        return {'count': self.count, 'seconds': self.sum,
+                'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': dict((i < last and str(2 ** i) or 'inf', n)
+                                for i, n in enumerate(self.buckets) if n)}
+
+
+class MiddlewareMetrics(object):
+    """Records, for each middleware class and content type (without
+       parameters), histograms of how long responses took to buffer
+       ("buffer") and to filter ("filter", and "validate" for checks
+       run by a ValidationQueue), and counts of:
+
+       responses
+           responses filtered
+       bytes_in, bytes_out
+           the lengths of their bodies before and after filtering
+       errors
+           problems reported by a validator, and exceptions raised
+       bypassed
+           responses streamed through because of their method, status
+           or content type
+       skipped
+           responses the middleware's sampler chose not to filter, or
+           which were bigger than its max_size
+       overruns
+           responses which took longer to filter than its deadline
+
+       Can be shared between middleware and threads.  If path is given,
+       the middleware using these metrics serve snapshot() as JSON at
+       that path (which the app then never sees).  An instance is also a
+       WSGI app which does that anywhere.
+    """
+    counters = ('responses', 'bytes_in', 'bytes_out', 'errors',
+                'bypassed', 'skipped', 'overruns')
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}  # (name, content_type) -> [counts, histograms]
+        self._lock = threading.Lock()
+
+    def _entry(self, middleware, content_type):
+        key = (type(middleware).__name__, content_type)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [
+                dict.fromkeys(self.counters, 0), {}]
+        return entry
+
+    @staticmethod
+    def _add(histograms, stage, seconds):
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, middleware, content_type, counter, n=1):
+        """Adds n to one of the counters for middleware."""
+        with self._lock:
+            self._entry(middleware, content_type)[0][counter] += n
+
+    def observe(self, middleware, content_type, stage, seconds):
+        """Adds a duration to the histogram for stage of middleware."""
+        with self._lock:
+            self._add(self._entry(middleware, content_type)[1], stage,
+                      seconds)
+
+    def filtered(self, middleware, content_type, seconds, bytes_in,
+                 bytes_out):
+        """Records a response which middleware filtered."""
+        with self._lock:
+            counts, histograms = self._entry(middleware, content_type)
+            counts['responses'] += 1
+            counts['bytes_in'] += bytes_in
+            counts['bytes_out'] += bytes_out
+            self._add(histograms, 'filter', seconds)
+
+    def snapshot(self):
+        """Returns a dict mapping each middleware class name to a dict
+           mapping content types to their counters, with each histogram
+           (see Histogram.as_dict()) under the name of its stage."""
+        result = {}
+        with self._lock:
+            for (name, content_type), (counts, histograms) in \
+                    self._entries.items():
+                entry = dict(counts)
+                for stage, histogram in histograms.items():
+                    entry[stage] = histogram.as_dict()
+                result.setdefault(name, {})[content_type] = entry
+        return result
+
+    def clear(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self._entries.clear()
+
+    def __call__(self, environ, start_response):
+        body = json.dumps(self.snapshot(), sort_keys=True)
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
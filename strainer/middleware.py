@@ -1,107 +1,802 @@
 """Provides WSGI middleware for validating and tidying HTML output."""
 import re
 from . import xhtmlify
+import collections
+import copy
+import hashlib
 import logging
-try:
-    from io import StringIO
-except ImportError:
-    try:
-        from cStringIO import StringIO
-    except ImportError:
-        from StringIO import StringIO
+import random
+import threading
+import time
+import six
+
+from .deadline import Deadline, DeadlineExceeded
+from .metrics import timer
 
 
 __all__ = ['XHTMLValidatorMiddleware', 'XHTMLifyMiddleware',
-           'WellformednessCheckerMiddleware', 'JSONValidatorMiddleware']
+           'WellformednessCheckerMiddleware', 'JSONValidatorMiddleware',
+           'Sampler', 'ValidationQueue', 'StrainerPipeline',
+           'ResponseContext', 'ResultCache']
 
 
 LOG = logging.getLogger('strainer.middleware')
 
 
-def get_content_type(headers, default=''):
-    """Returns the value of the content-type header or default."""
+def get_header(headers, name, default=None):
+    """Returns the value of the header called name (in lowercase), or
+       default."""
     for key, value in headers:
-        if key.lower() == 'content-type':
+        if key.lower() == name:
             return value
     return default
 
 
+def get_content_type(headers, default=''):
+    """Returns the value of the content-type header or default."""
+    return get_header(headers, 'content-type', default)
+
+
+_charset_re = re.compile(r"""charset\s*=\s*("[A-Za-z0-9_-]*"|"""
+                                      r"""'[A-Za-z0-9_-]*'|"""
+                                      r"""[A-Za-z0-9_-]*)""")
+
+
+def parse_content_type(value):
+    """Returns (media_type, charset) for the value of a content-type
+       header, where media_type has no parameters and charset is None
+       if none was given."""
+    parts = value.split(';', 1)
+    charset = None
+    if len(parts) == 2:
+        m = _charset_re.search(parts[1])
+        if m:
+            charset = m.group(1).replace('"', '').replace("'", '')
+    return parts[0].strip(), charset
+
+
+def run_filter(middleware, context):
+    """Calls middleware.apply_filter(context), recording how long it took
+       in middleware.metrics, if it is set.  If middleware.deadline is set
+       (and context has no deadline yet), the filter is given that long;
+       if it overruns, context.body is left as it was."""
+    if middleware.deadline is not None and context.deadline is None:
+        context.deadline = Deadline(middleware.deadline)
+    metrics = middleware.metrics
+    body = context.body
+    start = timer()
+    try:
+        middleware.apply_filter(context)
+    except DeadlineExceeded as e:
+        context.body = body
+        record_overrun(middleware, context, e)
+        return
+    except Exception:
+        if metrics is not None:
+            metrics.count(middleware, context.content_type, 'errors')
+        raise
+    if metrics is not None:
+        metrics.filtered(middleware, context.content_type, timer() - start,
+                         len(body), len(context.body))
+
+
+def record_overrun(middleware, context, error):
+    """Logs that middleware ran out of time filtering context."""
+    if middleware.metrics is not None:
+        middleware.metrics.count(middleware, context.content_type,
+                                 'overruns')
+    environ = context.environ or {}
+    LOG.warning('%s gave up on %s: %s', type(middleware).__name__,
+                environ.get('SCRIPT_NAME', '') +
+                environ.get('PATH_INFO', ''), error)
+
+
+def set_content_length(headers, body):
+    """Returns a copy of headers with the content-length header set to the
+       length of body.  If body is text (from an app which doesn't follow
+       PEP 3333), its length once encoded isn't known, so the header is
+       just removed."""
+    headers = [(key, value) for key, value in headers
+               if key.lower() != 'content-length']
+    if isinstance(body, six.binary_type):
+        headers.append(('Content-Length', str(len(body))))
+    return headers
+
+
+def overrides_filter(middleware, cls):
+    """Returns whether middleware's class has its own filter() method,
+       rather than that of cls (one of the classes here which implement
+       filter_context() directly)."""
+    return (six.get_unbound_function(type(middleware).filter) is not
+            six.get_unbound_function(cls.filter))
+
+
+class Sampler(object):
+    """Chooses which responses a validator middleware should check, so
+       that the cost of validation in production is predictable.
+
+       Each response is checked with the given probability, but no more
+       than rate responses per second are (on average; up to burst may be
+       checked at once, after a quiet spell).  prefixes maps URL path
+       prefixes to a Sampler (or a probability) which decides instead for
+       the paths starting with that prefix; the longest matching prefix
+       wins.  The numbers of responses checked and skipped so far are in
+       sampled and skipped.
+    """
+    def __init__(self, probability=1.0, rate=None, burst=None,
+                 prefixes=None, random=random.random, clock=time.time):
+        self.probability = probability
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(rate, 1)
+        self.burst = burst
+        self.prefixes = sorted(
+            ((prefix, sampler if isinstance(sampler, Sampler)
+                      else Sampler(sampler))
+             for prefix, sampler in (prefixes or {}).items()),
+            key=lambda item: -len(item[0]))
+        self.random = random
+        self.clock = clock
+        self.sampled = 0
+        self.skipped = 0
+        self._tokens = burst
+        self._last = None  # when the token bucket was last filled
+        self._lock = threading.Lock()
+
+    def __call__(self, environ):
+        """Returns True if the response to the request with environ should
+           be checked."""
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        for prefix, sampler in self.prefixes:
+            if path.startswith(prefix):
+                sample = sampler(environ)
+                break
+        else:
+            sample = ((self.probability >= 1 or
+                       self.random() < self.probability) and
+                      (self.rate is None or self._take_token()))
+        with self._lock:
+            if sample:
+                self.sampled += 1
+            else:
+                self.skipped += 1
+        return sample
+
+    def _take_token(self):
+        with self._lock:
+            now = self.clock()
+            if self._last is not None:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class ValidationQueue(object):
+    """Runs validation jobs on a pool of background threads, so that the
+       validator middlewares can serve a response without waiting for it
+       to be checked.
+
+       At most maxsize jobs wait to be run.  When the queue is full, the
+       policy decides which job is dropped: 'drop-newest' drops the job
+       being submitted, 'drop-oldest' the one which has waited longest.
+       The numbers of jobs submitted, dropped, completed and failed
+       (raised an exception) so far are kept in those attributes, and the
+       largest number of jobs which have waited at once in max_depth.
+    """
+    policies = ('drop-newest', 'drop-oldest')
+
+    def __init__(self, workers=1, maxsize=100, policy='drop-newest'):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy %r' % (policy,))
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self._jobs = collections.deque()
+        self._running = 0  # jobs taken off the queue but not finished
+        self._threads = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def depth(self):
+        """The number of jobs waiting to be run."""
+        return len(self._jobs)
+
+    def submit(self, func, *args):
+        """Queues func(*args) to be called by a worker thread.  Returns
+           False if the job was dropped because the queue is full."""
+        with self._cond:
+            if self._closed:
+                raise ValueError('ValidationQueue is closed')
+            self.submitted += 1
+            if len(self._jobs) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == 'drop-newest' or not self._jobs:
+                    return False
+                self._jobs.popleft()
+            self._jobs.append((func, args))
+            self.max_depth = max(self.max_depth, len(self._jobs))
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='strainer-validation')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._closed:
+                    self._cond.wait()
+                if not self._jobs:
+                    return  # closed, and nothing left to do
+                func, args = self._jobs.popleft()
+                self._running += 1
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                LOG.exception('Validation job failed')
+                failed = True
+            with self._cond:
+                self._running -= 1
+                self.completed += 1
+                self.failed += failed
+                self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Waits until every queued job has been run, or for up to timeout
+           seconds.  Returns True if the queue is idle."""
+        deadline = timeout is not None and time.time() + timeout
+        with self._cond:
+            while self._jobs or self._running:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def close(self, wait=True):
+        """Stops accepting jobs.  The workers exit once the jobs already
+           queued have run; if wait is True, waits for them to do so."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def as_dict(self):
+        """Returns the queue's counters as a dict."""
+        with self._cond:
+            return {'depth': len(self._jobs), 'max_depth': self.max_depth,
+                    'submitted': self.submitted, 'dropped': self.dropped,
+                    'completed': self.completed, 'failed': self.failed}
+
+
+class ResponseContext(object):
+    """A buffered response on its way through the filters.
+
+       Holds the status, headers, exc_info and body (as passed to
+       BufferingMiddleware.filter()), and the environ of the request if
+       it is known.  The media type (content_type, without parameters)
+       and charset are parsed from the headers once, however many filters
+       look at them.  Filters may replace body and headers; original_body
+       is the body as the app returned it.  deadline is the Deadline for
+       filtering it, if there is one.
+    """
+    def __init__(self, status, headers, exc_info, body, environ=None):
+        self.status = status
+        self.headers = headers
+        self.exc_info = exc_info
+        self.body = body
+        self.original_body = body
+        self.environ = environ
+        self.deadline = None
+        self.content_type, self.charset = parse_content_type(
+            get_content_type(headers))
+
+    def copy(self):
+        """Returns a shallow copy, e.g. to be checked later."""
+        return copy.copy(self)
+
+
+class ResultCache(object):
+    """Remembers the results of filtering responses, so that a response
+    which is served over and over (e.g. an error page) is only converted
+    or validated once.  Set it as the cache of one middleware; the keys
+    include the middleware's class, but not its settings.
+
+    Responses are identified by a SHA-1 digest of the body and its media
+    type and charset or, for a body as the app returned it, by the URL
+    and a strong ETag header if it has one.  At most max_entries results
+    are kept, adding up to no more than max_bytes characters (or bytes),
+    for up to ttl seconds (or forever if ttl is None); the least
+    recently used are evicted first.  hits, misses, evictions and
+    expirations count what has happened so far.  Instances can be shared
+    between threads.
+    """
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024,
+                 ttl=None, clock=time.time):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0  # total length of the cached results
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = collections.OrderedDict()  # LRU first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups which found a result."""
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+    def key(self, middleware, context):
+        """Returns the cache key for filtering the response described by
+           context (a ResponseContext) with middleware."""
+        prefix = '%s\0%s\0%s\0' % (type(middleware).__name__,
+                                    context.content_type,
+                                    context.charset or '')
+        environ = context.environ
+        etag = get_header(context.headers, 'etag')
+        if (etag and not etag.startswith('W/') and environ is not None and
+                context.body is context.original_body):
+            host = environ.get('HTTP_HOST') or '%s:%s' % (
+                environ.get('SERVER_NAME', ''), environ.get('SERVER_PORT', ''))
+            return (prefix, environ.get('wsgi.url_scheme', ''), host,
+                    environ.get('SCRIPT_NAME', '') +
+                    environ.get('PATH_INFO', ''),
+                    environ.get('QUERY_STRING', ''), etag)
+        body = context.body
+        if isinstance(body, six.text_type):
+            # Text and bytes give different types of output.
+            body = body.encode('utf-8', 'surrogatepass' if six.PY3
+                                        else 'strict')
+            prefix += 'text'
+        digest = hashlib.sha1(prefix.encode('utf-8'))
+        digest.update(body)
+        return digest.digest()
+
+    def get(self, key):
+        """Returns (True, result) if a result is cached for key, or
+           (False, None) if not."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None and \
+                    self.clock() >= entry[1]:
+                self.size -= self._sizeof(entry[0])
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries[key] = entry  # now MRU
+            self.hits += 1
+            return True, entry[0]
+
+    def set(self, key, result):
+        """Stores result (a body, a sequence of error messages or None)
+           for key."""
+        size = self._sizeof(result)
+        if size > self.max_bytes:
+            return  # would evict everything else
+        expires = self.ttl is not None and self.clock() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= self._sizeof(old[0])
+            self._entries[key] = (result, expires)
+            self.size += size
+            while (self.size > self.max_bytes or
+                   len(self._entries) > self.max_entries):
+                _, (old, _) = self._entries.popitem(last=False)
+                self.size -= self._sizeof(old)
+                self.evictions += 1
+
+    @staticmethod
+    def _sizeof(result):
+        if result is None:
+            return 0
+        if isinstance(result, (six.binary_type, six.text_type)):
+            return len(result)
+        return sum(len(message) for message in result)
+
+    def clear(self):
+        """Empties the cache.  The counters are left alone."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def as_dict(self):
+        """Returns the cache's counters as a dict."""
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hit_rate,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
 class BufferingMiddleware(object):
-    """Buffers the response and passes it through self.filter()."""
+    """Buffers the response and passes it through self.filter().
+
+       Only the responses accepted by should_filter() (and by sampler, if
+       it is set) are buffered.  The rest are streamed straight through:
+       the app's iterable is returned as it is, so its close() method and
+       any wsgi.file_wrapper (and so sendfile) still work.
+
+       If metrics (a strainer.metrics.MiddlewareMetrics) is set, on the
+       class to share it between all the middleware or on an instance,
+       the time spent buffering and filtering responses is recorded in it.
+
+       So that one huge response can't hold up a worker for long, set
+       max_size to stream through bodies of more than that many bytes
+       (they are skipped as soon as the content-length header or the
+       body buffered so far is too long), and deadline to a number of
+       seconds of CPU time after which filtering a response is given up
+       and the body is served as it was.
+    """
+    # The content types of the responses to filter, or None for all
+    content_types = None
+    # If set, a Sampler which picks the responses to filter
+    sampler = None
+    # If set, a ResultCache of the results of filtering earlier responses
+    cache = None
+    # If set, a MiddlewareMetrics which records what filtering costs
+    metrics = None
+    # If set, the size of the largest body to filter
+    max_size = None
+    # If set, the most CPU time to spend filtering a response, in seconds
+    deadline = None
+
     def __init__(self, app):
         self.app = app
 
+    def should_filter(self, environ, status, headers):
+        """Returns True if the response with status and headers should be
+           buffered and passed through filter(), or False to pass it on
+           unchanged.  Responses to HEAD requests, and 204 (No Content)
+           and 304 (Not Modified) responses, are never filtered."""
+        content_type = get_content_type(headers).split(';')[0].strip()
+        if (environ.get('REQUEST_METHOD') == 'HEAD' or
+                status[:3] in ('204', '304') or
+                not self.filters_content_type(content_type)):
+            if self.metrics is not None:
+                self.metrics.count(self, content_type, 'bypassed')
+            return False
+        if self.max_size is not None:
+            length = get_header(headers, 'content-length', '')
+            if length.isdigit() and int(length) > self.max_size:
+                self.record_skip(content_type)
+                return False
+        if self.sampler is None or self.sampler(environ):
+            return True
+        self.record_skip(content_type)
+        return False
+
+    def record_skip(self, content_type):
+        """Counts a response which wasn't filtered although it could have
+           been, in metrics."""
+        if self.metrics is not None:
+            self.metrics.count(self, content_type, 'skipped')
+
+    def filters_content_type(self, content_type):
+        """Returns True if responses of content_type (without parameters)
+           should be filtered."""
+        return self.content_types is None or content_type in self.content_types
+
     def __call__(self, environ, start_response):
-        output = StringIO()
+        metrics = self.metrics
+        if (metrics is not None and metrics.path is not None and
+                environ.get('PATH_INFO') == metrics.path):
+            return metrics(environ, start_response)
+        chunks = []
         start_response_args = []
+        passed_through = []
 
         def dummy_start_response(status, headers, exc_info=None):
+            if passed_through or (not start_response_args and
+                    not self.should_filter(environ, status, headers)):
+                passed_through.append(True)
+                return start_response(status, headers, exc_info)
             start_response_args.append((status, headers, exc_info))
-            return output.write
+            return chunks.append
         app_iter = self.app(environ, dummy_start_response)
-        for line in app_iter:
-            output.write(line if xhtmlify.PY3 else line.decode())
-        if hasattr(app_iter, 'close'):
-            app_iter.close()
-        response = output.getvalue()
-        output.close()
+        if not start_response_args and not passed_through:
+            # The app will call start_response when it is first iterated
+            app_iter = _PeekedIterable(app_iter)
+        if passed_through:
+            return app_iter
+        start = timer()
+        max_size = self.max_size
+        size = 0
+        iterator = iter(app_iter)
+        too_big = False
+        try:
+            for chunk in iterator:
+                chunks.append(chunk)
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    too_big = True
+                    break
+        finally:
+            if not too_big and hasattr(app_iter, 'close'):
+                app_iter.close()
+        if too_big:
+            status, headers, exc_info = start_response_args[-1]
+            self.record_skip(parse_content_type(get_content_type(headers))[0])
+            start_response(status, headers, exc_info)
+            return _PeekedIterable(app_iter, chunks, iterator)
+        if chunks:
+            response = chunks[0][:0].join(chunks)
+        else:
+            response = six.b('')
+        del chunks[:]
         status, headers, exc_info = start_response_args[-1]
-        filtered_response = self.filter(status, headers, exc_info, response)
-        start_response(*start_response_args[-1])
-        return [filtered_response]
+        context = ResponseContext(status, headers, exc_info, response,
+                                  environ)
+        if metrics is not None:
+            metrics.observe(self, context.content_type, 'buffer',
+                            timer() - start)
+        run_filter(self, context)
+        headers = context.headers
+        if context.body is not response:
+            headers = set_content_length(headers, context.body)
+        start_response(context.status, headers, exc_info)
+        return [context.body]
+
+    def filter_context(self, context):
+        """Filters the buffered response described by context (a
+           ResponseContext), replacing context.body if it changes.  By
+           default this calls filter()."""
+        context.body = self.filter(context.status, context.headers,
+                                   context.exc_info, context.body)
+
+    def apply_filter(self, context):
+        """Calls filter_context(context), unless self.cache already holds
+           the body it gave for an identical response."""
+        if self.cache is None:
+            self.filter_context(context)
+            return
+        key = self.cache.key(self, context)
+        found, body = self.cache.get(key)
+        if found:
+            if body is not None:  # None means it was left as it was
+                context.body = body
+            return
+        body = context.body
+        self.filter_context(context)
+        self.cache.set(key, None if context.body is body else context.body)
 
     def filter(self, status, headers, exc_info, response):
-        """Returns some response string which may differ from that passed in.
-           response should be a string in both input and output."""
+        """Returns some response body which may differ from that passed in.
+           response is bytes, the body as the app returned it, and the
+           result should be bytes too.  (If the app returned text, in
+           breach of PEP 3333, response is text.)  The content-length
+           header is updated if the body changes."""
         return response
 
+
+class _PeekedIterable(object):
+    """Wraps an app's iterable, getting its first item straight away (or
+       given the items already read, first, and iterator)."""
+    def __init__(self, app_iter, first=None, iterator=None):
+        self.app_iter = app_iter
+        if first is not None:
+            self.first = first
+            self.iterator = iterator
+            return
+        self.iterator = iter(app_iter)
+        try:
+            self.first = [next(self.iterator)]
+        except StopIteration:
+            self.first = []
+
+    def __iter__(self):
+        for item in self.first:
+            yield item
+        del self.first[:]
+        for item in self.iterator:
+            yield item
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class ValidatorMiddleware(BufferingMiddleware):
+    """Base class for the middleware which check responses without
+       changing them.  Subclasses implement validate(), which returns a
+       list of the problems found; each is reported by calling
+       self.record_error(message).
+
+       If queue (a ValidationQueue) is set, responses are served as soon
+       as they have been buffered, and validate() is run later by one of
+       the queue's worker threads; if the queue is full, some responses
+       go unchecked.  If cache (a ResultCache) is set, the problems found
+       in a response are remembered, and reported again without calling
+       validate() when an identical response is served.  (A subclass
+       which overrides filter() is called through it for every response,
+       and the cache isn't used.)
+    """
+    # If set, a ValidationQueue which runs validate() off the request path
+    queue = None
+
+    def filter(self, status, headers, exc_info, response):
+        self._check(ResponseContext(status, headers, exc_info, response),
+                    None)
+        return response
+
+    def filter_context(self, context):
+        if overrides_filter(self, ValidatorMiddleware):
+            # A subclass's own filter() still sees every response
+            BufferingMiddleware.filter_context(self, context)
+        else:
+            self._check(context, None)
+
+    def apply_filter(self, context):
+        if self.cache is None or overrides_filter(self, ValidatorMiddleware):
+            self.filter_context(context)
+            return
+        key = self.cache.key(self, context)
+        found, errors = self.cache.get(key)
+        if found:
+            if self.metrics is not None:
+                self.metrics.count(self, context.content_type, 'errors',
+                                   len(errors))
+            for message in errors:
+                self.record_error(message)
+        else:
+            self._check(context, key)
+
+    def _check(self, context, key):
+        if self.queue is None:
+            self._validate(context, key)
+        else:
+            # Later filters may change context, but not the body itself,
+            # which is an immutable str/bytes
+            self.queue.submit(self._validate_later, context.copy(), key)
+
+    def _validate_later(self, context, key):
+        # A Deadline has to be checked by the thread which made it
+        context.deadline = None
+        if self.deadline is not None:
+            context.deadline = Deadline(self.deadline)
+        self._validate(context, key)
+
+    def _validate(self, context, key):
+        metrics = self.metrics
+        start = timer()
+        try:
+            errors = self.validate(context)
+        except DeadlineExceeded as e:
+            record_overrun(self, context, e)
+            return
+        if metrics is not None:
+            if self.queue is not None:
+                metrics.observe(self, context.content_type, 'validate',
+                                timer() - start)
+            metrics.count(self, context.content_type, 'errors', len(errors))
+        for message in errors:
+            self.record_error(message)
+        if key is not None:
+            self.cache.set(key, tuple(errors))
+
+    def validate(self, context):
+        """Checks the response described by context (a ResponseContext).
+           Returns a list of error messages."""
+        raise NotImplementedError
+
+
 try:
     from .validate import validate_xhtml, XHTMLSyntaxError
 
-    class XHTMLValidatorMiddleware(BufferingMiddleware):
-        def __init__(self, app, doctype='', record_error=LOG.error):
+    class XHTMLValidatorMiddleware(ValidatorMiddleware):
+        content_types = ('text/html', 'application/xml+html')
+
+        def __init__(self, app, doctype='', record_error=LOG.error,
+                     sampler=None, queue=None, cache=None):
             """The middleware will output XHTML validation error messages
-               by calling record_error(message)."""
+               by calling record_error(message).  If sampler (a Sampler)
+               is given, only the responses it picks are validated.  If
+               queue (a ValidationQueue) is given, they are validated by
+               its worker threads after being served.  If cache (a
+               ResultCache) is given, identical responses are only
+               validated once."""
             super(XHTMLValidatorMiddleware, self).__init__(app)
             self.doctype = doctype
             self.record_error = record_error
+            self.sampler = sampler
+            self.queue = queue
+            self.cache = cache
 
-        def filter(self, status, headers, exc_info, response):
-            content_type = get_content_type(headers)
-            content_type = content_type.split(';')[0].strip()
-            if content_type in ('text/html', 'application/xml+html'):
+        def validate(self, context):
+            if context.content_type in ('text/html', 'application/xml+html'):
                 try:
-                    validate_xhtml(response, doctype=self.doctype)
+                    validate_xhtml(context.body, doctype=self.doctype,
+                                   deadline=context.deadline)
                 except XHTMLSyntaxError as e:
-                    self.record_error(str(e))
-            return response
+                    return [str(e)]
+            return []
 except ImportError:
     pass  # no lxml, no XHTMLValidatorMiddleware, sorry.
 
 
 class XHTMLifyMiddleware(BufferingMiddleware):
+    content_types = ('text/html', 'application/xml+html')
+
+    def __init__(self, app, verify=False, stats=None, cache=None):
+        """If verify is True, responses which are already clean XHTML are
+           served as they are, without building a converted copy of
+           them, and the others are still converted in a single pass
+           (see xhtmlify()).  The number of (X)HTML responses and how
+           many of those were already clean are kept in responses and
+           clean_responses.  If stats (an XHTMLifyStats) is given, the
+           time spent in each stage of xhtmlify() is added up in it
+           across all the requests.  If cache (a ResultCache) is given,
+           the converted body of a response is reused for identical
+           responses, which are then not counted."""
+        super(XHTMLifyMiddleware, self).__init__(app)
+        self.verify = verify
+        self.stats = stats
+        self.cache = cache
+        self.responses = 0
+        self.clean_responses = 0
+        self._lock = threading.Lock()  # for the counts
+
     def filter(self, status, headers, exc_info, response):
-        content_type = get_content_type(headers)
-        parts = content_type.split(';', 1)
-        if len(parts) == 2:
-            content_type, rest = parts
+        context = ResponseContext(status, headers, exc_info, response)
+        self._xhtmlify(context)
+        return context.body
+
+    def filter_context(self, context):
+        if overrides_filter(self, XHTMLifyMiddleware):
+            # A subclass's own filter() still sees every response
+            BufferingMiddleware.filter_context(self, context)
         else:
-            rest = ''
-        encoding = re.search(
-            r"""charset\s*=\s*("[A-Za-z0-9_-]*"|"""
-                           r"""'[A-Za-z0-9_-]*'|"""
-                           r"""[A-Za-z0-9_-]*)""", rest)
-        if encoding:
-            encoding = encoding.group(1).replace('"', '').replace("'", '')
-        if content_type.strip() in ('text/html', 'application/xml+html'):
-            response = xhtmlify.xhtmlify(response, encoding=encoding)
-        return response
+            self._xhtmlify(context)
+
+    def _xhtmlify(self, context):
+        if context.content_type in ('text/html', 'application/xml+html'):
+            stats = None
+            if self.stats is not None:
+                stats = xhtmlify.XHTMLifyStats()  # merged in below
+            output = xhtmlify.xhtmlify(context.body, encoding=context.charset,
+                                       verify=self.verify, stats=stats,
+                                       deadline=context.deadline)
+            if stats is not None:
+                self.stats.merge(stats)
+            with self._lock:
+                self.responses += 1
+                if output is context.body:
+                    self.clean_responses += 1
+            context.body = output
 
 
 from .wellformed import is_wellformed_xhtml, is_wellformed_xml
 
 
-class WellformednessCheckerMiddleware(BufferingMiddleware):
+class WellformednessCheckerMiddleware(ValidatorMiddleware):
     """Checks that served webpages are well-formed HTML/XHTML/XML,
        according to the Content-Type header.
 
@@ -111,37 +806,93 @@ class WellformednessCheckerMiddleware(BufferingMiddleware):
        logs to the "strainer.middleware" channel using the standard logging
        module.
     """
-    def __init__(self, app, record_error=LOG.error):
+    def __init__(self, app, record_error=LOG.error, sampler=None,
+                 queue=None, cache=None):
         """The middleware will output HTML/XHTML/XML wellformedness
-           error messages by calling record_error(message)."""
+           error messages by calling record_error(message).  If sampler
+           (a Sampler) is given, only the responses it picks are checked.
+           If queue (a ValidationQueue) is given, they are checked by its
+           worker threads after being served.  If cache (a ResultCache)
+           is given, identical responses are only checked once."""
         super(WellformednessCheckerMiddleware, self).__init__(app)
         self.record_error = record_error
+        self.sampler = sampler
+        self.queue = queue
+        self.cache = cache
 
-    def filter(self, status, headers, exc_info, response):
-        content_type = get_content_type(headers)
-        content_type = content_type.split(';')[0].strip()
+    def filters_content_type(self, content_type):
+        return (content_type in ('text/html', 'application/xml+html') or
+                content_type.split('+')[0] == 'application/xml')
+
+    def validate(self, context):
+        errors = []
+        content_type = context.content_type
         if content_type in ('text/html', 'application/xml+html'):
-            is_wellformed_xhtml(response, record_error=self.record_error)
+            is_wellformed_xhtml(context.body, record_error=errors.append,
+                                deadline=context.deadline)
         elif content_type.split('+')[0] == 'application/xml':
-            is_wellformed_xml(response, record_error=self.record_error)
-        return response
+            is_wellformed_xml(context.body, record_error=errors.append,
+                              deadline=context.deadline)
+        return errors
 
 from .validate import validate_json, JSONSyntaxError
 
 
-class JSONValidatorMiddleware(BufferingMiddleware):
-    def __init__(self, app, doctype='', record_error=LOG.error):
+class JSONValidatorMiddleware(ValidatorMiddleware):
+    content_types = ('text/json',)
+
+    def __init__(self, app, doctype='', record_error=LOG.error,
+                 sampler=None, queue=None, cache=None):
         """The middleware will output JSON validation error messages
-           by calling record_error(message)."""
+           by calling record_error(message).  If sampler (a Sampler) is
+           given, only the responses it picks are validated.  If queue
+           (a ValidationQueue) is given, they are validated by its worker
+           threads after being served.  If cache (a ResultCache) is
+           given, identical responses are only validated once."""
         super(JSONValidatorMiddleware, self).__init__(app)
         self.record_error = record_error
+        self.sampler = sampler
+        self.queue = queue
+        self.cache = cache
 
-    def filter(self, status, headers, exc_info, response):
-        content_type = get_content_type(headers)
-        content_type = content_type.split(';')[0].strip()
-        if content_type == 'text/json':
+    def validate(self, context):
+        if context.content_type == 'text/json':
+            if context.deadline is not None:
+                context.deadline.check()  # the parser can't be interrupted
             try:
-                validate_json(response)
+                validate_json(context.body)
             except JSONSyntaxError as e:
-                self.record_error(str(e))
-        return response
+                return [str(e)]
+        return []
+
+
+class StrainerPipeline(BufferingMiddleware):
+    """Runs several of the middleware in this module as one, buffering
+       each response once instead of once per layer::
+
+           app = StrainerPipeline(app, [XHTMLifyMiddleware(None),
+                                        XHTMLValidatorMiddleware(None)])
+
+       The filters are instances of BufferingMiddleware subclasses (their
+       own app is never called, so it can be None).  They are run in
+       order, each seeing the body left by the one before, and sharing a
+       ResponseContext, so the content type is only parsed once.  Only
+       the filters whose should_filter() accepts a response are run on
+       it, and the response is only buffered if there are any.
+    """
+    # The environ key under which the filters picked for a request are kept
+    environ_key = 'strainer.pipeline.filters'
+
+    def __init__(self, app, filters=()):
+        super(StrainerPipeline, self).__init__(app)
+        self.filters = list(filters)
+
+    def should_filter(self, environ, status, headers):
+        filters = [f for f in self.filters
+                   if f.should_filter(environ, status, headers)]
+        environ[self.environ_key] = filters
+        return bool(filters)
+
+    def filter_context(self, context):
+        for f in (context.environ or {}).pop(self.environ_key, ()):
+            run_filter(f, context)
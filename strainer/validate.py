@@ -38,12 +38,14 @@ class JSONSyntaxError(ValueError):
     pass
 
 _parser = None
+_resolver = None
+_chunk_size = 65536  # how much to parse between checks of a deadline
 
 
-def _get_parser():
-    global _parser, lxml
-    if _parser is not None:
-        return _parser
+def _make_parser():
+    """Returns a new validating parser, which reads the XHTML DTDs from
+       this package."""
+    global _resolver, lxml
     if lxml is None:
         import lxml.etree
 
@@ -60,24 +62,47 @@ def _get_parser():
         def resolve(self, url, id, context):
             return self.resolve_string(self.cache[url], context)
 
-    resolver = CustomResolver()
-    _parser = lxml.etree.XMLParser(dtd_validation=True, no_network=True)
-    _parser.resolvers.add(resolver)
+    if _resolver is None:
+        _resolver = CustomResolver()
+    parser = lxml.etree.XMLParser(dtd_validation=True, no_network=True)
+    parser.resolvers.add(_resolver)
+    return parser
+
+
+def _get_parser():
+    global _parser
+    if _parser is None:
+        _parser = _make_parser()
     return _parser
 
 
-def validate_xhtml(xhtml, doctype=''):
+def validate_xhtml(xhtml, doctype='', deadline=None):
     """Validates that doctype + xhtml matches the DTD.
        If not given or '', doctype will be extracted from the document.
        The resulting doctype must be one of DOCTYPE_XHTML1_STRICT,
        DOCTYPE_XHTML1_TRANSITIONAL or DOCTYPE_XHTML1_FRAMESET.
+       xhtml may be bytes, in which case lxml works out its encoding.
+       If deadline (a strainer.deadline.Deadline) is given, the document
+       is parsed a piece at a time, and DeadlineExceeded is raised if the
+       time runs out.
 
        Requires lxml."""
-    global parser, lxml
+    global lxml
     if lxml is None:
         import lxml.etree
+    prefix = doctype
+    if isinstance(xhtml, bytes) and not isinstance(doctype, bytes):
+        prefix = doctype.encode('ascii')
     try:
-        lxml.etree.fromstring(doctype + xhtml, parser=_get_parser())
+        if deadline is None:
+            lxml.etree.fromstring(prefix + xhtml, parser=_get_parser())
+        else:
+            doc = prefix + xhtml
+            feed_parser = _make_parser()  # a feed parser can't be shared
+            for pos in range(0, len(doc), _chunk_size):
+                deadline.check()
+                feed_parser.feed(doc[pos:pos + _chunk_size])
+            feed_parser.close()
     except lxml.etree.XMLSyntaxError as e:
         # Try to fix up the error message so line numbers are
         # relative to xhtml.
@@ -11,20 +11,23 @@ from xml.sax._exceptions import SAXParseException
 
 __all__ = ['is_wellformed_xml', 'is_wellformed_xhtml']
 
+_chunk_size = 65536  # how much to parse between checks of a deadline
+
 DOCTYPE_XHTML1_STRICT = (
     '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
     '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">')
 
 
-def is_wellformed_xhtml(docpart, record_error=None):
+def is_wellformed_xhtml(docpart, record_error=None, deadline=None):
     """Calls is_wellformed_xml with doctype=DOCTYPE_XHTML1_STRICT
        and entitydefs=htmlentitydefs.entitydefs."""
     return is_wellformed_xml(docpart, doctype=DOCTYPE_XHTML1_STRICT,
                              entitydefs=htmlentitydefs.entitydefs,
-                             record_error=record_error)
+                             record_error=record_error, deadline=deadline)
 
 
-def is_wellformed_xml(docpart, doctype='', entitydefs={}, record_error=None):
+def is_wellformed_xml(docpart, doctype='', entitydefs={}, record_error=None,
+                      deadline=None):
     """Prefixes doctype to docpart and parses the resulting string.
        Returns True if it parses as XML without error. If entitydefs
        is given, checks that all named entity references are keys
@@ -34,8 +37,18 @@ def is_wellformed_xml(docpart, doctype='', entitydefs={}, record_error=None):
        If record_error is not None, it is called with the text of the
        first error message if there is one (that is, if this function
        will return False).
+
+       docpart may be bytes, in which case the parser works out its
+       encoding.
+
+       If deadline (a strainer.deadline.Deadline) is given, the document
+       is parsed a piece at a time, and DeadlineExceeded is raised if the
+       time runs out.
     """
-    doc = doctype + docpart
+    if isinstance(docpart, bytes) and not isinstance(doctype, bytes):
+        doc = doctype.encode('ascii') + docpart
+    else:
+        doc = doctype + docpart
     parser = xml.sax.make_parser()
     parser.setFeature(xml.sax.handler.feature_external_ges, False)
     parser.setFeature(xml.sax.handler.feature_external_pes, False)
@@ -48,7 +61,12 @@ def is_wellformed_xml(docpart, doctype='', entitydefs={}, record_error=None):
         h = Handler()
         parser.setContentHandler(h)
     try:
-        parser.feed(doc)
+        if deadline is None:
+            parser.feed(doc)
+        else:
+            for pos in range(0, len(doc), _chunk_size):
+                deadline.check()
+                parser.feed(doc[pos:pos + _chunk_size])
         parser.close()
         return True
     except SAXParseException as e:
@@ -9,17 +9,49 @@ except ImportError:
     import htmlentitydefs
     PY3 = False
 
+import bisect
 import codecs
+import collections
 import encodings.aliases
+import hashlib
+import threading
+import time
 import six
+from six.moves import intern
+from xml.sax.xmlreader import AttributesImpl
+
+from strainer.deadline import Deadline
+from strainer.doctypes import DOCTYPE_XHTML1_STRICT, \
+    DOCTYPE_XHTML1_TRANSITIONAL, DOCTYPE_XHTML1_FRAMESET
 
 # from six.moves import html_entities as htmlentitydefs
 
 
 __all__ = [
     'xhtmlify',
+    'XHTMLifier',
+    'XHTMLifyResult',
+    'CachedXHTMLifier',
+    'XHTMLifyStats',
+    'XHTMLifyProfile',
+    'DEFAULT_PROFILE',
+    'tokenize',
+    'Tokenizer',
+    'Token',
+    'Text',
+    'Comment',
+    'CData',
+    'PI',
+    'Doctype',
+    'StartTag',
+    'EndTag',
+    'split_attrs',
+    'ampfix',
+    'ampfix_values',
     'xmldecl',
     'fix_xmldecl',
+    'parse_xmldecl',
+    'XMLDecl',
     'sniff_encoding',
     'ValidationError',
     'PY3',
@@ -38,8 +70,13 @@ CDATA_RE = r'<!\[CDATA\[.*?\]\]>'
 COMMENT_RE = r'<!--.*?-->'
 TAG_RE = r'''%s|%s|<((?:[^<>'"]+|'[^']*'|"[^"]*"|'|")*)>|<'''\
         % (COMMENT_RE, CDATA_RE)
-INNARDS_RE = r'(%s(?:[ \t\r\n]+%s)*[ \t\r\n]*(/?)\Z)|(/%s[ \t\r\n]*\Z)|(.*)'\
-        % (NAME_RE, ATTR_RE, NAME_RE)
+# groups: opening tag name, its attributes (with any "/"), the "/",
+# closing tag name
+INNARDS_RE = r'(?:(%s)((?:[ \t\r\n]+%s)*[ \t\r\n]*(/?))\Z)'\
+             r'|(?:/(%s)[ \t\r\n]*\Z)|.*' % (NAME_RE, ATTR_RE, NAME_RE)
+# groups: name, white-space, white-space, value, white-space
+SPLIT_ATTR_RE = r'''(%s)([ \t\r\n]*)(?:=([ \t\r\n]*)("[^"]*"|'[^']*'|%s))?([ \t\r\n]*)'''\
+        % (NAME_RE, BAD_ATTR_RE)
 
 SELF_CLOSING_TAGS = [
     # As per XHTML 1.0 sections 4.6, C.2 and C.3, these are the elements
@@ -70,10 +107,12 @@ class StrainerError(Exception):
 
 class ValidationError(StrainerError):
     def __init__(self, message, pos, line, offset, tags):
+        original_message = message
         message += ' at line %d, column %d (char %d)' % (line, offset, pos + 1)
         if DEBUG:
             message += '\n%r' % tags
         super(ValidationError, self).__init__(message)
+        self.message = original_message
         self.pos = pos
         self.line = line
         self.offset = offset
@@ -83,200 +122,386 @@ class XMLParsingError(StrainerError):
     pass
 
 
+class XHTMLifyProfile(object):
+    """The tag lists and compiled grammars used by xhtmlify().
+
+    Everything is worked out once, when the profile is created, so a
+    profile can be reused for any number of documents.  Profiles can't be
+    modified, so they can safely be shared between threads.  Pass one to
+    xhtmlify() or XHTMLifier() with profile=...; DEFAULT_PROFILE is used
+    if the default tag lists are wanted.
+    """
+    __slots__ = (
+        'self_closing_tags', 'cdata_tags', 'structural_tags',
+        'prohibitors_of', 'self_nesting_tags', 'closed_by',
+        'tag_re', 'innards_re', 'name_re', 'cdata_end_re', 'key',
+    )
+
+    def __init__(self, self_closing_tags=SELF_CLOSING_TAGS,
+                       cdata_tags=CDATA_TAGS,
+                       structural_tags=STRUCTURAL_TAGS):
+        for tag in cdata_tags:
+            assert tag not in self_closing_tags
+        assert 'div' not in structural_tags  # can safely nest with <p>s
+        assert 'span' not in structural_tags
+        # ... but 'p' can be in structural_tags => disallow nested <p>s.
+        init_attr = super(XHTMLifyProfile, self).__setattr__
+        init_attr('self_closing_tags', frozenset(self_closing_tags))
+        init_attr('cdata_tags', frozenset(cdata_tags))
+        init_attr('structural_tags', frozenset(structural_tags))
+        # http://www.w3.org/TR/xhtml1/#prohibitions
+        init_attr('prohibitors_of', {
+            'a': frozenset(['a']),
+            'img': frozenset(['pre']), 'object': frozenset(['pre']),
+            'big': frozenset(['pre']), 'small': frozenset(['pre']),
+            'sub': frozenset(['pre']), 'sup': frozenset(['pre']),
+            'input': frozenset(['button']), 'select': frozenset(['button']),
+            'textarea': frozenset(['button']),
+            'button': frozenset(['button']),
+            'form': frozenset(['button', 'form']),
+            'fieldset': frozenset(['button']),
+            'iframe': frozenset(['button']),
+            'isindex': frozenset(['button']),
+            'label': frozenset(['button', 'label']),
+        })
+        # I'm assuming only the tags listed below can self-nest,
+        # and we automatically close <p> tags before structural tags.
+        # HTML5 has many others like <section> that we don't support.
+        init_attr('self_nesting_tags', frozenset([
+            'div', 'span', 'fieldset', 'q', 'blockquote', 'ins', 'del',
+            'bdo', 'sub', 'sup', 'big', 'small']))
+        # Closing a container can close an open child.
+        init_attr('closed_by', {
+            'p': frozenset(structural_tags),
+            'li': frozenset(['ol', 'ul']),
+            'dd': frozenset(['dl']),
+            'area': frozenset(['map']),
+            'td': frozenset(['tr']),
+            'th': frozenset(['tr']),
+        })
+        init_attr('tag_re', re.compile(TAG_RE, re.DOTALL | re.IGNORECASE))
+        init_attr('innards_re', re.compile(INNARDS_RE, re.DOTALL))
+        init_attr('name_re', re.compile(NAME_RE))
+        init_attr('cdata_end_re', re.compile(r'/(%s)[ \t\r\n]*\Z' % NAME_RE))
+        # Identifies profiles with the same tag lists (see CachedXHTMLifier)
+        init_attr('key', repr((sorted(self.self_closing_tags),
+                               sorted(self.cdata_tags),
+                               sorted(self.structural_tags))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("XHTMLifyProfile objects are read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("XHTMLifyProfile objects are read-only")
+
+    @classmethod
+    def get(cls, self_closing_tags=SELF_CLOSING_TAGS,
+                 cdata_tags=CDATA_TAGS,
+                 structural_tags=STRUCTURAL_TAGS):
+        """Returns DEFAULT_PROFILE if given the default tag lists,
+           otherwise a new profile."""
+        if (self_closing_tags is SELF_CLOSING_TAGS and
+            cdata_tags is CDATA_TAGS and
+            structural_tags is STRUCTURAL_TAGS):
+            return DEFAULT_PROFILE
+        return cls(self_closing_tags, cdata_tags, structural_tags)
+
+
+DEFAULT_PROFILE = XHTMLifyProfile()
+
+
+# Everything ampfix() may change, and the CDATA sections and comments
+# which it must leave alone.
+_ampfix_re = re.compile(r'<!\[CDATA\[.*?\]\]>|<!--.*?-->|&#?\w+;|[&<>]',
+                        re.DOTALL)
+
+
+def _build_ampfix_table():
+    """Returns a dict mapping the entities and other characters that
+       ampfix() replaces to their replacements."""
+    # So that no external DTDs are needed for validation, we only
+    # preserve XML's hard-coded named entities, and convert the rest
+    # to numeric form.
+    table = dict(('&%s;' % name, '&#x%x;' % cp)
+                 for name, cp in htmlentitydefs.name2codepoint.items())
+    for name in ['amp', 'lt', 'gt', 'quot', 'apos']:
+        table['&%s;' % name] = '&%s;' % name
+    table.update({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+    return table
+
+_ampfix_table = _build_ampfix_table()
+
+
+def _ampfix_sub(m, _get=_ampfix_table.get):
+    text = m.group()
+    fixed = _get(text)
+    if fixed is not None:
+        return fixed
+    elif text[:2] == '<!':
+        return text  # CDATA section or comment
+    elif text[:2] == '&#':
+        # character reference
+        try:
+            if text[:3] in ('&#x', '&#X'):
+                c = int(text[3:-1], 16)
+            else:
+                c = int(text[2:-1], 10)
+        except ValueError:
+            pass
+        else:
+            # "&#X...;" is invalid in XHTML
+            if c in (0x9, 0xA, 0xD) or 0x0020 <= c <= 0xD7FF or (
+               0xE000 <= c <= 0xFFFD) or 0x10000 <= c <= 0x10FFFF:
+                return text.lower()  # well-formed
+    return '&amp;' + text[1:]  # unknown entity
+
+
 def ampfix(value):
     """Replaces ampersands in value that aren't part of an HTML entity.
     Adapted from <http://effbot.org/zone/re-sub.htm#unescape-html>.
     Also converts all entities to numeric form and replaces every
     "<" or ">" outside of any CDATA sections with "&lt;" or "&gt;"."""
-    def fixup(m):
-        text = m.group(0)
-        if text == '&':
-            pass
-        elif text[:2] == "&#":
-            # character reference
-            try:
-                uchr = chr if PY3 else unichr
-                if text[:3] in ("&#x", "&#X"):
-                    c = uchr(int(text[3:-1], 16))
-                else:
-                    c = uchr(int(text[2:-1], 10))
-            except ValueError:
-                pass
-            else:
-                # "&#X...;" is invalid in XHTML
-                c = ord(c)
-                if c in (0x9, 0xA, 0xD) or 0x0020 <= c <= 0xD7FF or (
-                   0xE000 <= c <= 0xFFFD) or 0x10000 <= c <= 0x10FFFF:
-                    return text.lower()  # well-formed
-                else:
-                    pass
-        else:
-            # Named entity. So that no external DTDs are needed
-            # for validation, we only preserve XML hard-coded
-            # named entities.
-            name = text[1:-1]
-            if name in ['amp', 'lt', 'gt', 'quot', 'apos']:
-                return text
-            else:
-                cp = htmlentitydefs.name2codepoint.get(name)
-                if cp:
-                    return '&#x%x;' % cp
-                else:
-                    pass
-        return '&amp;' + text[1:]
+    if '&' not in value and '<' not in value and '>' not in value:
+        return value  # nothing to do, as is usually the case
+    return _ampfix_re.sub(_ampfix_sub, value)
 
-    def fix2(m):
-        g = m.group()
-        if g.startswith('<!'):
-            return g
-        elif g == '<':
-            return '&lt;'
-        elif g == '>':
-            return '&gt;'
-        else:
-            return re.sub("&#?\w+;|&", fixup, g)
-    R = re.compile('(<!\[CDATA\[.*?\]\]>)|<!--.*?-->|<|>|[^<>]+', re.DOTALL)
-    return R.sub(fix2, value)
 
+def ampfix_values(values):
+    """Returns a list of the results of ampfix() for each of values,
+       e.g. the values of a tag's attributes, doing them all at once
+       where possible."""
+    joined = '\0'.join(values)
+    if '&' not in joined and '<' not in joined and '>' not in joined:
+        return list(values)
+    if '<!' in joined or joined.count('\0') != len(values) - 1:
+        # A comment or CDATA section might span values
+        return [ampfix(value) for value in values]
+    return _ampfix_re.sub(_ampfix_sub, joined).split('\0')
 
-def fix_attrs(tagname, attrs, ERROR=None):
-    """Returns an XHTML-clean version of attrs, the attributes part
-       of an (X)HTML tag. Tries to make as few changes as possible,
-       but does convert all attribute names to lowercase."""
-    if not attrs and tagname != 'html':
-        return ''  # most tags have no attrs, quick exit in that case
+
+# For reading back text and attributes after ampfix() or cdatafix()
+_xml_text_re = re.compile(r'<!\[CDATA\[(.*?)\]\]>|<!--(.*?)-->|(&#?\w+;)',
+                          re.DOTALL)
+_xml_ref_re = re.compile(r'&#?\w+;')
+_fixed_attr_re = re.compile(
+    r'([^ \t\r\n=/]+)[ \t\r\n]*=[ \t\r\n]*(?:"([^"]*)"|\'([^\']*)\')')
+_attr_space_re = re.compile(r'[\t\r\n]')
+_xml_entities = {'&amp;': '&', '&lt;': '<', '&gt;': '>', '&quot;': '"',
+                 '&apos;': "'"}
+
+
+def _xml_unref(m):
+    ref = m.group()
+    if ref[:2] != '&#':
+        return _xml_entities.get(ref, ref)
+    try:
+        if ref[:3] == '&#x':
+            return six.unichr(int(ref[3:-1], 16))
+        return six.unichr(int(ref[2:-1], 10))
+    except (ValueError, OverflowError):
+        return ref
+
+
+def _xml_unescape(value):
+    """Replaces the references in value, as left by ampfix()."""
+    if '&' not in value:
+        return value
+    return _xml_ref_re.sub(_xml_unref, value)
+
+
+_attr_re = re.compile(SPLIT_ATTR_RE, re.DOTALL)
+_tag_end_re = re.compile(r'[ \t\r\n]*/?')
+_trailing_space_re = re.compile(r'[ \t\r\n]*\Z')
+
+
+def split_attrs(attrs, ERROR=None):
+    """Splits attrs, the attributes part of an (X)HTML tag, into a list of
+       (space, name, postname, preval, value, postval) tuples, one for
+       each attribute, where space is the white-space before the
+       attribute, postname and preval are the white-space either side of
+       the "=", value is the (possibly quoted) value or None if there was
+       no "=", and postval is the white-space after the value.  Returns
+       (attributes, trailing), where trailing is anything after the last
+       attribute (white-space and maybe a "/").  Errors are reported by
+       calling ERROR(message, position within attrs)."""
     lastpos = 0
     result = []
     output = result.append
     seen = {}  # enforce XML's "Well-formedness constraint: Unique Att Spec"
-    name_re = re.compile('(%s)' % NAME_RE + r'([ \t\r\n]*)\Z')
-    space_before = ' '
-    for m in re.compile(ATTR_RE, re.DOTALL).finditer(attrs):
-        assert re.match(r'[ \t\r\n]*\Z', attrs[lastpos:m.start()])
-        output(attrs[lastpos:m.start()] or space_before)
+    for m in _attr_re.finditer(attrs):
+        space = attrs[lastpos:m.start()]
+        assert _trailing_space_re.match(space)
         lastpos = m.end()
-        attr = m.group()
-        # A space to insert before the next attribute
-        if attr[-1:] in ' \t\r\n':
-            space_before = ''
-        else:
-            space_before = ' '
-        if '=' not in attr:
-            assert name_re.match(attr), repr(attr)
-            output(re.sub(r'\A(%s)' % NAME_RE, r'\1="\1"', attr).lower())
-        else:
-            name, value = attr.split('=', 1)
-            m2 = name_re.match(name)
-            if m2:
-                name, postname = m2.groups()
-            else:
-                ERROR("Invalid attribute name", m.start())
-            name = name.lower()
-            preval = re.match(r'[ \t\r\n]*', value).group()
-            value = value[len(preval):]
-            value_end = re.search(r'[ \t\r\n]*\Z', value).start()
-            value, postval = value[:value_end], value[value_end:]
-            if name in seen:
-                ERROR('Repeated attribute "%s"' % name, m.start())
-            else:
-                seen[name] = 1
-
-            if len(value) > 1 and value[0] + value[-1] in ("''", '""'):
-                if value[0] not in value[1:-1]:  # preserve their quoting
-                    value = ampfix(value)
-                    output('%s%s=%s%s%s' % (
-                        name, postname, preval, value, postval))
-                    continue
-                value = value[1:-1]
-            value = ampfix(value.replace('"', '&quot;'))
-            output('%s%s=%s"%s"%s' % (name, postname, preval, value, postval))
-    after = attrs[lastpos:]
-    if re.match(r'[ \t\r\n]*/?', after).end() == len(after):
-        output(after)
-    else:
+        name, postname, preval, value, postval = m.groups()
+        if value is None:
+            output((space, name, postname, '', None, ''))
+            continue
+        lowername = name.lower()
+        if lowername in seen:
+            ERROR('Repeated attribute "%s"' % lowername, m.start())
+            continue  # drop it, if ERROR() returns
+        seen[lowername] = 1
+        output((space, name, postname, preval, value, postval))
+    trailing = attrs[lastpos:]
+    if _tag_end_re.match(trailing).end() != len(trailing):
         ERROR("Malformed tag contents", lastpos)
+        trailing = ''
+    return result, trailing
+
 
+def join_attrs(tagname, attrs, trailing=''):
+    """Returns an XHTML-clean version of the attributes of an (X)HTML tag,
+       given the attributes and trailing text as returned by split_attrs().
+       Tries to make as few changes as possible, but does convert all
+       attribute names to lowercase."""
+    if not attrs and not trailing and tagname != 'html':
+        return ''  # most tags have no attrs, quick exit in that case
+    result = []
+    output = result.append
+    seen = {}
+    space_before = ' '  # A space to insert before the next attribute
+    values = []  # the values, to be ampfixed all at once
+    value_indexes = []  # where each value goes in result
+    for space, name, postname, preval, value, postval in attrs:
+        output(space or space_before)
+        name = name.lower()
+        if value is None:
+            output('%s="%s"%s' % (name, name, postname))
+            space_before = not postname and ' ' or ''
+            continue
+        seen[name] = 1
+        space_before = not postval and ' ' or ''
+        quote = '"'
+        if len(value) > 1 and value[0] + value[-1] in ("''", '""'):
+            if value[0] not in value[1:-1]:  # preserve their quoting
+                quote = ''
+            else:
+                value = value[1:-1]
+        if quote:
+            value = value.replace('"', '&quot;')
+        output('%s%s=%s%s' % (name, postname, preval, quote))
+        value_indexes.append(len(result))
+        values.append(value)
+        output(value)
+        output(quote + postval)
+    if values:
+        for i, value in zip(value_indexes, ampfix_values(values)):
+            result[i] = value
+    output(trailing)
     if tagname == 'html' and 'xmlns' not in seen:
         output(space_before + 'xmlns="http://www.w3.org/1999/xhtml"')
     return ''.join(result)
 
 
+def fix_attrs(tagname, attrs, ERROR=None):
+    """Returns an XHTML-clean version of attrs, the attributes part
+       of an (X)HTML tag. Tries to make as few changes as possible,
+       but does convert all attribute names to lowercase."""
+    if not attrs and tagname != 'html':
+        return ''  # most tags have no attrs, quick exit in that case
+    attrs, trailing = split_attrs(attrs, ERROR)
+    return join_attrs(tagname, attrs, trailing)
+
+
+# The states of cdatafix()'s scanner: (function to find the next character
+# which matters, replacements for "<", ">" and "&", next state for each
+# token which changes state).
+_cdatafix_outside, _cdatafix_comment = [], []
+_cdatafix_dqstring, _cdatafix_sqstring = [], []
+_cdatafix_outside += (
+    re.compile(r'''[/"'<>&\]]''').search,
+    '/*<![CDATA[*/ < /*]]>*/',
+    '/*<![CDATA[*/ > /*]]>*/',
+    '/*<![CDATA[*/ & /*]]>*/',
+    {'/*': _cdatafix_comment, '"': _cdatafix_dqstring,
+     "'": _cdatafix_sqstring})
+_cdatafix_comment += (
+    re.compile(r'''[*<>&\]]''').search,
+    '<![CDATA[<]]>',
+    '<![CDATA[>]]>',
+    '<![CDATA[&]]>',
+    {'*/': _cdatafix_outside})
+_cdatafix_dqstring += (
+    re.compile(r'''[\\"<>&\]]''').search,
+    r'\x3c',
+    r'\x3e',
+    r'\x26',
+    {'"': _cdatafix_outside})
+_cdatafix_sqstring += (
+    re.compile(r'''[\\'<>&\]]''').search,
+    r'\x3c',
+    r'\x3e',
+    r'\x26',
+    {"'": _cdatafix_outside})
+
+
 def cdatafix(value):
     """Alters value, the body of a <script> or <style> tag, so that
        it will be parsed equivalently by the underlying language parser
        whether it is treated as containing CDATA (by an XHTML parser)
-       or #PCDATA (by an HTML parser).
+       or #PCDATA (by an HTML parser).  Returns value itself if it
+       needs no changes.
     """
-    cdata_re = re.compile('(%s)' % CDATA_RE, re.DOTALL)
+    if '<' not in value and '>' not in value and '&' not in value:
+        return value  # nothing to escape, as is usually the case
     result = []
     output = result.append
-    outside_lexer = re.compile(
-        r'''((/\*|"|')|(<!\[CDATA\[)|(\]\]>)|\]|(<)|(>)|(&))|/|[^/"'<>&\]]+''')
-    comment_lexer = re.compile(
-        r'''((\*/)|(<!\[CDATA\[)|(\]\]>)|\]|(<)|(>)|(&))|\*|[^\*<>&\]]+''')
-    dqstring_lexer = re.compile(
-        r'''\\[^<>]|((")|(<!\[CDATA\[)|(\]\]>)|\]|(\\<|<)|(\\>|>)|(\\&|&))|[^\\"<>&\]]+''', re.DOTALL)
-    sqstring_lexer = re.compile(
-        r'''\\[^<>]|((')|(<!\[CDATA\[)|(\]\]>)|\]|(\\<|<)|(\\>|>)|(\\&|&))|[^\\'<>&\]]+''', re.DOTALL)
-    Outside, Comment, DQString, SQString = [], [], [], []
-    Outside += (outside_lexer.match,
-                '/*<![CDATA[*/ < /*]]>*/',
-                '/*<![CDATA[*/ > /*]]>*/',
-                '/*<![CDATA[*/ & /*]]>*/',
-                {'/*': Comment, '"': DQString, "'": SQString})
-    Comment += (comment_lexer.match,
-                '<![CDATA[<]]>',
-                '<![CDATA[>]]>',
-                '<![CDATA[&]]>',
-                {'*/': Outside})
-    DQString += (dqstring_lexer.match,
-                r'\x3c',
-                r'\x3e',
-                r'\x26',
-                {'"': Outside})
-    SQString += (sqstring_lexer.match,
-                r'\x3c',
-                r'\x3e',
-                r'\x26',
-                {"'": Outside})
-    #names = dict(zip([x[0] for x in Outside, Comment, DQString, SQString],
-    #                       ['Outside', 'Comment', 'DQString', 'SQString']))
-    lexer, lt_rep, gt_rep, amp_rep, next_state = Outside
-    pos = 0
+    search, lt_rep, gt_rep, amp_rep, next_state = _cdatafix_outside
     in_cdata = False
-    while pos < len(value):
-        m = lexer(value, pos)
-        #print '%s:' % names[lexer], 'in_cdata=%d' % in_cdata, repr(m.group())
-        assert m.start() == pos  # no gaps
-        pos = m.end()
-        (interesting, state_changer, cdata_start, cdata_end,
-         lt, gt, amp) = m.groups()
-        if interesting:
-            if cdata_start:
-                output(m.group())
+    start = pos = 0  # value[start:pos] is to be output unchanged
+    while 1:
+        m = search(value, pos)
+        if m is None:
+            break
+        pos = m.start()
+        c = value[pos]
+        if c == '<':
+            if value.startswith('<![CDATA[', pos):
                 in_cdata = True
-            elif cdata_end:
-                if in_cdata:
-                    output(m.group())
-                else:
-                    output(']]')
-                    pos = m.start() + 2  # so > gets escaped as normal
+                pos += 9
+                continue
+            replacement, length = lt_rep, 1
+        elif c == '>':
+            replacement, length = gt_rep, 1
+        elif c == '&':
+            replacement, length = amp_rep, 1
+        elif c == ']':
+            if value.startswith(']]>', pos):
+                # Outside a CDATA section, leave the ">" to be escaped
+                pos += in_cdata and 3 or 2
                 in_cdata = False
-            elif lt:
-                output(in_cdata and m.group() or lt_rep)
-            elif gt:
-                output(in_cdata and m.group() or gt_rep)
-            elif amp:
-                output(in_cdata and m.group() or amp_rep)
-            elif m.group() == ']':
-                output(']')
             else:
-                output(in_cdata and m.group() or state_changer)
-                lexer, lt_rep, gt_rep, amp_rep, next_state = \
-                        next_state[state_changer]
+                pos += 1
+            continue
+        elif c == '\\':  # in a string
+            escaped = value[pos + 1:pos + 2]
+            if escaped == '<':
+                replacement, length = lt_rep, 2
+            elif escaped == '>':
+                replacement, length = gt_rep, 2
+            else:
+                pos += 2
+                continue
         else:
-            output(m.group())
+            # Quotes, "/*" and "*/" change the state
+            token = c in '/*' and value[pos:pos + 2] or c
+            if token not in next_state:
+                pos += 1
+                continue
+            search, lt_rep, gt_rep, amp_rep, next_state = next_state[token]
+            pos += len(token)
+            continue
+        if in_cdata:
+            pos += length
+            continue
+        output(value[start:pos])
+        output(replacement)
+        pos += length
+        start = pos
     assert not in_cdata  # enforced by calling parser (I think)
+    if not result:
+        return value
+    output(value[start:])
     return ''.join(result)
 
 
@@ -313,17 +538,173 @@ def xmldecl(version='1.0', encoding=None, standalone=None):
     return six.u('<?xml version="%s"%s%s ?>') % (version, encodingdecl, sddecl)
 
 
+class XMLDecl(collections.namedtuple('XMLDecl', 'bom version encoding '
+                                                'standalone end')):
+    """A parsed XML declaration, as returned by parse_xmldecl(): the
+       byte-order mark before it ('' if none), the values of its version,
+       encoding and standalone pseudo-attributes (None if missing), and
+       the position of its end."""
+    __slots__ = ()
+
+
+_bom = six.u('\ufeff')
+_bomless_utf16_re = re.compile('utf[_-]?16[_-]?[bl]e\Z', re.IGNORECASE)
+
+
+class _XMLDeclGrammar(object):
+    """The regular expressions for the XML declaration, compiled for
+       the encoded form of one encoding.  Building these is slow, so
+       they are cached by _get_xmldecl_grammar()."""
+    def __init__(self, enc):
+        # We must use an encoder to handle utf_8_sig properly.
+        self.encode = encode = codecs.lookup(enc).incrementalencoder().encode
+        # We can't just encode the empty string since Py 2.7 and later
+        # special-case emit the empty string in that case :-(
+        prefix = encode(six.u('K'))[:-len(encode(six.u('K')))]
+        chars_we_need = ('''abcdefghijklmnopqrstuvwxyz'''
+                         '''ABCDEFGHIJKLMNOPQRSTUVWXYZ'''
+                         '''0123456789.-_ \t\r\n<?'"[]:()+*>''')
+        self.multibyte_safe = (
+            encode(chars_we_need * 3) == encode(chars_we_need) * 3)
+        L = lambda s: re.escape(encode(s))  # encoded form of literal s
+        group = lambda s: six.b('(') + s + six.b(')')
+        named = lambda name, s: six.b('(?P<%s>' % name) + s + six.b(')')
+        optional = lambda s: six.b('(?:') + s + six.b(')?')
+        oneof = lambda opts: six.b('(?:') + six.b('|').join(opts) + six.b(')')
+        charset = lambda s: oneof([L(c) for c in s])
+        all_until = lambda s: six.b('(?:(?!') + s + six.b(').)*')
+        joinbytes = six.b('').join
+        upper = charset('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+        lower = charset('abcdefghijklmnopqrstuvwxyz')
+        digit = charset('0123456789')
+        punc = charset('._-')
+        Name = six.b('(?:') + (oneof([upper, lower]) +
+                               oneof([upper, lower, digit, punc])) + six.b('*)')
+        EOB = six.b(r'\Z')  # end of bytes regexp
+
+        # The XML spec's grammar, as used by parse_xmldecl().
+        Ss = charset(' \t\r\n') + six.b('*')  # optional white space
+        Sp = charset(' \t\r\n') + six.b('+')  # required white space
+        Eq = joinbytes([Ss, L('='), Ss])
+        VersionInfo = joinbytes([
+            Sp,
+            L('version'),
+            Eq,
+            oneof([
+                L("'") + named('ver_sq', L('1.') + digit + six.b('+')) +
+                    L("'"),
+                L('"') + named('ver_dq', L('1.') + digit + six.b('+')) +
+                    L('"'),
+            ])
+        ])
+        EncodingDecl = joinbytes([
+            Sp,
+            L('encoding'),
+            Eq,
+            oneof([
+                L("'") + named('enc_sq', Name) + L("'"),
+                L('"') + named('enc_dq', Name) + L('"')
+            ])
+        ])
+        # standalone="yes" is valid XML but almost certainly a lie...
+        SDDecl = joinbytes([
+            Sp,
+            L('standalone'),
+            Eq,
+            oneof([
+                L("'") + named('sd_sq', oneof([L('yes'), L('no')])) +
+                    L("'"),
+                L('"') + named('sd_dq', oneof([L('yes'), L('no')])) +
+                    L('"'),
+            ])
+        ])
+        if enc in ('utf_16_le', 'utf_16_be'):
+            self.strict_prefix = _bom.encode(enc)  # the standard approach fails
+        else:
+            self.strict_prefix = prefix
+        self.strict_re = re.compile(joinbytes([
+            self.strict_prefix,
+            L('<?xml'),
+            VersionInfo,
+            optional(EncodingDecl),
+            optional(SDDecl),
+            Ss,
+            L('?>')
+        ]))
+
+        # The more lenient grammar used by fix_xmldecl().
+        if _bomless_utf16_re.match(enc):
+            # These need a BOM prefix according to the spec but the default
+            # Python encodings of that name don't provide one.
+            prefix = encode(_bom)
+        self.prefix = prefix
+        Ss = charset(' \t\r\n\f') + six.b('*') # optional white space (inc. \f)
+        Sp = charset(' \t\r\n\f') + six.b('+') # required white space (inc. \f)
+        self.start_re = re.compile(joinbytes([
+            prefix, Ss, L('<'), Ss, L('?'), Ss,
+            oneof([L('xml'), L('xmL'), L('xMl'), L('xML'),
+                   L('Xml'), L('XmL'), L('XMl'), L('XML')])]))
+        self.attr_re = re.compile(joinbytes([
+            group(Sp), group(Name), group(joinbytes([Ss, L('='), Ss])),
+            oneof([
+                group(L('"') + all_until(oneof([L('"'), L('<'), L('>')])) +
+                      L('"')),
+                group(L("'") + all_until(oneof([L("'"), L('<'), L('>')])) +
+                      L("'")),
+                group(all_until(oneof([Sp, L('?'), L('<'), L('>')]))),
+            ])
+        ]), re.DOTALL)
+        self.end_re = re.compile(joinbytes([
+            group(Ss), oneof([joinbytes([L('?'), Ss, L('>')]), L('>')])
+        ]))
+        self.bad_end_re = re.compile(oneof([L('>'), L('<')]))
+        self.version_re = re.compile(Ss + group(L("1.") + digit) + Ss + EOB)
+        self.encoding_re = re.compile(Ss + group(Name) + Ss + EOB)
+        self.standalone_re = re.compile(
+            Ss + oneof([
+                group(oneof([
+                        L('yes'), L('yeS'), L('yEs'), L('yES'),
+                        L('Yes'), L('YeS'), L('YEs'), L('YES')])),
+                group(oneof([L('no'), L('nO'),
+                             L('No'), L('NO')]))
+            ]) + Ss + EOB)
+        # Encoded literals
+        self.VERSION = encode('version')
+        self.ENCODING = encode('encoding')
+        self.STANDALONE = encode('standalone')
+        self.YES, self.NO = encode('yes'), encode('no')
+        self.START, self.END = encode('<?xml'), encode('?>')
+        self.GT = encode('>')
+        self.DQUOTE, self.SQUOTE = encode('"'), encode("'")
+        self.SPACE, self.FF = encode(' '), encode('\f')
+
+
+_xmldecl_grammars = {}  # encoding name -> _XMLDeclGrammar
+
+
+def _get_xmldecl_grammar(enc):
+    """Returns the _XMLDeclGrammar for enc, building it the first time."""
+    grammar = _xmldecl_grammars.get(enc)
+    if grammar is None:
+        grammar = _xmldecl_grammars[enc] = _XMLDeclGrammar(enc)
+    return grammar
+
+
 def fix_xmldecl(xml, encoding=None, add_encoding=False, default_version='1.0'):
     """Looks for an XML declaration near the start of xml, cleans it up,
        and returns the adjusted version of xml. Doesn't add a declaration
        if none was found."""
+    return _fix_xmldecl(xml, encoding, add_encoding, default_version)[0]
+
+
+def _fix_xmldecl(xml, encoding=None, add_encoding=False, default_version='1.0'):
+    """Does the work of fix_xmldecl().  Returns (xml, decl), where decl
+       is the XMLDecl for the fixed declaration, or None if there isn't
+       one (so the caller needn't parse it again)."""
     # This code started as a copy of sniff_encoding(), which follows the
     # XML spec.  This version uses a more lenient parser.
     EOS = r'\Z'  # end of string regexp
-    EOB = six.b(EOS)  # end of bytes regexp
-    bom = chr(0xfeff) if PY3 else unichr(0xfeff)
     starts_utf16_re = re.compile('utf[_-]?16', re.IGNORECASE)
-    bomless_utf16_re = re.compile('utf[_-]?16[_-]?[bl]e\Z', re.IGNORECASE)
     unicode_input = isinstance(xml, six.text_type)
     if not re.match(r'1\.[0-9]+' + EOS, default_version):
         raise ValueError("Bad default XML declaration version")
@@ -340,9 +721,9 @@ def fix_xmldecl(xml, encoding=None, add_encoding=False, default_version='1.0'):
             if not unicode_input and not (
                 xml.startswith(codecs.BOM_UTF16_LE) or
                 xml.startswith(codecs.BOM_UTF16_BE)):
-                xml = bom.encode(encoding) + xml
-            elif unicode_input and bomless_utf16_re.match(encoding):
-                xml = bom + xml
+                xml = _bom.encode(encoding) + xml
+            elif unicode_input and _bomless_utf16_re.match(encoding):
+                xml = _bom + xml
             # "else: pass"; Python adds the BOM when encoding unicode as UTF-16
     if unicode_input:
         if encoding:
@@ -359,158 +740,107 @@ def fix_xmldecl(xml, encoding=None, add_encoding=False, default_version='1.0'):
         xml = xmlbytes
         def decode(s):
             result = s.decode(enc, 'strict')
-            if result.startswith(bom):
+            if result.startswith(_bom):
                 result = result[1:]
             return result
     else:
         decode = lambda s: s
-    # We must use an encoder to handle utf_8_sig properly.
-    encode = codecs.lookup(enc).incrementalencoder().encode
-    if bomless_utf16_re.match(enc):
-        # These need a BOM prefix according to the spec but the default
-        # Python encodings of that name don't provide one.
-        prefix = encode(bom)
-    else:
-        # We can't just encode the empty string since Py 2.7 and later
-        # special-case emit the empty string in that case :-(
-        prefix = encode(six.u('K'))[:-len(encode(six.u('K')))]
-    chars_we_need = ('''abcdefghijklmnopqrstuvwxyz'''
-                     '''ABCDEFGHIJKLMNOPQRSTUVWXYZ'''
-                     '''0123456789.-_ \t\r\n<?'"[]:()+*>''')
-    assert encode(chars_we_need * 3) == encode(chars_we_need) * 3, enc
-    L = lambda s: re.escape(encode(s))  # encoded form of literal s
-    group = lambda s: six.b('(') + s + six.b(')')
-    oneof = lambda opts: six.b('(?:') + six.b('|').join(opts) + six.b(')')
-    charset = lambda s: oneof([L(c) for c in s])
-    all_until = lambda s: six.b('(?:(?!') + s + six.b(').)*')
-    upper = charset('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
-    lower = charset('abcdefghijklmnopqrstuvwxyz')
-    digits = charset('0123456789')
-    punc = charset('._-')
-    Name = six.b('(?:') + (oneof([upper, lower]) +
-                           oneof([upper, lower, digits, punc])) + six.b('*)')
-    Ss = charset(' \t\r\n\f') + six.b('*') # optional white space (inc. \f)
-    Sp = charset(' \t\r\n\f') + six.b('+') # required white space (inc. \f)
-    VERSION = encode('version')
-    ENCODING = encode('encoding')
-    STANDALONE = encode('standalone')
-    joinbytes = six.b('').join
-    StartDecl = joinbytes([prefix, Ss, L('<'), Ss, L('?'), Ss,
-                           oneof([L('xml'), L('xmL'), L('xMl'), L('xML'),
-                                  L('Xml'), L('XmL'), L('XMl'), L('XML')])])
-    Attr = joinbytes([
-        group(Sp), group(Name), group(joinbytes([Ss, L('='), Ss])),
-        oneof([
-            group(L('"') + all_until(oneof([L('"'), L('<'), L('>')])) + L('"')),
-            group(L("'") + all_until(oneof([L("'"), L('<'), L('>')])) + L("'")),
-            group(all_until(oneof([Sp, L('?'), L('<'), L('>')]))),
-        ])
-    ])
-    Attr_re = re.compile(Attr, re.DOTALL)
-    EndDecl = joinbytes([
-        group(Ss), oneof([joinbytes([L('?'), Ss, L('>')]), L('>')])
-    ])
-    m = re.match(StartDecl, xml)
+    g = _get_xmldecl_grammar(enc)
+    assert g.multibyte_safe, enc
+    encode = g.encode
+    m = g.start_re.match(xml)
     if m:
         pos = m.end()
         attrs = {}
+        values = {}  # the fixed values of attrs
         while 1:
-            m2 = Attr_re.match(xml, pos)
+            m2 = g.attr_re.match(xml, pos)
             if m2:
                 wspace, name, eq, dquoted, squoted, unquoted = m2.groups()
-                wspace = wspace.replace(encode('\f'), encode(' '))
+                wspace = wspace.replace(g.FF, g.SPACE)
+                eq = eq.replace(g.FF, g.SPACE)
                 if dquoted is not None:
-                    quotes = encode('"')
+                    quotes = g.DQUOTE
                     n = len(quotes)
                     value = dquoted[n:-n]
                 elif squoted is not None:
-                    quotes = encode("'")
+                    quotes = g.SQUOTE
                     n = len(quotes)
                     value = squoted[n:-n]
                 else:
-                    quotes = encode("'")  # works for cp1026 where '"' doesn't
+                    quotes = g.SQUOTE  # works for cp1026 where '"' doesn't
                     value = unquoted
                 if name in attrs:
                     pass  # TODO: warn: already got a value for xxx
-                elif name == VERSION:
-                    m3 = re.match(Ss + group(L("1.") + digits) + Ss + EOB,
-                                  value)
+                elif name == g.VERSION:
+                    m3 = g.version_re.match(value)
                     if m3:
-                        attrs[name] = wspace + name + eq + \
-                                quotes + m3.group(1) + quotes
+                        values[name] = m3.group(1)
                     else:
                         pass  # TODO: warn: expected 1.x
-                elif name == ENCODING:
-                    m3 = re.match(Ss + group(Name) + Ss + EOB, value)
+                elif name == g.ENCODING:
+                    m3 = g.encoding_re.match(value)
                     if m3:
-                        attrs[name] = wspace + name + eq + \
-                                quotes + m3.group(1) + quotes
+                        values[name] = m3.group(1)
                     else:
                         pass  # TODO: warn: expected a name
-                elif name == STANDALONE:
-                    m3 = re.match(
-                        Ss + oneof([
-                            group(oneof([
-                                    L('yes'), L('yeS'), L('yEs'), L('yES'),
-                                    L('Yes'), L('YeS'), L('YEs'), L('YES')])),
-                            group(oneof([L('no'), L('nO'),
-                                         L('No'), L('NO')]))
-                        ]) + Ss + EOB,
-                        value)
+                elif name == g.STANDALONE:
+                    m3 = g.standalone_re.match(value)
                     if m3:
                         yes, no = m3.groups()
-                        if yes:
-                            attrs[name] = wspace + name + eq + \
-                                    quotes + encode('yes') + quotes
-                        else:
-                            attrs[name] = wspace + name + eq + \
-                                    quotes + encode('no') + quotes
+                        values[name] = yes and g.YES or g.NO
                     else:
                         pass  # TODO: warn: expected yes or no
                 else:
                     pass  # TODO: warn: non-standard attribute name
+                if name in values and name not in attrs:
+                    attrs[name] = (wspace + name + eq +
+                                   quotes + values[name] + quotes)
                 pos = m2.end()
             else:
                 break  # doesn't look like an attribute, give up
-        if add_encoding and ENCODING not in attrs:
-            attrs[ENCODING] = encode(" encoding='%s'" % enc)
-        m4 = re.compile(EndDecl).match(xml, pos)
+        if add_encoding and g.ENCODING not in attrs:
+            attrs[g.ENCODING] = encode(" encoding='%s'" % enc)
+            values[g.ENCODING] = encode(enc)
+        m4 = g.end_re.match(xml, pos)
         if m4:
-            return decode(
-                prefix + encode('<?xml') +
-                attrs.get(VERSION, encode(" version='%s'" % default_version)) +
-                (attrs.get(ENCODING) if ENCODING in attrs else six.b('')) +
-                (attrs.get(STANDALONE) if STANDALONE in attrs else six.b('')) +
-                m4.group(1).replace(encode('\f'), encode(' ')) +
-                encode('?>') + xml[m4.end():])
+            decl = (g.prefix + g.START +
+                    attrs.get(g.VERSION,
+                              encode(" version='%s'" % default_version)) +
+                    attrs.get(g.ENCODING, six.b('')) +
+                    attrs.get(g.STANDALONE, six.b('')) +
+                    m4.group(1).replace(g.FF, g.SPACE) +
+                    g.END)
+            value = lambda name: (name in values and
+                                  values[name].decode(enc) or None)
+            record = XMLDecl(
+                bom=six.u('') if unicode_input else g.prefix,
+                version=value(g.VERSION) or default_version,
+                encoding=value(g.ENCODING),
+                standalone=value(g.STANDALONE),
+                end=len(decode(decl)))
+            return decode(decl + xml[m4.end():]), record
         else:
-            m5 = re.compile(oneof([L('>'), L('<')])).search(xml, pos)
+            m5 = g.bad_end_re.search(xml, pos)
             if m5:
-                if m5.group() == encode('>'):
+                if m5.group() == g.GT:
                     endpos = m5.end()
                 else:
                     endpos = m5.start()
-                return decode(xml[:m.start()] + xml[endpos:]) # remove bad decl
+                # remove bad decl
+                return decode(xml[:m.start()] + xml[endpos:]), None
             else:
-                raise ValidationError("Unterminated XML declaration")
+                raise ValidationError("Unterminated XML declaration",
+                                      m.start(), 1, m.start() + 1, [])
     if unicode_input:
         xml = decode(xml)  # reverse the encoding done earlier
-    return xml  # no decl detected
+    return xml, None  # no decl detected
 
 
-def fix_doctype(html):
-    """\
-    Searches for a doctype declaration at the start of html, after any
-    XML declaration and white-space, and makes sure its syntax matches
-    the "doctypedecl" rule in the XML spec, with a few minor exceptions
-    (we disallow '<' and '>' in PUBLIC identifiers, allow any
-    combination of plausible characters for ELEMENT grammar rules,
-    and disallow nested comments and processing instructions).
-    Returns (fixed_doctype, index) where fixed_doctype is a fixed
-    version of everything up to the end of the doctype and index is the
-    position within html of the end of the doctype (so html[index:]
-    can be processed including positions relative to the original input).
-    """
+def _doctype_grammar():
+    """Returns the regular expressions used by fix_doctype(): the XML
+       spec's "doctypedecl" rule, a PUBLIC identifier and its allowed
+       characters, and the keywords (and quoted strings) in a doctype."""
     # This is a conversion of the grammar in the XML spec.
     # If you've never seen a description of what's allowed in the doctype,
     # try to read this code.  They were clearly bonkers.
@@ -587,8 +917,45 @@ def fix_doctype(html):
                        named('extid', opt(S + ExternalID) + Ss) +
                        named('subset', opt(r'\[' + intSubset + r'\]' + Ss)) +
                        '>'))
-    doctypedecl = re.compile(doctypedecl + r'\Z', flags=re.IGNORECASE)
+    return (re.compile(doctypedecl + r'\Z', flags=re.IGNORECASE),
+            re.compile(S + 'PUBLIC' + S + '(%s)' % quoted, flags=re.IGNORECASE),
+            re.compile(PubidLiteral + r'\Z'),
+            re.compile(oneof('"[^"]*"', "'[^']*'",
+                             oneof('#', '!' + Ss) + '[a-zA-Z]+')))
+
+
+(_doctypedecl_re, _doctype_pubid_re, _pubid_literal_re,
+ _doctype_keyword_re) = _doctype_grammar()
+# Looks for <! DOCTYPE ... >, possibly with <! ... >s inside.
+_doctype_re = re.compile('<![ \t\r\n]*DOCTYPE[ \t\r\n][^<>]*'
+                         '(?:<![^<>]*>[^<>]*)*>', re.IGNORECASE)
+_doctype_name_re = re.compile(r'<!\s*(\S+)')
+
+
+def fix_doctype(html):
+    """\
+    Searches for a doctype declaration at the start of html, after any
+    XML declaration and white-space, and makes sure its syntax matches
+    the "doctypedecl" rule in the XML spec, with a few minor exceptions
+    (we disallow '<' and '>' in PUBLIC identifiers, allow any
+    combination of plausible characters for ELEMENT grammar rules,
+    and disallow nested comments and processing instructions).
+    Returns (fixed_doctype, index) where fixed_doctype is a fixed
+    version of everything up to the end of the doctype and index is the
+    position within html of the end of the doctype (so html[index:]
+    can be processed including positions relative to the original input).
+    """
+    m = _doctype_re.search(html)
+    if not m:
+        return '', 0  # no <! DOCTYPE ... > found
+    fixed = _known_doctypes.get(m.group())
+    if fixed is not None:  # the usual case, no need to parse it
+        return html[:m.start()] + fixed, m.end()
+    return _fix_doctype(html, m)
+
 
+def _fix_doctype(html, m):
+    """Does the work of fix_doctype(), given the match of _doctype_re."""
     def ERROR(message, charpos=None):
         if charpos is None:
             charpos = pos
@@ -596,19 +963,13 @@ def fix_doctype(html):
         offset = charpos - html.rfind('\n', 0, charpos)
         raise ValidationError(message, charpos, line, offset, [])
 
-    # Start by looking for <! DOCTYPE ... >, possibly with <! ... >s inside.
-    m = re.compile('<!' + Ss + 'DOCTYPE' + S + '[^<>]*' +
-                   any('<![^<>]*>[^<>]*') + '>', re.IGNORECASE).search(html)
-    if not m:
-        return '', 0  # no <! DOCTYPE ... > found
     # Now check whether it's almost correct
-    m2 = doctypedecl.match(html, m.start(), m.end())
+    m2 = _doctypedecl_re.match(html, m.start(), m.end())
     if not m2:
         raise ERROR('Invalid doctype', m.start())
     m = m2
-    r = re.compile(S + 'PUBLIC' + S + '(%s)' % quoted, flags=re.IGNORECASE)
-    for pubid in r.finditer(html, m.start(), m.end()):
-        if not re.match(PubidLiteral + '\Z', pubid.group(1)):
+    for pubid in _doctype_pubid_re.finditer(html, m.start(), m.end()):
+        if not _pubid_literal_re.match(pubid.group(1)):
             raise ERROR('Bad characters in PUBLIC "..." identifier',
                         pubid.start(1))
 
@@ -623,217 +984,1085 @@ def fix_doctype(html):
             return g.upper()  # convert keywords to uppercase
     before, doctype, body, after = (
         html[:m.start()], m.group('doctype'), m.group('body'), html[m.end():])
-    doctype = re.sub(r'<!\s*(\S+)', lambda m: '<!' + m.group(1).upper(),
-                     doctype)
-    body = re.sub(oneof('"[^"]*"', "'[^']*'",
-                        oneof('#', '!' + Ss) + '[a-zA-Z]+'),
-                     fix, body)
+    doctype = _doctype_name_re.sub(lambda m: '<!' + m.group(1).upper(),
+                                   doctype)
+    body = _doctype_keyword_re.sub(fix, body)
     return before + doctype + body, m.end()
 
 
-def xhtmlify(html, encoding=None,
-                   self_closing_tags=SELF_CLOSING_TAGS,
-                   cdata_tags=CDATA_TAGS,
-                   structural_tags=STRUCTURAL_TAGS):
-    """
-    Parses HTML and converts it to XHTML-style tags.
-    Raises a ValidationError if the tags are badly nested or malformed.
-    It is slightly stricter than normal HTML in some places and more lenient
-    in others, but it generally tries to behave in a human-friendly way.
-    It is intended to be idempotent, i.e. it should make no changes if fed
-    its own output. It accepts XHTML-style self-closing tags.
-    """
-    html = fix_xmldecl(html, encoding=encoding, add_encoding=False)
-    if not encoding:
-        encoding = sniff_encoding(html)
-    unicode_input = isinstance(html, six.text_type)
-    if unicode_input:
-        html = html.encode(encoding, 'strict')
-    if not isinstance(html, six.binary_type):
-        raise TypeError("Expected %s, got %s" %
-                        (six.binary_type.__name__, type(html)))
-    html = html.decode(encoding, 'replace')
+# The fixed versions of the doctypes most documents use
+_known_doctypes = {}
+for _doctype in [DOCTYPE_XHTML1_STRICT, DOCTYPE_XHTML1_TRANSITIONAL,
+                 DOCTYPE_XHTML1_FRAMESET, '<!DOCTYPE html>']:
+    for _doctype in [_doctype.strip(),
+                     _doctype.strip().replace('<!DOCTYPE', '<!doctype')]:
+        _known_doctypes[_doctype] = _fix_doctype(
+            _doctype, _doctype_re.match(_doctype))[0]
+del _doctype
+
+
+if len(six.u('\U00010000')) == 1:
+    _disallowed_char_re = re.compile(  # XML 1.0 section 2.2, "Char" production
+        six.u('[^\x09\x0A\x0D\u0020-\uD7FF\uE000-\uFFFD') +
+          six.u('\U00010000-\U0010FFFF]'))  # <-- 32 bit characters
+else:
+    # Replace 32-bit characters, this Python build doesn't support them
+    _disallowed_char_re = re.compile(  # XML 1.0 section 2.2, "Char" production
+        six.u('[^\x09\x0A\x0D\u0020-\uD7FF\uE000-\uFFFD]'))
+
+
+def fix_chars(html):
+    """Replaces form feeds in html with spaces and any characters which
+       aren't allowed in XML with U+FFFD (the unicode replacement char)."""
     # "in HTML, the Formfeed character (U+000C) is treated as white space"
     html = html.replace(six.u('\u000C'), six.u(' '))
     # Replace disallowed characters with U+FFFD (unicode replacement char)
-    if len(six.u('\U00010000')) == 1:
-        html = re.sub(  # XML 1.0 section 2.2, "Char" production
-            six.u('[^\x09\x0A\x0D\u0020-\uD7FF\uE000-\uFFFD') +
-              six.u('\U00010000-\U0010FFFF]'),  # <-- 32 bit characters
-            six.u('\N{replacement character}'), html)
-    else:
-        # Replace 32-bit characters, this Python build doesn't support them
-        html = re.sub(  # XML 1.0 section 2.2, "Char" production
-            six.u('[^\x09\x0A\x0D\u0020-\uD7FF\uE000-\uFFFD]'),
-            six.u('\N{replacement character}'), html)
+    return _disallowed_char_re.sub(six.u('\N{replacement character}'), html)
 
-    def ERROR(message, charpos=None):
-        if charpos is None:
-            charpos = pos
-        line = html.count('\n', 0, charpos) + 1
-        offset = charpos - html.rfind('\n', 0, charpos)
-        raise ValidationError(message, charpos, line, offset, tags)
-
-    for tag in cdata_tags:
-        assert tag not in self_closing_tags
-    assert 'div' not in structural_tags  # can safely nest with <p>s
-    assert 'span' not in structural_tags
-    # ... but 'p' can be in structural_tags => disallow nested <p>s.
-    tags = []
-    result = []
-    output = result.append
-    # Output the XML declaration and doctype, if they exist.
-    doctype, lastpos = fix_doctype(html)
-    output(doctype)
-    if html.startswith('<?xml') or html.startswith(six.u('\ufeff<?xml')):
-        pos = html.find('>') + 1
-        if not doctype:
-            output(html[:pos])
-            lastpos = pos
-    # Start processing tags
-    tag_re = re.compile(TAG_RE, re.DOTALL | re.IGNORECASE)
-    for tag_match in tag_re.finditer(html, lastpos):
-        pos = tag_match.start()
-        prevtag = tags and tags[-1][0].lower() or None
-        innards = tag_match.group(1)
-        if innards is None:
+
+# Matches the UTF-8 encoding of anything fix_chars() may need to change,
+# so valid UTF-8 which doesn't match can skip fix_chars() altogether.
+if len(six.u('\U00010000')) == 1:
+    _unclean_utf8_re = re.compile(six.b(
+        '[\x00-\x08\x0B\x0C\x0E-\x1F]|\xEF\xBF[\xBE\xBF]'))
+else:
+    _unclean_utf8_re = re.compile(six.b(
+        '[\x00-\x08\x0B\x0C\x0E-\x1F]|\xEF\xBF[\xBE\xBF]|[\xF0-\xF4]'))
+
+
+_quote_re = re.compile('[\'"]')
+_newline_re = re.compile('\n')
+_quote_or_gt_re = re.compile('[\'">]')
+_element_start_re = re.compile('<[A-Za-z/]')
+_doctype_start_re = re.compile('!doctype[ \t\r\n]', re.IGNORECASE)
+
+
+def quotes_balanced(innards):
+    """Returns True if every quote in innards (the inside of a tag, as
+       matched by TAG_RE) is paired with a closing quote within innards,
+       i.e. TAG_RE's match can't change if more text follows the tag."""
+    pos = 0
+    while 1:
+        m = _quote_re.search(innards, pos)
+        if not m:
+            return True
+        pos = innards.find(m.group(), m.end()) + 1
+        if not pos:
+            return False
+
+
+class Token(object):
+    """A piece of an HTML document, as produced by tokenize().
+       text is the source text of the token, and start and end are its
+       offsets in the document."""
+    __slots__ = ('text', 'start', 'end')
+
+    def __init__(self, text, start, end):
+        self.text = text
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '<%s %r at %d>' % (type(self).__name__, self.text, self.start)
+
+
+class Text(Token):
+    """Character data.  cdata is True for the contents of a <script> or
+       <style> element (or whatever the profile's CDATA tags are), which
+       can contain unescaped "<" and "&" characters."""
+    __slots__ = ('cdata',)
+
+    def __init__(self, text, start, end, cdata=False):
+        super(Text, self).__init__(text, start, end)
+        self.cdata = cdata
+
+
+class Comment(Token):
+    """A <!-- ... --> comment."""
+    __slots__ = ()
+
+
+class CData(Token):
+    """A <![CDATA[ ... ]]> section."""
+    __slots__ = ()
+
+
+class PI(Token):
+    """A processing instruction, <? ... >."""
+    __slots__ = ()
+
+
+class Doctype(Token):
+    """A <!DOCTYPE ... > declaration."""
+    __slots__ = ()
+
+
+class StartTag(Token):
+    """An opening tag, or an XHTML-style self-closing tag if self_closing
+       is True.  name is the tag name as written, and attrs and trailing
+       are the attributes as split by split_attrs()."""
+    __slots__ = ('name', 'attrs', 'trailing', 'self_closing')
+
+    def __init__(self, text, start, end, name, attrs=(), trailing='',
+                 self_closing=False):
+        super(StartTag, self).__init__(text, start, end)
+        self.name = name
+        self.attrs = attrs
+        self.trailing = trailing
+        self.self_closing = self_closing
+
+
+class EndTag(Token):
+    """A closing tag.  name is the tag name as written."""
+    __slots__ = ('name',)
+
+    def __init__(self, text, start, end, name):
+        super(EndTag, self).__init__(text, start, end)
+        self.name = name
+
+
+class Tokenizer(object):
+    """Splits HTML into tokens, reading the input once.  This holds the
+       state of tokenize() between calls to tokens(), so that a document
+       can be tokenized a buffer at a time (see XHTMLifier).  Errors are
+       reported by calling ERROR(message, position within the buffer);
+       tokenizing continues, treating the bad tag as text, if it returns.
+    """
+    def __init__(self, profile=DEFAULT_PROFILE, ERROR=None):
+        self.profile = profile
+        self.ERROR = ERROR
+        self.offset = 0  # position of the buffer in the document
+        self.textpos = 0  # the start of the text not yet tokenized
+        self.scanpos = 0  # where to look for the next tag
+        self.cdata_tag = None  # set while inside a <script> or <style>
+        self.split_attrs = split_attrs  # replaced to time it, see stats
+
+    def tokens(self, html, final=True):
+        """Generates the tokens in html, starting at textpos.  If final is
+           False, more of the document is still to come, so stops before
+           anything that may change once more input is added."""
+        profile = self.profile
+        ERROR = self.ERROR
+        offset = self.offset
+        split = self.split_attrs
+        if final:
+            endpos = len(html)
+        else:
+            # Every tag ends in ">", and scanning an unfinished tag can
+            # be very slow, so stop after the last ">" we have seen.
+            endpos = html.rfind('>') + 1
+        for tag_match in profile.tag_re.finditer(html, self.scanpos, endpos):
+            pos = tag_match.start()
+            end = tag_match.end()
+            self.scanpos = end
+            if not final and not self._is_final(html, tag_match):
+                self.scanpos = pos
+                return
+            innards = tag_match.group(1)
             whole_tag = tag_match.group()
-            if whole_tag.startswith('<!'):
-                # CDATA, comment, or doctype-alike. Treat as text.
-                if re.match(r'(?i)<!doctype[ \t\r\n]', whole_tag):
-                    text = html[lastpos:pos]
-                    if re.match(r'[ \t\r\n]*\Z', text):
-                        output(text)
-                    output('<!DOCTYPE')
-                    lastpos = tag_match.start() + len('<!doctype')
+            if innards is None:
+                if self.cdata_tag:
+                    continue  # ignore until we have all the text
+                if whole_tag == '<':
+                    ERROR('Unescaped "<" or unfinished tag', pos)
+                    continue
+                elif whole_tag.startswith('<!--'):
+                    token = Comment(whole_tag, offset + pos, offset + end)
+                else:
+                    token = CData(whole_tag, offset + pos, offset + end)
+            elif not innards:
+                ERROR("Empty tag", pos)
                 continue
-            assert whole_tag == '<'
-            if prevtag in cdata_tags:
-                continue  # ignore until we have all the text
+            elif self.cdata_tag:
+                m = profile.cdata_end_re.match(innards)
+                if not m or m.group(1).lower() != self.cdata_tag:
+                    continue  # not the closing tag we need, keep treating as text
+                token = EndTag(whole_tag, offset + pos, offset + end,
+                               m.group(1))
             else:
-                ERROR('Unescaped "<" or unfinished tag')
-        elif not innards:
-            ERROR("Empty tag")
-        text = html[lastpos:pos]
-        if prevtag in cdata_tags:
-            m = re.match(r'/(%s)[ \t\r\n]*\Z' % NAME_RE, innards)
-            if not m or m.group(1).lower() != prevtag:
-                continue  # not the closing tag we need, keep treating as text
-            output(cdatafix(text))
-        else:
-            output(ampfix(text))
-        m = re.compile(INNARDS_RE, re.DOTALL).match(innards)
-        if m.group(1):  # opening tag
-            endslash = m.group(2)
-            m = re.match(NAME_RE, innards)
-            TagName, attrs = m.group(), innards[m.end():]
-            tagname = TagName.lower()
-            attrs = fix_attrs(tagname, attrs,
-                ERROR=lambda msg, relpos:
-                        ERROR(msg, tag_match.start(1) + m.end() + relpos))
-            if prevtag in self_closing_tags:
-                tags.pop()
-                prevtag = tags and tags[-1][0].lower() or None
-            # http://www.w3.org/TR/xhtml1/#prohibitions
-            prohibitors_of = {
-                'a': ['a'],
-                'img': ['pre'], 'object': ['pre'], 'big': ['pre'],
-                'small': ['pre'], 'sub': ['pre'], 'sup': ['pre'],
-                'input': ['button'], 'select': ['button'],
-                'textarea': ['button'],
-                'button': ['button'], 'form': ['button', 'form'],
-                'fieldset': ['button'], 'iframe': ['button'],
-                'isindex': ['button'],
-                'label': ['button', 'label'],
-            }
-            bad_parents = prohibitors_of.get(tagname, [])
-            for ancestor, _ in tags:
-                if ancestor in bad_parents:
-                    if tagname == ancestor:
-                        other_text = 'other '
-                    else:
-                        other_text = ''
-                    ERROR("XHTML <%s> elements must not "
-                          "contain %s<%s> elements" %
-                          (ancestor, other_text, tagname))
-            # I'm assuming only the tags listed below can self-nest,
-            # and we automatically close <p> tags before structural tags.
-            # HTML5 has many others like <section> that we don't support.
-            if (tagname == prevtag and tagname not in ('div', 'span',
-                    'fieldset', 'q', 'blockquote', 'ins', 'del', 'bdo',
-                    'sub', 'sup', 'big', 'small')
-               ) or (prevtag == 'p' and tagname in structural_tags):
-                tags.pop()
-                output('</%s>' % prevtag)
-                #prevtag = tags and tags[-1][0].lower() or None  # not needed
-            if endslash:
-                output('<%s%s>' % (tagname, attrs))
-            elif tagname in self_closing_tags:
-                if attrs.rstrip() == attrs:
-                    attrs += ' '
-                output('<%s%s/>' % (tagname, attrs))  # preempt any closing tag
-                tags.append((TagName, pos))
-            else:
-                output('<%s%s>' % (tagname, attrs))
-                tags.append((TagName, pos))
-        elif m.group(3):  # closing tag
-            TagName = re.match(r'/(\w+)', innards).group(1)
-            tagname = TagName.lower()
-            if prevtag in self_closing_tags:
-                # The tag has already been output in self-closed form.
-                if prevtag == tagname:  # explicit close
-                    # Minor hack: discard any whitespace we just output
-                    if result[-1].strip():
-                        ERROR("Self-closing tag <%s/> is not empty" %
-                                  tags[-1][0], tags[-1][1])
+                m = profile.innards_re.match(innards)
+                name, attrs, endslash, endname = m.group(1, 2, 3, 4)
+                if name:  # opening tag
+                    if attrs:
+                        attrs_pos = tag_match.start(1) + m.start(2)
+                        attrs, trailing = split(attrs,
+                            ERROR=lambda msg, relpos:
+                                ERROR(msg, attrs_pos + relpos))
                     else:
-                        result.pop()
+                        attrs, trailing = [], ''
+                    token = StartTag(whole_tag, offset + pos, offset + end,
+                                     name, attrs, trailing, bool(endslash))
+                elif endname:  # closing tag
+                    token = EndTag(whole_tag, offset + pos, offset + end,
+                                   endname)
+                elif innards.startswith('?'):
+                    token = PI(whole_tag, offset + pos, offset + end)
+                elif _doctype_start_re.match(innards):
+                    token = Doctype(whole_tag, offset + pos, offset + end)
+                else:
+                    ERROR("Malformed tag", pos)
+                    continue
+            if self.textpos < pos:
+                yield Text(html[self.textpos:pos], offset + self.textpos,
+                           offset + pos, bool(self.cdata_tag))
+            self.textpos = end
+            if type(token) is StartTag:
+                tagname = token.name.lower()
+                if tagname in profile.cdata_tags and not token.self_closing:
+                    self.cdata_tag = tagname
+            elif type(token) is EndTag:
+                self.cdata_tag = None
+            yield token
+        self.scanpos = max(endpos, self.scanpos)
+        if final and self.textpos < len(html):
+            yield Text(html[self.textpos:], offset + self.textpos,
+                       offset + len(html), bool(self.cdata_tag))
+            self.textpos = self.scanpos = len(html)
+
+    def _is_final(self, html, tag_match):
+        """Returns True if more input can't change how TAG_RE matched."""
+        pos = tag_match.start()
+        innards = tag_match.group(1)
+        if innards is None:
+            if tag_match.group() != '<':
+                return True  # CDATA or comment
+            # TAG_RE only matches a lone "<" if there is no ">" before
+            # the next "<" (or there's an unmatched quote in between).
+            end = html.find('<', pos + 1)
+            if end < 0 or _quote_or_gt_re.search(html, pos, end):
+                return False
+            return not (html.startswith('<!--', pos) or
+                        html.startswith('<![CDATA[', pos))
+        if html.startswith('<!--', pos) or html.startswith('<![CDATA[', pos):
+            return False  # may yet be terminated
+        return quotes_balanced(innards)
+
+
+def tokenize(html, profile=None, ERROR=None):
+    """Generates the Text, Comment, CData, PI, Doctype, StartTag and EndTag
+       tokens making up html, which must be text rather than bytes.
+       Raises a ValidationError for a malformed tag, unless ERROR is given,
+       in which case ERROR(message, position) is called instead and the
+       bad tag is treated as text."""
+    if ERROR is None:
+        def ERROR(message, charpos):
+            line = html.count('\n', 0, charpos) + 1
+            offset = charpos - html.rfind('\n', 0, charpos)
+            raise ValidationError(message, charpos, line, offset, [])
+    return Tokenizer(profile or DEFAULT_PROFILE, ERROR).tokens(html)
+
+
+class XHTMLifyResult(collections.namedtuple('XHTMLifyResult',
+                                            'output errors')):
+    """What xhtmlify() returns in recovery mode: the output and a list
+       of the ValidationErrors found, in the order they were found."""
+    __slots__ = ()
+
+
+class XHTMLifyStats(object):
+    """Collects how many times each stage of xhtmlify() ran, how long it
+       took in total (wall time, in seconds) and how much input it was
+       given (bytes, or characters once the input has been decoded, or
+       for fix_attrs the length of the attributes it outputs).
+       Pass one as the stats argument of xhtmlify() or XHTMLifier; when
+       stats isn't given, nothing is timed.
+
+       The stages are fix_xmldecl, sniff_encoding, decode (including the
+       replacement of disallowed characters), fix_doctype, tags (the whole
+       tag loop, including tokenizing and the stages below), split_attrs,
+       fix_attrs, ampfix, cdatafix and encode.
+
+       An XHTMLifyStats should only be used by one thread at a time, but
+       merge() can safely add up the stats of many documents in one.
+    """
+    def __init__(self):
+        self.stages = {}  # stage -> [calls, seconds, size]
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, size=0):
+        """Records one call of stage."""
+        counts = self.stages.get(stage)
+        if counts is None:
+            counts = self.stages[stage] = [0, 0.0, 0]
+        counts[0] += 1
+        counts[1] += seconds
+        counts[2] += size
+
+    def timed(self, stage, func):
+        """Returns a version of func which records each call as one of
+           stage, taking the size from the length of its first argument."""
+        add = self.add
+
+        def wrapper(value, *args, **kwargs):
+            start = timer()
+            result = func(value, *args, **kwargs)
+            add(stage, timer() - start, len(value))
+            return result
+        return wrapper
+
+    def merge(self, other):
+        """Adds the stats in other, an XHTMLifyStats or a dict as returned
+           by as_dict(), to these."""
+        if isinstance(other, XHTMLifyStats):
+            other = other.as_dict()
+        with self._lock:
+            for stage, counts in other.items():
+                mine = self.stages.setdefault(stage, [0, 0.0, 0])
+                mine[0] += counts['calls']
+                mine[1] += counts['seconds']
+                mine[2] += counts['bytes']
+
+    def as_dict(self):
+        """Returns {stage: {'calls': n, 'seconds': t, 'bytes': size}}."""
+        with self._lock:
+            return dict((stage, {'calls': calls, 'seconds': seconds,
+                                 'bytes': size})
+                        for stage, (calls, seconds, size)
+                        in self.stages.items())
+
+    def report(self):
+        """Returns a table of the stats, slowest stage first."""
+        lines = ['%-15s %10s %10s %12s' % ('stage', 'calls', 'seconds',
+                                           'bytes')]
+        stages = sorted(self.as_dict().items(),
+                        key=lambda item: -item[1]['seconds'])
+        for stage, counts in stages:
+            lines.append('%-15s %10d %10.4f %12d' % (
+                stage, counts['calls'], counts['seconds'], counts['bytes']))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self.stages.clear()
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# How much of the input xhtmlify(out=...) converts at a time
+_stream_chunk_size = 65536
+
+# How many tokens the tag loop converts between checks of a Deadline
+_deadline_interval = 64
+
+# How many pieces of output the tag loop collects before passing them to
+# the out of an XHTMLifier
+_write_interval = 1024
+
+
+class _OpenTags(list):
+    """The stack of open tags, as (TagName, pos) pairs.  Also keeps the
+       lowercase name of the innermost open tag (top) and how many tags of
+       each name are open (counts), so that the nesting checks needn't
+       search the whole stack for each new tag."""
+    __slots__ = ('names', 'counts', 'top')
+
+    def __init__(self):
+        list.__init__(self)
+        self.names = []  # the lowercase (interned) names of the tags
+        self.counts = {}
+        self.top = None
+
+    def push(self, TagName, tagname, pos):
+        """Opens TagName, whose lowercase name is tagname."""
+        self.append((TagName, pos))
+        self.names.append(tagname)
+        self.counts[tagname] = self.counts.get(tagname, 0) + 1
+        self.top = tagname
+
+    def pop(self):
+        """Closes the innermost tag, returning its (TagName, pos)."""
+        names = self.names
+        self.counts[names.pop()] -= 1
+        self.top = names and names[-1] or None
+        return list.pop(self)
+
+    def outermost(self, tagnames):
+        """Returns the outermost open tag named in tagnames, or None."""
+        counts = self.counts
+        found = [tagname for tagname in tagnames if counts.get(tagname)]
+        if len(found) > 1:  # rare, so it's OK to search the stack here
+            for tagname in self.names:
+                if tagname in found:
+                    return tagname
+        return found and found[0] or None
+
+
+class XHTMLifier(object):
+    """Converts HTML to XHTML incrementally, like xhtmlify().
+
+    Call feed() with successive chunks of the document and then close().
+    Each call returns whatever part of the output is already final, so
+    only the unconverted tail of the input and the stack of open tags are
+    kept in memory.  The chunks must be either all bytes or all text, and
+    the output is of the same type.  The encoding is sniffed from the
+    first head_size bytes (or characters) of the input, and a doctype is
+    only recognised before the first tag.
+
+    If recover is True, malformed or misplaced tags are added to errors
+    (as ValidationErrors) instead of being raised, and are dropped or
+    escaped so that the output is still well-formed.
+
+    If out (e.g. a file or a socket's makefile()) is given, each piece of
+    output is passed to out.write() as soon as it is final, and feed()
+    and close() return an empty string instead.
+
+    If handler is given, it is sent SAX-style events for the elements
+    and text in the output as they are converted, so that the output
+    needn't be parsed again: startElement(name, attrs), endElement(name),
+    characters(content) and, if it has the method, comment(content).
+    The names are lowercase, attrs is an xml.sax AttributesImpl, and the
+    attribute values and text have their references replaced, so an
+    xml.sax.handler.ContentHandler can be used.  The XML declaration and
+    doctype aren't reported.
+
+    If deadline (a strainer.deadline.Deadline) is given, it is checked
+    every so often as the tags are converted, so feed() and close() may
+    raise DeadlineExceeded.
+    """
+    head_size = 4096
+
+    def __init__(self, encoding=None,
+                       self_closing_tags=SELF_CLOSING_TAGS,
+                       cdata_tags=CDATA_TAGS,
+                       structural_tags=STRUCTURAL_TAGS,
+                       profile=None, recover=False, out=None, handler=None,
+                       stats=None, deadline=None):
+        if profile is None:
+            profile = XHTMLifyProfile.get(self_closing_tags, cdata_tags,
+                                          structural_tags)
+        self.encoding = encoding
+        self.recover = recover
+        self.out = out
+        self.handler = handler
+        self.stats = stats
+        self.deadline = deadline
+        self.errors = []  # the ValidationErrors found in recovery mode
+        self.profile = profile
+        self.tags = _OpenTags()  # stack of (TagName, pos) for the open tags
+        self.unicode_input = None  # not known until the first feed()
+        self._head = []  # input chunks received before the head is parsed
+        self._head_len = 0
+        self._head_end = None  # must see past the first ">" (XML decl end)
+        self._started = False  # True once the XML decl & doctype are done
+        self._closed = False
+        self._decode = None  # set once the encoding is known
+        self._undecoded = six.b('')  # see _decode_utf8()
+        # Decoded input not yet converted, starting at _offset characters
+        # into the document.
+        self._buffer = six.u('')
+        self._offset = 0
+        self._line = 1  # line number of _buffer[0]
+        self._last_newline = -1  # position of last newline before _buffer
+        self._newlines = None  # (_buffer, positions of its newlines)
+        self._tokenizer = Tokenizer(profile, self._error)
+        if stats is not None:
+            self._tokenizer.split_attrs = stats.timed('split_attrs',
+                                                      split_attrs)
+        self._pending = []  # output for the text since the last tag
+
+    def feed(self, data):
+        """Converts some more of the document, returning any output
+           which is now final."""
+        if self._closed:
+            raise ValueError("feed() called after close()")
+        unicode_input = isinstance(data, six.text_type)
+        if not unicode_input and not isinstance(data, six.binary_type):
+            raise TypeError("Expected %s, got %s" %
+                            (six.binary_type.__name__, type(data)))
+        if self.unicode_input is None:
+            self.unicode_input = unicode_input
+        elif unicode_input != self.unicode_input:
+            raise TypeError("Can't mix bytes and text input")
+        if self._decode is None:
+            if self._head_end is None:
+                gt = data.find(six.u('>') if unicode_input else six.b('>'))
+                if gt >= 0:
+                    # Allow for the rest of a multi-byte character
+                    self._head_end = self._head_len + gt + 4
+            self._head.append(data)
+            self._head_len += len(data)
+            if self._head_end is None or self._head_len < max(
+                    self.head_size, self._head_end):
+                return data[:0]
+            data = data[:0].join(self._head)
+            self._head = None
+            self._start_decoding(data)
+        else:
+            self._buffer += self._decode(data)
+        return self._output(self._process(final=False))
+
+    def close(self):
+        """Converts the rest of the document and returns the final part
+           of the output. Raises a ValidationError if the tags are badly
+           nested or malformed."""
+        if self._closed:
+            raise ValueError("close() called twice")
+        if self.unicode_input is None:
+            self.unicode_input = True
+        if self._decode is None:
+            self._start_decoding(six.u('').join(self._head)
+                                 if self.unicode_input
+                                 else six.b('').join(self._head))
+            self._head = None
+        self._buffer += self._decode(
+            six.u('') if self.unicode_input else six.b(''), True)
+        self._closed = True
+        return self._output(self._process(final=True), final=True)
+
+    def _start_decoding(self, head):
+        """Fixes up the XML declaration in head, the start of the document,
+           works out the encoding and decodes head into _buffer."""
+        stats = self.stats
+        if stats is not None:
+            start_time = timer()
+        head, decl = _fix_xmldecl(head, encoding=self.encoding,
+                                  add_encoding=False)
+        if stats is not None:
+            stats.add('fix_xmldecl', timer() - start_time, len(head))
+            start_time = timer()
+        encoding = self.encoding
+        if not encoding and decl is None:
+            encoding = sniff_encoding(head)
+        elif not encoding:
+            # No need to parse the (fixed) declaration again
+            start = head[:4]
+            if self.unicode_input:
+                start = start.encode('utf-8')
+            encoding = _decl_encoding(sniff_bom_encoding(start), decl)
+        if stats is not None:
+            stats.add('sniff_encoding', timer() - start_time, len(head))
+        self.encoding = encoding
+        decode = codecs.getincrementaldecoder(encoding)('replace').decode
+        if self.unicode_input:
+            # Check the text can be encoded, as the output will have to be.
+            encode = codecs.getincrementalencoder(encoding)('strict').encode
+            self._decode = lambda data, final=False: fix_chars(
+                decode(encode(data, final), final))
+        elif codecs.lookup(encoding).name == 'utf-8':
+            self._encode = codecs.getincrementalencoder(encoding)().encode
+            self._decode = self._decode_utf8
+        else:
+            self._encode = codecs.getincrementalencoder(encoding)().encode
+            self._decode = lambda data, final=False: fix_chars(
+                decode(data, final))
+        if stats is not None:
+            self._decode = stats.timed('decode', self._decode)
+            if not self.unicode_input:
+                self._encode = stats.timed('encode', self._encode)
+        self._buffer = self._decode(head)
+
+    def _decode_utf8(self, data, final=False):
+        """Decodes UTF-8 input, only calling fix_chars() if the input is
+           invalid or a scan of the bytes finds a character it would fix."""
+        if self._undecoded:
+            data = self._undecoded + data
+        try:
+            text, consumed = codecs.utf_8_decode(data, 'strict', final)
+        except UnicodeDecodeError:
+            text, consumed = codecs.utf_8_decode(data, 'replace', final)
+            text = fix_chars(text)
+        else:
+            if _unclean_utf8_re.search(data, 0, consumed):
+                text = fix_chars(text)
+        # Keep any incomplete character at the end for next time
+        self._undecoded = data[consumed:]
+        return text
+
+    def _output(self, text, final=False):
+        if not self.unicode_input:
+            # There's an argument that we should only ever deal in bytes,
+            # but it's probably more helpful to say "unicode in =>
+            # unicode out".
+            text = self._encode(text, final)
+        if self.out is None:
+            return text
+        if text:
+            self.out.write(text)
+        return text[:0]
+
+    def _error(self, message, charpos):
+        """Raises a ValidationError for position charpos in _buffer,
+           or in recovery mode adds it to errors."""
+        html = self._buffer
+        if self._newlines is None or self._newlines[0] is not html:
+            # Index the newlines once, rather than counting them for
+            # each error.
+            self._newlines = (html, [m.start()
+                                     for m in _newline_re.finditer(html)])
+        newlines = self._newlines[1]
+        n = bisect.bisect_left(newlines, charpos)
+        if n:
+            last_newline = newlines[n - 1]
+        else:
+            last_newline = self._last_newline - self._offset
+        error = ValidationError(message, self._offset + charpos,
+                                self._line + n, charpos - last_newline,
+                                list(self.tags))
+        if not self.recover:
+            raise error
+        self.errors.append(error)
+
+    def _start(self, final):
+        """Outputs the XML declaration and doctype, if they exist.
+           Returns None if more input is needed to find them."""
+        html = self._buffer
+        if not final and not _element_start_re.search(html):
+            if not _doctype_re.search(html):
+                return None  # there may be a doctype still to come
+        result = []
+        output = result.append
+        if self.stats is None:
+            doctype, lastpos = fix_doctype(html)
+        else:
+            doctype, lastpos = self.stats.timed('fix_doctype',
+                                                fix_doctype)(html)
+        output(doctype)
+        if html.startswith('<?xml') or html.startswith(six.u('\ufeff<?xml')):
+            pos = html.find('>') + 1
+            if not doctype:
+                output(html[:pos])
+                lastpos = pos
+        self._tokenizer.textpos = self._tokenizer.scanpos = lastpos
+        self._started = True
+        return result
+
+    def _process(self, final):
+        """Converts as much of _buffer as possible, returning the output.
+           If final is True, the whole document must be in _buffer."""
+        if not self._started:
+            result = self._start(final)
+            if result is None:
+                return six.u('')
+        else:
+            result = []
+        output = result.append
+        pending = self._pending
+        tags = self.tags
+        offset = self._offset
+        profile = self.profile
+        self_closing_tags = profile.self_closing_tags
+        prohibitors_of = profile.prohibitors_of
+        self_nesting_tags = profile.self_nesting_tags
+        closed_by = profile.closed_by
+        structural_tags = profile.structural_tags
+        handler = self.handler
+        out = self.out
+        deadline = self.deadline
+        countdown = _deadline_interval
+        stats = self.stats
+        if stats is None:
+            fix_text, fix_cdata, fix_tag_attrs = ampfix, cdatafix, join_attrs
+        else:
+            start_time = timer()
+            fix_text = stats.timed('ampfix', ampfix)
+            fix_cdata = stats.timed('cdatafix', cdatafix)
+
+            def fix_tag_attrs(tagname, attrs, trailing):
+                start = timer()
+                result = join_attrs(tagname, attrs, trailing)
+                stats.add('fix_attrs', timer() - start, len(result))
+                return result
+
+        def ERROR(message, charpos=None):
+            if charpos is None:
+                charpos = token.start - offset
+            self._error(message, charpos)
+
+        for token in self._tokenizer.tokens(self._buffer, final):
+            if deadline is not None:
+                countdown -= 1
+                if not countdown:
+                    deadline.check()
+                    countdown = _deadline_interval
+            token_type = type(token)
+            if token_type is Text:
+                if token.cdata:
+                    pending.append(fix_cdata(token.text))
+                else:
+                    pending.append(fix_text(token.text))
+                continue
+            elif token_type is Comment:
+                pending.append(token.text)  # treat as text
+                continue
+            elif token_type is CData:
+                pending.append(fix_text(token.text))  # "<![cdata[" isn't
+                continue
+            # The text since the last tag is output in one piece, so that
+            # the "not empty" check below can look at it.
+            text = six.u('').join(pending)
+            output(text)
+            del pending[:]
+            if out is not None and len(result) > _write_interval:
+                # Write all but text, which may yet be taken back (see
+                # below), so that a big chunk's output isn't all held.
+                if stats is not None:
+                    write_time = timer()
+                self._output(six.u('').join(result[:-1]))
+                del result[:-1]
+                if stats is not None:
+                    start_time += timer() - write_time  # not in 'tags'
+            prevtag = tags.top
+            if handler is not None and text and not (
+                    # whitespace that's discarded below
+                    token_type is EndTag and prevtag in self_closing_tags and
+                    prevtag == token.name.lower() and not text.strip()):
+                self._send_text(text)
+            if token_type is StartTag:
+                TagName = token.name
+                tagname = intern(TagName.lower())
+                attrs = fix_tag_attrs(tagname, token.attrs, token.trailing)
+                if prevtag in self_closing_tags:
+                    tags.pop()
+                    prevtag = tags.top
+                # http://www.w3.org/TR/xhtml1/#prohibitions
+                bad_parents = prohibitors_of.get(tagname)
+                if bad_parents:
+                    ancestor = tags.outermost(bad_parents)
+                    if ancestor is not None:
+                        if tagname == ancestor:
+                            other_text = 'other '
+                        else:
+                            other_text = ''
+                        ERROR("XHTML <%s> elements must not "
+                              "contain %s<%s> elements" %
+                              (ancestor, other_text, tagname))
+                # Only some tags can self-nest, and we automatically
+                # close <p> tags before structural tags.
+                if (tagname == prevtag and tagname not in self_nesting_tags
+                   ) or (prevtag == 'p' and tagname in structural_tags):
+                    tags.pop()
+                    output('</%s>' % prevtag)
+                    #prevtag = tags.top  # not needed
+                    if handler is not None:
+                        handler.endElement(prevtag)
+                if handler is not None:
+                    self._send_start(tagname, attrs)
+                if token.self_closing:
+                    output('<%s%s>' % (tagname, attrs))
+                    if handler is not None:
+                        handler.endElement(tagname)
+                elif tagname in self_closing_tags:
+                    if attrs.rstrip() == attrs:
+                        attrs += ' '
+                    output('<%s%s/>' % (tagname, attrs))  # preempt any closing tag
+                    tags.push(TagName, tagname, token.start)
+                    if handler is not None:
+                        handler.endElement(tagname)
                 else:
+                    output('<%s%s>' % (tagname, attrs))
+                    tags.push(TagName, tagname, token.start)
+            elif token_type is EndTag:
+                TagName = token.name
+                tagname = TagName.lower()
+                if prevtag in self_closing_tags:
+                    # The tag has already been output in self-closed form.
+                    if prevtag == tagname:  # explicit close
+                        # Minor hack: discard any whitespace we just output
+                        if result[-1].strip():
+                            ERROR("Self-closing tag <%s/> is not empty" %
+                                      tags[-1][0],
+                                  tags[-1][1] - offset)
+                        else:
+                            result.pop()
+                    else:
+                        tags.pop()
+                        prevtag = tags.top
+                        assert prevtag not in self_closing_tags
+                # If we have found a mismatched close tag, we may insert
+                # a close tag for the previous tag to fix it in some cases.
+                # Specifically, closing a container can close an open child.
+                if (prevtag != tagname and
+                    tagname in closed_by.get(prevtag, ())):
+                    output('</%s>' % prevtag)
                     tags.pop()
-                    prevtag = tags and tags[-1][0].lower() or None
-                    assert prevtag not in self_closing_tags
-            # If we have found a mismatched close tag, we may insert
-            # a close tag for the previous tag to fix it in some cases.
-            # Specifically, closing a container can close an open child.
-            if prevtag != tagname and (
-                 (prevtag == 'p' and tagname in structural_tags) or
-                 (prevtag == 'li' and tagname in ('ol', 'ul')) or
-                 (prevtag == 'dd' and tagname == 'dl') or
-                 (prevtag == 'area' and tagname == 'map') or
-                 (prevtag == 'td' and tagname == 'tr') or
-                 (prevtag == 'th' and tagname == 'tr')
-            ):
-                output('</%s>' % prevtag)
-                tags.pop()
-                prevtag = tags and tags[-1][0].lower() or None
-            if prevtag == tagname:
+                    if handler is not None:
+                        handler.endElement(prevtag)
+                    prevtag = tags.top
+                if prevtag == tagname:
+                    if tagname not in self_closing_tags:
+                        output(token.text.lower())
+                        tags.pop()
+                        if handler is not None:
+                            handler.endElement(tagname)
+                else:
+                    ERROR("Unexpected closing tag </%s>" % TagName)
+            else:
+                # Processing instructions and doctypes after the start
+                # of the document aren't allowed.
+                ERROR("Malformed tag")
+                output(fix_text(token.text))  # in recovery mode
+                if handler is not None:
+                    self._send_text(result[-1])
+        if final:
+            text = six.u('').join(pending)
+            output(text)
+            del pending[:]
+            if handler is not None and text:
+                self._send_text(text)
+            while tags:
+                TagName, pos = tags.pop()
+                tagname = TagName.lower()
                 if tagname not in self_closing_tags:
-                    output(tag_match.group().lower())
-                    tags.pop()
+                    output('</%s>' % tagname)
+                    if handler is not None:
+                        handler.endElement(tagname)
+        if stats is not None:
+            stats.add('tags', timer() - start_time, self._tokenizer.textpos)
+        self._discard()
+        return six.u('').join(result)
+
+    def _send_start(self, tagname, attrs):
+        """Sends a startElement event for a tag with the (fixed) attributes
+           attrs to the handler."""
+        values = {}
+        if attrs:
+            for name, dquoted, squoted in _fixed_attr_re.findall(attrs):
+                # As an XML parser would normalize the value
+                value = _attr_space_re.sub(' ', dquoted or squoted)
+                values[name] = _xml_unescape(value)
+        self.handler.startElement(tagname, AttributesImpl(values))
+
+    def _send_text(self, text):
+        """Sends characters (and comment) events for text, some output
+           between tags, to the handler."""
+        handler = self.handler
+        if '&' not in text and '<' not in text:
+            handler.characters(text)
+            return
+        chars = []
+        pos = 0
+        for m in _xml_text_re.finditer(text):
+            chars.append(text[pos:m.start()])
+            pos = m.end()
+            cdata, comment, ref = m.groups()
+            if cdata is not None:
+                chars.append(cdata)
+            elif ref is not None:
+                chars.append(_xml_unref(m))
             else:
-                ERROR("Unexpected closing tag </%s>" % TagName)
-        elif m.group(4):  # mismatch
-            ERROR("Malformed tag")
+                chars = six.u('').join(chars)
+                if chars:
+                    handler.characters(chars)
+                chars = []
+                send_comment = getattr(handler, 'comment', None)
+                if send_comment is not None:
+                    send_comment(comment)
+        chars.append(text[pos:])
+        chars = six.u('').join(chars)
+        if chars:
+            handler.characters(chars)
+
+    def _discard(self):
+        """Drops the text which has been tokenized from _buffer."""
+        tokenizer = self._tokenizer
+        keep = tokenizer.textpos
+        tags = self.tags
+        if tags.top in self.profile.self_closing_tags:
+            # Needed for the "Self-closing tag <%s/> is not empty" error
+            keep = min(keep, tags[-1][1] - self._offset)
+        done = self._buffer[:keep]
+        last_newline = done.rfind('\n')
+        if last_newline >= 0:
+            self._line += done.count('\n')
+            self._last_newline = self._offset + last_newline
+        self._buffer = self._buffer[keep:]
+        self._offset += keep
+        tokenizer.offset = self._offset
+        tokenizer.textpos -= keep
+        tokenizer.scanpos -= keep
+
+
+def xhtmlify(html, encoding=None,
+                   self_closing_tags=SELF_CLOSING_TAGS,
+                   cdata_tags=CDATA_TAGS,
+                   structural_tags=STRUCTURAL_TAGS,
+                   profile=None, recover=False, cache=None, out=None,
+                   handler=None, verify=False, stats=None, deadline=None):
+    """
+    Parses HTML and converts it to XHTML-style tags.
+    Raises a ValidationError if the tags are badly nested or malformed.
+    It is slightly stricter than normal HTML in some places and more lenient
+    in others, but it generally tries to behave in a human-friendly way.
+    It is intended to be idempotent, i.e. it should make no changes if fed
+    its own output. It accepts XHTML-style self-closing tags.
+    If profile (an XHTMLifyProfile) is given, its tag lists are used
+    instead of self_closing_tags, cdata_tags and structural_tags.
+    See XHTMLifier for converting a document a piece at a time.
+    If recover is True, carries on after any problems with the tags and
+    returns an XHTMLifyResult holding the output and a list of all the
+    ValidationErrors, rather than raising the first one.  (Errors in the
+    XML declaration are still raised.)
+    If cache (a CachedXHTMLifier) is given, the output is looked up in it
+    first and stored in it afterwards (recovery mode is never cached).
+    If out (anything with a write() method, such as a file) is given, the
+    output is written to it a piece at a time, so that the whole of it is
+    never held in memory, and None is returned (or an XHTMLifyResult with
+    no output, in recovery mode).  If a ValidationError is raised, the
+    output so far will already have been written.  The cache isn't used.
+    If handler is given, it is sent SAX-style events for the output as
+    it is converted; see XHTMLifier.  The cache isn't used then either.
+    If verify is True, the output is compared with html a piece at a
+    time as it is converted, and if it is exactly the same then html
+    itself is returned, so a clean document is never copied and callers
+    can tell that it was clean.  Otherwise the output is collected from
+    the first difference on, in the same pass, so it costs no more than
+    a normal conversion.  (It is ignored if out or handler is given.)
+    If stats (an XHTMLifyStats) is given, the time spent in each stage of
+    the conversion is added to it.  The cache isn't used then.
+    If deadline (a strainer.deadline.Deadline, or a number of seconds) is
+    given, DeadlineExceeded is raised if the conversion takes longer.  The
+    cache isn't used then either.
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+    if verify and out is None and handler is None:
+        checker = _CleanChecker(html)
+        xhtmlifier = XHTMLifier(encoding,
+                                self_closing_tags=self_closing_tags,
+                                cdata_tags=cdata_tags,
+                                structural_tags=structural_tags,
+                                profile=profile, recover=recover,
+                                out=checker, stats=stats, deadline=deadline)
+        xhtmlifier.head_size = len(html) + 1  # process it all in one go
+        xhtmlifier.feed(html)
+        xhtmlifier.close()
+        output = checker.getvalue()
+        if recover:
+            return XHTMLifyResult(output, xhtmlifier.errors)
+        return output
+    if out is not None:
+        xhtmlifier = XHTMLifier(encoding,
+                                self_closing_tags=self_closing_tags,
+                                cdata_tags=cdata_tags,
+                                structural_tags=structural_tags,
+                                profile=profile, recover=recover, out=out,
+                                handler=handler, stats=stats,
+                                deadline=deadline)
+        feed, size = xhtmlifier.feed, _stream_chunk_size
+        for pos in range(0, len(html), size):
+            feed(html[pos:pos + size])
+        xhtmlifier.close()
+        if recover:
+            return XHTMLifyResult(None, xhtmlifier.errors)
+        return None
+    if (cache is not None and not recover and handler is None and
+        stats is None and deadline is None):
+        return cache(html, encoding, self_closing_tags=self_closing_tags,
+                     cdata_tags=cdata_tags, structural_tags=structural_tags,
+                     profile=profile)
+    xhtmlifier = XHTMLifier(encoding, self_closing_tags=self_closing_tags,
+                            cdata_tags=cdata_tags,
+                            structural_tags=structural_tags,
+                            profile=profile, recover=recover,
+                            handler=handler, stats=stats, deadline=deadline)
+    xhtmlifier.head_size = len(html) + 1  # process it all in one go
+    output = xhtmlifier.feed(html) + xhtmlifier.close()
+    if recover:
+        return XHTMLifyResult(output, xhtmlifier.errors)
+    return output
+
+
+class _CleanChecker(object):
+    """A file-like object for XHTMLifier's output which checks that it
+       is the same as expected, without keeping it.  From the first piece
+       which differs on, it collects the output instead."""
+    def __init__(self, expected):
+        self.expected = expected
+        self.pos = 0  # how much of expected has been written
+        self.pieces = None  # the output, once it has differed
+
+    def write(self, data):
+        if self.pieces is None:
+            if self.expected.startswith(data, self.pos):
+                self.pos += len(data)
+                return
+            self.pieces = [self.expected[:self.pos]]
+        self.pieces.append(data)
+
+    def getvalue(self):
+        """Returns the output, which is expected itself if it was the
+           same."""
+        if self.pieces is not None:
+            return self.expected[:0].join(self.pieces)
+        if self.pos == len(self.expected):
+            return self.expected
+        return self.expected[:self.pos]
+
+
+class CachedXHTMLifier(object):
+    """Works like xhtmlify(), but remembers its output for the most
+    recently used inputs, so converting the same HTML again (e.g. a widget
+    included in many pages) needs no parsing at all.
+
+    Entries are keyed by a SHA-1 digest of the input, the encoding and the
+    profile's tag lists, and the least recently used are evicted once the
+    outputs add up to more than max_bytes characters (or bytes).  hits,
+    misses and evictions count what has happened so far.  Instances can be
+    called directly or passed to xhtmlify() as cache=..., and can be shared
+    between threads.  Inputs which raise a ValidationError aren't cached.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0  # total length of the cached outputs
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()  # LRU first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __call__(self, html, encoding=None,
+                       self_closing_tags=SELF_CLOSING_TAGS,
+                       cdata_tags=CDATA_TAGS,
+                       structural_tags=STRUCTURAL_TAGS,
+                       profile=None):
+        if profile is None:
+            profile = XHTMLifyProfile.get(self_closing_tags, cdata_tags,
+                                          structural_tags)
+        key = self.key(html, encoding, profile)
+        with self._lock:
+            output = self._entries.get(key)
+            if output is not None:
+                self.hits += 1
+                self._entries[key] = self._entries.pop(key)  # now MRU
+                return output
+            self.misses += 1
+        output = xhtmlify(html, encoding, profile=profile)
+        self._store(key, output)
+        return output
+
+    def key(self, html, encoding, profile):
+        """Returns the cache key for converting html with profile."""
+        if isinstance(html, six.text_type):
+            # Text and bytes give different types of output.
+            data = html.encode('utf-8', 'surrogatepass' if PY3 else 'strict')
+            prefix = 'text'
         else:
-            # We don't do any validation on pre-processing tags (<? ... >).
-            output(ampfix(tag_match.group()))
-        lastpos = tag_match.end()
-    prevtag = tags and tags[-1][0].lower() or None
-    if prevtag in cdata_tags:
-        output(cdatafix(html[lastpos:]))
-    else:
-        output(ampfix(html[lastpos:]))
-    while tags:
-        TagName, pos = tags.pop()
-        tagname = TagName.lower()
-        if tagname not in self_closing_tags:
-            output('</%s>' % tagname)
-    result = ''.join(result)
-    if not unicode_input:
-        # There's an argument that we should only ever deal in bytes,
-        # but it's probably more helpful to say "unicode in => unicode out".
-        result = result.encode(encoding)
-    return result
+            data = html
+            prefix = 'bytes'
+        digest = hashlib.sha1(('%s\0%s\0%s\0' % (
+            prefix, encoding or '', profile.key)).encode('utf-8'))
+        digest.update(data)
+        return digest.digest()
+
+    def _store(self, key, output):
+        if len(output) > self.max_bytes:
+            return  # would evict everything else
+        with self._lock:
+            if key in self._entries:
+                return  # another thread got there first
+            self._entries[key] = output
+            self.size += len(output)
+            while self.size > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def clear(self):
+        """Empties the cache.  The counters are left alone."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
 
 def test(html=None):
@@ -921,99 +2150,78 @@ def sniff_encoding(xml):
     else:
         raise TypeError('Expected a string, got %r' % type(xml))
     enc = sniff_bom_encoding(xmlbytes)
-    # Now the fun really starts. We compile the encoded sniffer regexp.
-    # We must use an encoder to handle utf_8_sig properly.
-    encode = codecs.lookup(enc).incrementalencoder().encode
-    # We can't just encode the empty string since Py 2.7 and later
-    # special-case emit the empty string in that case :-(
-    prefix = encode(six.u('K'))[:-len(encode(six.u('K')))]
-    if enc in ('utf_16_le', 'utf_16_be'):
-        prefix = six.u('\ufeff').encode(enc)  # the standard approach fails
-    L = lambda s: re.escape(encode(s))  # encoded form of literal s
-    optional = lambda s: six.b('(?:') + s + six.b(')?')
-    oneof = lambda opts: six.b('(?:') + six.b('|').join(opts) + six.b(')')
-    charset = lambda s: oneof([L(c) for c in s])
-    upper = charset('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
-    lower = charset('abcdefghijklmnopqrstuvwxyz')
-    digit = charset('0123456789')
-    digits = digit + six.b('+')
-    punc = charset('._-')
-    name = six.b('(?:') + (oneof([upper, lower]) +
-                           oneof([upper, lower, digit, punc])) + six.b('*)')
-    Ss = charset(' \t\r\n') + six.b('*')  # optional white space
-    Sp = charset(' \t\r\n') + six.b('+')  # required white space
-    joinbytes = six.b('').join
-    Eq = joinbytes([Ss, L('='), Ss])
-    VersionInfo = joinbytes([
-        Sp,
-        L('version'),
-        Eq,
-        oneof([
-            L("'1.") + digits + L("'"),
-            L('"1.') + digits + L('"'),
-        ])
-    ])
-    EncodingDecl = joinbytes([
-        Sp,
-        L('encoding'),
-        Eq,
-        oneof([
-            L("'") + six.b('(?P<enc_dq>') + name + six.b(')') + L("'"),
-            L('"') + six.b('(?P<enc_sq>') + name + six.b(')') + L('"')
-        ])
-    ])
-    # standalone="yes" is valid XML but almost certainly a lie...
-    SDDecl = joinbytes([
-        Sp,
-        L('standalone'),
-        Eq,
-        oneof([
-            L("'") + oneof([L('yes'), L('no')]) + L("'"),
-            L('"') + oneof([L('yes'), L('no')]) + L('"'),
-        ])
-    ])
-    R = joinbytes([
-        prefix,
-        L('<?xml'),
-        VersionInfo,
-        optional(EncodingDecl),
-        optional(SDDecl),
-        Ss,
-        L('?>')
-    ])
-    m = re.match(R, xmlbytes)
-    if m:
-        encvalue = m.group('enc_dq')
-        if encvalue is None:
-            encvalue = m.group('enc_sq')
-            if encvalue is None:
-                return enc
-        decl_enc = encvalue.decode(enc).encode('ascii').decode('ascii')
-        bom_codec = None
-
-        def get_codec(encoding):
-            encoding = encoding.lower()
-            if encoding == 'ebcdic':
-                encoding = 'cp037'  # good enough
-            elif encoding in ('utf_16_le', 'utf_16_be'):
-                encoding = 'utf_16'
-            return codecs.lookup(encoding)
-        try:
-            bom_codec = get_codec(enc)
-        except LookupError:
-            pass  # unknown BOM codec, old version of Python maybe?
-        try:
-            if (bom_codec and enc == enc.lower() and
-                get_codec(decl_enc) != bom_codec):
-                    raise ValidationError(
-                        "Multiply-specified encoding "
-                        "(BOM: %s, XML decl: %s)" % (enc, decl_enc),
-                        0, 1, 1, [])
-        except LookupError:
-            pass  # unknown encoding specified, let it pass
-        return decl_enc
+    return _decl_encoding(enc, _parse_xmldecl(xmlbytes, enc))
+
+
+def parse_xmldecl(xml):
+    """Parses the XML declaration at the start of xml, if it follows the
+       grammar in the XML 1.0 spec, and returns an XMLDecl (or None if
+       there isn't one).  Text is parsed as if it were encoded in UTF-8.
+       See fix_xmldecl() for cleaning up a declaration first."""
+    if isinstance(xml, six.binary_type):
+        xmlbytes = xml
+    elif isinstance(xml, six.text_type):
+        xmlbytes = xml.encode('utf-8')
     else:
+        raise TypeError('Expected a string, got %r' % type(xml))
+    return _parse_xmldecl(xmlbytes, sniff_bom_encoding(xmlbytes),
+                          isinstance(xml, six.text_type))
+
+
+def _parse_xmldecl(xmlbytes, enc, unicode_input=False):
+    """Does the work of parse_xmldecl(), given the encoding implied by
+       the byte-order mark."""
+    g = _get_xmldecl_grammar(enc)
+    m = g.strict_re.match(xmlbytes)
+    if not m:
+        return None
+
+    def value(*names):
+        for name in names:
+            if m.group(name) is not None:
+                return m.group(name).decode(enc).encode('ascii').decode(
+                    'ascii')
+        return None
+    bom, end = g.strict_prefix, m.end()
+    if unicode_input:
+        bom = bom.decode('utf-8')
+        end = len(xmlbytes[:end].decode('utf-8'))
+    return XMLDecl(bom=bom, version=value('ver_sq', 'ver_dq'),
+                   encoding=value('enc_sq', 'enc_dq'),
+                   standalone=value('sd_sq', 'sd_dq'), end=end)
+
+
+def _decl_encoding(enc, decl):
+    """Returns the encoding of a document, given enc, the encoding implied
+       by its byte-order mark, and decl, its XMLDecl (or None)."""
+    if decl is None:
         return 'UTF-8'
+    decl_enc = decl.encoding
+    if decl_enc is None:
+        return enc
+    bom_codec = None
+
+    def get_codec(encoding):
+        encoding = encoding.lower()
+        if encoding == 'ebcdic':
+            encoding = 'cp037'  # good enough
+        elif encoding in ('utf_16_le', 'utf_16_be'):
+            encoding = 'utf_16'
+        return codecs.lookup(encoding)
+    try:
+        bom_codec = get_codec(enc)
+    except LookupError:
+        pass  # unknown BOM codec, old version of Python maybe?
+    try:
+        if (bom_codec and enc == enc.lower() and
+            get_codec(decl_enc) != bom_codec):
+                raise ValidationError(
+                    "Multiply-specified encoding "
+                    "(BOM: %s, XML decl: %s)" % (enc, decl_enc),
+                    0, 1, 1, [])
+    except LookupError:
+        pass  # unknown encoding specified, let it pass
+    return decl_enc
 
 
 def sniff_bom_encoding(xml):
@@ -0,0 +1,114 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from strainer.asgi import XHTMLifyMiddleware, JSONValidatorMiddleware
+from strainer.asgi import WellformednessCheckerMiddleware, StrainerPipeline
+from strainer import middleware
+from strainer.metrics import MiddlewareMetrics
+
+
+# Mocks and other test detritus
+
+class FakeASGIApp(object):
+    def __init__(self, chunks, status=200,
+                 headers=[(b'content-type', b'text/html')]):
+        self.chunks = chunks
+        self.status = status
+        self.headers = headers
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': self.headers})
+        for i, chunk in enumerate(self.chunks):
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': i < len(self.chunks) - 1})
+
+
+def call(app, scope=None):
+    """Runs the ASGI app, returning the messages it sent."""
+    messages = []
+    async def receive():
+        return {'type': 'http.request'}
+    async def send(message):
+        messages.append(message)
+    scope = dict({'type': 'http', 'method': 'GET', 'path': '/'}, **scope or {})
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+def test_asgi_xhtmlify_middleware():
+    executor = ThreadPoolExecutor(1)
+    app = FakeASGIApp([b'<html><body>', b'<br></body></html>'],
+                      headers=[(b'content-type', b'text/html'),
+                               (b'content-length', b'30')])
+    app = XHTMLifyMiddleware(app, executor=executor)
+    messages = call(app)
+    executor.shutdown()
+    assert len(messages)==2, messages
+    r = messages[0]['headers']
+    assert r==[(b'content-type', b'text/html'),
+               (b'Content-Length', b'69')], r
+    r = messages[1]
+    assert r=={'type': 'http.response.body',
+               'body': b'<html xmlns="http://www.w3.org/1999/xhtml">'
+                       b'<body><br /></body></html>'}, r
+    assert app.responses==1
+
+def test_asgi_middleware_streams_other_content_types():
+    chunks = [b'{"a": ', b'1}']
+    app = XHTMLifyMiddleware(FakeASGIApp(
+        chunks, headers=[(b'content-type', b'text/json')]))
+    r = [m.get('body') for m in call(app)]
+    assert r==[None] + chunks, r
+    assert app.responses==0
+    app = XHTMLifyMiddleware(FakeASGIApp([b'<br>']))
+    r = [m.get('body') for m in call(app, {'method': 'HEAD'})]
+    assert r==[None, b'<br>'], r
+
+def test_asgi_validator_middlewares():
+    errors = []
+    app = WellformednessCheckerMiddleware(FakeASGIApp([b'<p>', b'</b>']),
+                                          record_error=errors.append)
+    r = [m.get('body') for m in call(app)]
+    assert r==[None, b'<p></b>'], r
+    assert errors==['line 1, column 6: mismatched tag'], errors
+    errors = []
+    app = JSONValidatorMiddleware(FakeASGIApp(
+        [b'[1, 2'], headers=[(b'content-type', b'text/json')]),
+        record_error=errors.append)
+    r = [m.get('body') for m in call(app)]
+    assert r==[None, b'[1, 2'], r
+    assert len(errors)==1, errors
+
+def test_asgi_strainer_pipeline():
+    errors = []
+    app = StrainerPipeline(FakeASGIApp([b'<p>', b'<br>']), [
+        middleware.XHTMLifyMiddleware(None),
+        middleware.WellformednessCheckerMiddleware(
+            None, record_error=errors.append)])
+    r = [m.get('body') for m in call(app)]
+    assert r==[None, b'<p><br /></p>'], r
+    assert errors==[], errors
+
+def test_asgi_middleware_metrics():
+    app = XHTMLifyMiddleware(FakeASGIApp([b'<p>', b'<br>']))
+    app.metrics = MiddlewareMetrics(path='/_strainer')
+    call(app)
+    messages = call(app, {'path': '/_strainer'})
+    assert messages[0]['status']==200, messages
+    r = json.loads(messages[1]['body'].decode('utf-8'))
+    r = r['XHTMLifyMiddleware']['text/html']
+    assert (r['responses'], r['buffer']['count'])==(1, 1), r
+
+def test_asgi_middleware_max_size():
+    app = XHTMLifyMiddleware(FakeASGIApp([b'<p>', b'x<br>', b'</p>']))
+    app.max_size = 5
+    r = [(m.get('body'), m.get('more_body')) for m in call(app)]
+    assert r==[(None, None), (b'<p>x<br>', True), (b'</p>', False)], r
+
+def test_asgi_middleware_other_scopes():
+    called = []
+    async def app(scope, receive, send):
+        called.append(scope['type'])
+    call(XHTMLifyMiddleware(app), {'type': 'lifespan'})
+    assert called==['lifespan'], called
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+from strainer.batch import check_file, find_files, run, main
+
+
+def make_tree():
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'sub'))
+    for name, data in [('a.html', '<p>ok</p>'),
+                       ('sub/b.html', '<p>bad</b>'),
+                       ('sub/c.json', '{"a": 1}'),
+                       ('sub/d.json', '{a')]:
+        f = open(os.path.join(root, name), 'w')
+        f.write(data)
+        f.close()
+    return root
+
+def test_check_file():
+    root = make_tree()
+    try:
+        r = check_file(os.path.join(root, 'sub', 'b.html'))
+        assert not r['ok'], r
+        assert r['errors']==['Unexpected closing tag </b> '
+                             'at line 1, column 7 (char 7)'], r
+        assert r['bytes']==10, r
+        r = check_file(os.path.join(root, 'sub', 'c.json'), 'json')
+        assert r['ok'] and r['errors']==[], r
+        r = check_file(os.path.join(root, 'missing.html'))
+        assert not r['ok'], r
+        r = check_file(os.path.join(root, 'a.html'), stats=True)
+        assert r['stats']['tags']['calls']==1, r['stats']
+        assert r['stats']['decode']['bytes']==9, r['stats']
+    finally:
+        shutil.rmtree(root)
+
+def test_run_in_order():
+    root = make_tree()
+    try:
+        paths = list(find_files([root], ('.html',)))
+        e = [os.path.join(root, 'a.html'), os.path.join(root, 'sub', 'b.html')]
+        assert paths==e, paths
+        paths = paths * 10
+        for jobs in (1, 2):
+            r = [result['path'] for result in run(paths, jobs=jobs,
+                                                  chunksize=3)]
+            assert r==paths, (jobs, r)
+        r = [result['ok'] for result in run(find_files([root], ('.json',)),
+                                             'json', jobs=2)]
+        assert r==[True, False], r
+    finally:
+        shutil.rmtree(root)
+
+def test_main_exit_status():
+    root = make_tree()
+    try:
+        r = main(['-q', '-j', '1', os.path.join(root, 'a.html')])
+        assert r==0, r
+        r = main(['-q', '-j', '1', root])
+        assert r==1, r
+        listing = os.path.join(root, 'files.txt')
+        f = open(listing, 'w')
+        f.write(os.path.join(root, 'a.html') + '\n\n')
+        f.close()
+        r = main(['-q', '-j', '1', '--files-from', listing])
+        assert r==0, r
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,68 @@
+import json
+import six
+from strainer.metrics import Histogram, MiddlewareMetrics
+from strainer.middleware import XHTMLifyMiddleware, StrainerPipeline
+from strainer.middleware import WellformednessCheckerMiddleware, Sampler
+
+
+def fake_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', environ['type'])])
+    return [six.b('<p>a<br>')]
+
+def fake_start_response(status, headers, exc_info=None):
+    pass
+
+
+def test_histogram():
+    histogram = Histogram()
+    for seconds in (0.0000005, 0.000003, 0.000003, 0.001, 1e6):
+        histogram.add(seconds)
+    r = histogram.as_dict()
+    assert abs(r.pop('seconds') - 1000000.0010065) < 1e-6
+    assert r=={'count': 5, 'min': 0.0000005,
+               'max': 1e6, 'p50': 0.000004, 'p90': 1e6, 'p99': 1e6,
+               'buckets': {'1': 1, '4': 2, '1024': 1, 'inf': 1}}, r
+    r = Histogram().quantile(0.5)
+    assert r is None, r
+
+def test_middleware_metrics():
+    metrics = MiddlewareMetrics()
+    errors = []
+    xhtmlifier = XHTMLifyMiddleware(fake_app)
+    xhtmlifier.metrics = metrics
+    checker = WellformednessCheckerMiddleware(
+        None, record_error=errors.append, sampler=Sampler(0))
+    checker.metrics = metrics
+    xhtmlifier({'type': 'text/html'}, fake_start_response)
+    xhtmlifier({'type': 'text/plain'}, fake_start_response)
+    StrainerPipeline(fake_app, [checker])(
+        {'type': 'text/html'}, fake_start_response)
+    r = metrics.snapshot()
+    assert sorted(r)==['WellformednessCheckerMiddleware',
+                       'XHTMLifyMiddleware'], r
+    html = r['XHTMLifyMiddleware']['text/html']
+    assert html['filter']['count']==1, html
+    assert html['buffer']['count']==1, html
+    r = dict((key, html[key]) for key in MiddlewareMetrics.counters)
+    assert r=={'responses': 1, 'bytes_in': 8, 'bytes_out': 14,
+               'errors': 0, 'bypassed': 0, 'skipped': 0, 'overruns': 0}, r
+    r = metrics.snapshot()['XHTMLifyMiddleware']['text/plain']['bypassed']
+    assert r==1, r
+    r = metrics.snapshot()['WellformednessCheckerMiddleware']['text/html']
+    assert r['skipped']==1, r
+    metrics.clear()
+    assert metrics.snapshot()=={}
+
+def test_middleware_metrics_path():
+    metrics = MiddlewareMetrics(path='/_strainer')
+    app = XHTMLifyMiddleware(fake_app)
+    app.metrics = metrics
+    app({'type': 'text/html', 'PATH_INFO': '/'}, fake_start_response)
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started.append((status, headers[0]))
+    body = app({'PATH_INFO': '/_strainer'}, start_response)
+    assert started==[('200 OK', ('Content-Type', 'application/json'))]
+    r = json.loads(body[0].decode('utf-8'))
+    r = r['XHTMLifyMiddleware']['text/html']['responses']
+    assert r==1, r
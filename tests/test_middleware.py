@@ -1,13 +1,19 @@
 import logging
+import threading
+import six
 from strainer.middleware import XHTMLifyMiddleware
 from strainer.middleware import WellformednessCheckerMiddleware
-from strainer.middleware import JSONValidatorMiddleware
+from strainer.middleware import JSONValidatorMiddleware, Sampler
+from strainer.middleware import ValidationQueue, StrainerPipeline
+from strainer.middleware import ResponseContext, ResultCache
 try:
     from strainer.middleware import XHTMLValidatorMiddleware
 except ImportError:
     XHTMLValidatorMiddleware = None
 
 from strainer.doctypes import DOCTYPE_XHTML1_STRICT
+from strainer.xhtmlify import XHTMLifyStats
+from strainer.metrics import MiddlewareMetrics
 
 
 # Mocks and other test detritus
@@ -81,6 +87,111 @@ def test_xhtmlify_middleware_runs():
     response = app({}, fake_start_response)
     assert response==['<html xmlns="http://www.w3.org/1999/xhtml"></html>']
 
+def test_xhtmlify_middleware_verify():
+    clean = '<html xmlns="http://www.w3.org/1999/xhtml"></html>'
+    app = XHTMLifyMiddleware(FakeWSGIApp(clean), verify=True)
+    response = app({}, fake_start_response)
+    assert response==[clean], response
+    app.app = FakeWSGIApp('<html>')
+    response = app({}, fake_start_response)
+    assert response==[clean], response
+    app.app = FakeWSGIApp('{}', headers=[('Content-type', 'text/json')])
+    app({}, fake_start_response)
+    r = (app.responses, app.clean_responses)
+    assert r==(2, 1), r
+
+def test_xhtmlify_middleware_verify_single_pass():
+    stats = XHTMLifyStats()
+    clean = six.b('<html xmlns="http://www.w3.org/1999/xhtml"></html>')
+    app = XHTMLifyMiddleware(FakeWSGIApp(clean), verify=True, stats=stats)
+    response = app({}, fake_start_response)
+    assert response[0] is clean, response
+    r = (app.responses, app.clean_responses)
+    assert r==(1, 1), r
+    app.app = FakeWSGIApp(six.b('<html><br>'))
+    response = app({}, fake_start_response)
+    assert response==[clean[:-7] + six.b('<br /></html>')], response
+    r = (app.responses, app.clean_responses)
+    assert r==(2, 1), r
+    # Each response was converted once
+    r = stats.as_dict()['tags']['calls']
+    assert r==2, r
+
+def test_xhtmlify_middleware_counts_across_threads():
+    clean = '<html xmlns="http://www.w3.org/1999/xhtml"></html>'
+    app = XHTMLifyMiddleware(FakeWSGIApp(clean), verify=True)
+    def run():
+        for i in range(200):
+            app({}, fake_start_response)
+    threads = [threading.Thread(target=run) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    r = (app.responses, app.clean_responses)
+    assert r==(800, 800), r
+
+def test_xhtmlify_middleware_stats():
+    stats = XHTMLifyStats()
+    app = XHTMLifyMiddleware(FakeWSGIApp('<html>'), stats=stats)
+    app({}, fake_start_response)
+    app({}, fake_start_response)
+    r = stats.as_dict()['tags']['calls']
+    assert r==2, r
+
+class FileWrapper(object):
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+    def __iter__(self):
+        return iter([self.data])
+    def close(self):
+        self.closed = True
+
+def test_buffering_middleware_passes_through():
+    body = FileWrapper(six.b('GIF89a...'))
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'image/gif')])
+        return body
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started.append(status)
+    r = XHTMLifyMiddleware(app)({}, start_response)
+    assert r is body and started==['200 OK'], (r, started)
+    # HEAD requests and 304 responses aren't filtered either
+    r = XHTMLifyMiddleware(FakeWSGIApp('<p>'))(
+        {'REQUEST_METHOD': 'HEAD'}, fake_start_response)
+    assert r==['<p>'], r
+    r = XHTMLifyMiddleware(FakeWSGIApp('', status='304 Not Modified'))(
+        {}, fake_start_response)
+    assert r==[''], r
+
+def test_buffering_middleware_lazy_start_response():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', environ['type'])])
+        yield '<p>'
+        yield 'x'
+    r = XHTMLifyMiddleware(app)({'type': 'text/plain'}, fake_start_response)
+    assert list(r)==['<p>', 'x'], r
+    r.close()
+    r = XHTMLifyMiddleware(app)({'type': 'text/html'}, fake_start_response)
+    assert r==['<p>x</p>'], r
+
+def test_xhtmlify_middleware_bytes():
+    body = six.u('<p>\xe9<br>').encode('latin-1')
+    headers = [('Content-Type', 'text/html; charset=latin-1'),
+               ('Content-Length', str(len(body)))]
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started.append(headers)
+    app = XHTMLifyMiddleware(FakeWSGIApp(body, headers=headers))
+    response = app({}, start_response)
+    e = six.u('<p>\xe9<br /></p>').encode('latin-1')
+    assert response==[e], response
+    r = started[0]
+    assert r==[('Content-Type', 'text/html; charset=latin-1'),
+               ('Content-Length', '14')], r
+
 def test_xhtmlify_middleware_output_is_validatable():
     """This test is expected to fail if lxml isn't available."""
     log = logging.getLogger('strainer.middleware')
@@ -144,6 +255,235 @@ def test_wellformedness_checker_detects_xhtml_entities_in_xml():
     assert response==['<html>\n&lt;&euro;</html>']
     assert errors==['line 2, column 5: undefined entity']
 
+def test_wellformedness_checker_bytes():
+    log = logging.getLogger('strainer.middleware')
+    errors = []
+    log.addHandler(LogCaptureHandler(errors))
+    body = six.u('<html>\n\xe9&euro;<br></html>').encode('utf-8')
+    app = FakeWSGIApp(body)
+    app = WellformednessCheckerMiddleware(app)
+    response = app({}, fake_start_response)
+    assert response==[body], response
+    assert errors==['line 2, column 14: mismatched tag'], errors
+
+def test_sampler():
+    now = [0.0]
+    randoms = iter([0.1, 0.9] * 10)
+    sampler = Sampler(0.5, rate=2, random=lambda: next(randoms),
+                      clock=lambda: now[0],
+                      prefixes={'/api': 0, '/admin': 1})
+    r = [sampler({'PATH_INFO': '/page'}) for i in range(6)]
+    assert r==[True, False, True, False, False, False], r
+    now[0] = 1.0  # time for two more tokens
+    r = [sampler({'PATH_INFO': '/page'}) for i in range(4)]
+    assert r==[True, False, True, False], r
+    r = sampler({'PATH_INFO': '/api/x'}), sampler({'PATH_INFO': '/admin'})
+    assert r==(False, True), r
+    assert (sampler.sampled, sampler.skipped)==(5, 7)
+
+def test_validator_middleware_sampling():
+    log = logging.getLogger('strainer.middleware')
+    errors = []
+    log.addHandler(LogCaptureHandler(errors))
+    app = FakeWSGIApp('<html><body></html>')
+    sampler = Sampler(prefixes={'/static/': 0})
+    app = WellformednessCheckerMiddleware(app, sampler=sampler)
+    app({'PATH_INFO': '/static/x.html'}, fake_start_response)
+    app({'PATH_INFO': '/x.html'}, fake_start_response)
+    assert errors==['line 1, column 15: mismatched tag'], errors
+    assert (sampler.sampled, sampler.skipped)==(1, 1)
+
+def test_validation_queue_policies():
+    for policy, expected in (('drop-newest', [1, 2]),
+                             ('drop-oldest', [2, 3])):
+        started, release = threading.Event(), threading.Event()
+        def block():
+            started.set()
+            release.wait()
+        done = []
+        queue = ValidationQueue(maxsize=2, policy=policy)
+        queue.submit(block)
+        started.wait()  # the worker is busy, so the next jobs wait
+        r = [queue.submit(done.append, i) for i in (1, 2, 3)]
+        assert r==[True, True, policy == 'drop-oldest'], r
+        assert (queue.depth, queue.dropped)==(2, 1)
+        release.set()
+        assert queue.join(5)
+        queue.close()
+        assert done==expected, done
+        r = queue.as_dict()
+        assert r=={'depth': 0, 'max_depth': 2, 'submitted': 4,
+                   'dropped': 1, 'completed': 3, 'failed': 0}, r
+
+def test_validator_middleware_queue():
+    errors = []
+    queue = ValidationQueue()
+    app = FakeWSGIApp('<html><body></html>')
+    app = WellformednessCheckerMiddleware(app, record_error=errors.append,
+                                          queue=queue)
+    response = app({}, fake_start_response)
+    assert response==['<html><body></html>'], response
+    assert queue.join(5)
+    assert errors==['line 1, column 15: mismatched tag'], errors
+    queue.submit(int, 'x')  # a job which raises is counted, not fatal
+    assert queue.join(5)
+    assert (queue.completed, queue.failed)==(2, 1)
+    queue.close()
+
+def test_response_context():
+    context = ResponseContext('200 OK', [
+        ('Content-Type', 'text/html ; charset="ISO-8859-1"')], None, '<p>')
+    r = context.content_type, context.charset
+    assert r==('text/html', 'ISO-8859-1'), r
+    context = ResponseContext('200 OK', [], None, '')
+    r = context.content_type, context.charset
+    assert r==('', None), r
+
+def test_strainer_pipeline():
+    errors = []
+    xhtmlifier = XHTMLifyMiddleware(None)
+    checker = WellformednessCheckerMiddleware(None,
+                                              record_error=errors.append)
+    json_checker = JSONValidatorMiddleware(None, record_error=errors.append)
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started.append(headers)
+    app = StrainerPipeline(FakeWSGIApp(six.b('<p>a<br>')),
+                           [xhtmlifier, json_checker, checker])
+    response = app({}, start_response)
+    assert response==[six.b('<p>a<br /></p>')], response
+    r = started[0]
+    assert r==[('Content-type', 'text/html'), ('Content-Length', '14')], r
+    assert errors==[], errors  # the checker saw the converted body
+    assert xhtmlifier.responses==1
+    # The response isn't buffered if none of the filters wants it
+    body = FileWrapper(six.b('GIF89a...'))
+    def gif_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'image/gif')])
+        return body
+    r = StrainerPipeline(gif_app, [xhtmlifier, checker])({}, start_response)
+    assert r is body, r
+
+def test_middleware_subclass_filter():
+    class Shouting(XHTMLifyMiddleware):
+        def filter(self, status, headers, exc_info, response):
+            response = super(Shouting, self).filter(status, headers,
+                                                    exc_info, response)
+            return response.upper()
+    seen = []
+    class Checker(WellformednessCheckerMiddleware):
+        def filter(self, status, headers, exc_info, response):
+            seen.append(response)
+            return super(Checker, self).filter(status, headers, exc_info,
+                                               response)
+    errors = []
+    checker = Checker(None, record_error=errors.append)
+    checker.cache = ResultCache()
+    for app in [Shouting(Checker(FakeWSGIApp(six.b('<p>a<br>')),
+                                 record_error=errors.append)),
+                StrainerPipeline(FakeWSGIApp(six.b('<p>a<br>')),
+                                 [Shouting(None), checker])]:
+        response = app({}, fake_start_response)
+        assert response==[six.b('<P>A<BR /></P>')], response
+    assert seen==[six.b('<p>a<br>'), six.b('<P>A<BR /></P>')], seen
+    assert len(errors)==1, errors  # from the first, unconverted, body
+
+def test_result_cache():
+    now = [0.0]
+    cache = ResultCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 'A')
+    cache.set('b', ('error',))
+    r = cache.get('a'), cache.get('c')
+    assert r==((True, 'A'), (False, None)), r
+    cache.set('c', None)  # evicts b, the least recently used
+    r = cache.get('b'), len(cache), cache.size
+    assert r==((False, None), 2, 1), r
+    now[0] = 10.0
+    r = cache.get('a')
+    assert r==(False, None), r
+    r = cache.as_dict()
+    assert r=={'entries': 1, 'bytes': 0, 'hits': 1, 'misses': 3,
+               'hit_rate': 0.25, 'evictions': 1, 'expirations': 1}, r
+
+def test_middleware_result_cache():
+    cache = ResultCache()
+    app = XHTMLifyMiddleware(FakeWSGIApp(six.b('<p>a<br>')), cache=cache)
+    for i in range(3):
+        response = app({}, fake_start_response)
+        assert response==[six.b('<p>a<br /></p>')], response
+    assert (app.responses, cache.hits, cache.misses)==(1, 2, 1)
+    # Validators report the errors they found again, without re-checking
+    errors = []
+    cache = ResultCache()
+    checker = WellformednessCheckerMiddleware(
+        FakeWSGIApp('<p></b>'), record_error=errors.append, cache=cache)
+    checker.validate = lambda context, validate=checker.validate: (
+        [message + ' (checked)' for message in validate(context)])
+    checker({}, fake_start_response)
+    checker({}, fake_start_response)
+    assert errors==['line 1, column 6: mismatched tag (checked)'] * 2, errors
+    assert (cache.hits, cache.misses)==(1, 1)
+
+def test_result_cache_etag():
+    cache = ResultCache()
+    xhtmlifier = XHTMLifyMiddleware(None)
+    def key(body, etag, path='/', host='example.com', scheme='http'):
+        headers = [('Content-Type', 'text/html'), ('ETag', etag)]
+        context = ResponseContext('200 OK', headers, None, body,
+                                  {'PATH_INFO': path, 'HTTP_HOST': host,
+                                   'wsgi.url_scheme': scheme})
+        return cache.key(xhtmlifier, context)
+    # Identical bodies have the same digest without a strong ETag
+    assert key('<p>', 'W/"1"')==key('<p>', 'W/"2"')
+    # A strong ETag identifies the body at that URL
+    assert key('<p>', '"1"')==key('<br>', '"1"')
+    assert key('<p>', '"1"')!=key('<p>', '"2"')
+    assert key('<p>', '"1"')!=key('<p>', '"1"', '/other')
+    assert key('<p>', '"1"')!=key('<p>', '"1"', host='example.org')
+    assert key('<p>', '"1"')!=key('<p>', '"1"', scheme='https')
+
+def test_buffering_middleware_max_size():
+    body = FileWrapper(six.b('<p>x</p>'))
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html'),
+                                  ('Content-Length', '8')])
+        return body
+    middleware = XHTMLifyMiddleware(app)
+    middleware.max_size = 7
+    r = middleware({}, fake_start_response)
+    assert r is body, r
+    # Without a content-length, it's noticed while buffering
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return body
+    middleware.app = app
+    r = middleware({}, fake_start_response)
+    assert list(r)==[six.b('<p>x</p>')] and not body.closed, r
+    r.close()
+    assert body.closed
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        for chunk in ('<p>', 'x<br>', '</p>'):
+            yield chunk
+    middleware.app = app
+    r = list(middleware({}, fake_start_response))
+    assert r==['<p>', 'x<br>', '</p>'], r
+
+def test_middleware_deadline():
+    errors = []
+    body = '<p>x<br>' * 100
+    xhtmlifier = XHTMLifyMiddleware(FakeWSGIApp(body))
+    checker = WellformednessCheckerMiddleware(FakeWSGIApp(body + '</b>'),
+                                              record_error=errors.append)
+    for app in xhtmlifier, checker:
+        app.deadline = 0  # already up at the first check
+        app.metrics = MiddlewareMetrics()
+        response = app({}, fake_start_response)
+        assert response==[app.app.response], response
+        r = app.metrics.snapshot()[type(app).__name__]['text/html']
+        assert r['overruns']==1, r
+    assert errors==[], errors
+
 def test_json_validator_middleware_runs():
     log = logging.getLogger('strainer.middleware')
     errors = []
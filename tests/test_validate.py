@@ -1,4 +1,6 @@
+import strainer.validate
 from strainer.validate import *
+from strainer.deadline import Deadline
 from strainer.doctypes import DOCTYPE_XHTML1_STRICT
 from strainer.xhtmlify import PY3
 
@@ -8,6 +10,16 @@ def test_validate_xhtml():
         '<html><head><title/></head><body/></html>')
 
 
+def test_validate_xhtml_deadline():
+    try:
+        validate_xhtml('<html/>', doctype=DOCTYPE_XHTML1_STRICT,
+                       deadline=Deadline(60))
+    except XHTMLSyntaxError:
+        pass
+    # Each call has its own parser, which isn't left in the module
+    assert not hasattr(strainer.validate, 'parser')
+
+
 def test_validate_xhtml_fragment():
     validate_xhtml_fragment('<a/>')
 
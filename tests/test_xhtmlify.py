@@ -1,11 +1,17 @@
 import re
 import encodings.aliases
 import codecs
+import io
 import six
 
 from strainer.xhtmlify import xhtmlify as _xhtmlify, xmlparse, ValidationError
-from strainer.xhtmlify import sniff_encoding, fix_xmldecl
+from strainer.xhtmlify import sniff_encoding, fix_xmldecl, XHTMLifier
+from strainer.xhtmlify import parse_xmldecl, XMLDecl
+from strainer.xhtmlify import XHTMLifyProfile, DEFAULT_PROFILE, tokenize
+from strainer.xhtmlify import XHTMLifyResult, CachedXHTMLifier, XHTMLifyStats
+from strainer.xhtmlify import ampfix, ampfix_values, cdatafix, fix_doctype
 from strainer.doctypes import DOCTYPE_XHTML1_STRICT
+from strainer.deadline import Deadline, DeadlineExceeded
 
 
 def xhtmlify(html, *args, **kwargs):
@@ -935,6 +941,25 @@ def test_formfeed_in_xmldecl():
     assert xmldecl.decode('utf16')==(
         '''<?xml version="1.0"  standalone='no'  ?>'''), xmldecl
 
+def test_parse_xmldecl():
+    s = six.u("<?xml version='1.0' encoding=\"latin-1\"?><html/>")
+    r = parse_xmldecl(s)
+    e = XMLDecl(bom='', version='1.0', encoding='latin-1', standalone=None,
+                end=40)
+    assert r==e, r
+    r = parse_xmldecl(six.u('\ufeff') + s)
+    assert r==e._replace(bom=six.u('\ufeff'), end=41), r
+    r = parse_xmldecl(s.encode('utf-16'))
+    assert r==e._replace(bom=codecs.BOM_UTF16_LE, end=82), r
+    r = parse_xmldecl(six.u("<?xml version='1.0' standalone='yes' ?>"))
+    assert r==(r.bom, '1.0', None, 'yes', 39), r
+    r = parse_xmldecl(six.u('<?xml encoding="latin-1"?>'))
+    assert r is None, r
+    # The declaration that fix_xmldecl() writes is always a valid one
+    s = six.u('\n<?xml\fversion=\f"1.0"  standalone=no?>').encode('utf16')
+    r = parse_xmldecl(fix_xmldecl(s))
+    assert r==(codecs.BOM_UTF16_LE, '1.0', None, 'no', 80), r
+
 def test_xhtmlify_handles_utf8_xmldecl():
     result = xhtmlify(six.u('<?xml><html>'), 'utf-8', _wrap=False)
     assert result==six.u('<?xml version=\'1.0\'?><html xmlns="http://www.w3.org/1999/xhtml"></html>')
@@ -1036,3 +1061,285 @@ def test_sup_nesting():
     e = s
     r = xhtmlify(s)
     assert r==e, repr(r)
+
+def test_xhtmlifier_chunked():
+    s = (DOCTYPE_XHTML1_STRICT + '<html><p title=\'a > b\'>caf\xe9 &nbsp;<br>\n'
+         '<script>if (a<b) {}</script><!-- <p> --><p>x')
+    for data in (s, s.encode('utf-8')):
+        e = _xhtmlify(data)
+        for size in (1, 2, 7, 100):
+            x = XHTMLifier()
+            x.head_size = 4
+            r = [x.feed(data[i:i + size]) for i in range(0, len(data), size)]
+            r.append(x.close())
+            assert data[:0].join(r)==e, (size, r)
+
+def test_xhtmlifier_output_is_incremental():
+    x = XHTMLifier()
+    x.head_size = 0
+    r = x.feed('<html><p>one</p><p>tw')
+    assert r=='<html xmlns="http://www.w3.org/1999/xhtml"><p>one</p><p>', r
+    r = x.feed('o</p>')
+    assert r=='two</p>', r
+    r = x.close()
+    assert r=='</html>', r
+
+def test_xhtmlifier_error_position():
+    x = XHTMLifier()
+    x.head_size = 0
+    x.feed('<p>\n<br>')
+    try:
+        r = x.feed('x</br>\n')
+    except ValidationError as exc:
+        assert str(exc)==('Self-closing tag <br/> is not empty '
+                          'at line 2, column 1 (char 5)'), exc
+    else:
+        assert False, r
+
+def test_profile():
+    profile = XHTMLifyProfile(cdata_tags=['script', 'style', 'textarea'])
+    s = '<textarea>a < b</textarea><p>a &lt; b'
+    e = ('<textarea>a /*<![CDATA[*/ < /*]]>*/ b</textarea>'
+         '<p>a &lt; b</p>')
+    for i in range(2):
+        r = xhtmlify(s, profile=profile)
+        assert r==e, r
+    assert xhtmlify('<br>', profile=DEFAULT_PROFILE)=='<br />'
+    try:
+        profile.cdata_tags = frozenset()
+    except AttributeError:
+        pass
+    else:
+        assert False, "profile is not read-only"
+
+def test_tokenize():
+    s = '<p class=x>a<!-- c --><br/></p><script>1<2</script>'
+    r = [(type(t).__name__, t.text, t.start, t.end) for t in tokenize(s)]
+    e = [('StartTag', '<p class=x>', 0, 11),
+         ('Text', 'a', 11, 12),
+         ('Comment', '<!-- c -->', 12, 22),
+         ('StartTag', '<br/>', 22, 27),
+         ('EndTag', '</p>', 27, 31),
+         ('StartTag', '<script>', 31, 39),
+         ('Text', '1<2', 39, 42),
+         ('EndTag', '</script>', 42, 51)]
+    assert r==e, r
+    tokens = list(tokenize(s))
+    assert tokens[0].name=='p', tokens[0].name
+    assert tokens[0].attrs==[(' ', 'class', '', '', 'x', '')], tokens[0].attrs
+    assert tokens[3].self_closing
+    assert tokens[6].cdata and not tokens[1].cdata
+
+def test_tokenize_errors():
+    try:
+        list(tokenize('<p>\n<p a=1 a=2>'))
+    except ValidationError as exc:
+        assert str(exc)==('Repeated attribute "a" at line 2, column 8 '
+                          '(char 12)'), exc
+    else:
+        assert False, "no error"
+    errors = []
+    r = [t.text for t in tokenize('a<>b', ERROR=lambda msg, pos:
+                                               errors.append((msg, pos)))]
+    assert r==['a<>b'], r
+    assert errors==[('Empty tag', 1)], errors
+
+def test_utf8_disallowed_chars():
+    s = six.b('<p>caf\xc3\xa9\x0cno\x01 bad\xff \xef\xbf\xbe</p>')
+    e = six.b('<p>caf\xc3\xa9 no\xef\xbf\xbd bad\xef\xbf\xbd '
+              '\xef\xbf\xbd</p>')
+    r = xhtmlify(s, 'utf-8')
+    assert r==e, r
+    for size in (1, 2, 3):
+        x = XHTMLifier('utf-8')
+        x.head_size = 1
+        r = [x.feed(s[i:i+size]) for i in range(0, len(s), size)]
+        r.append(x.close())
+        assert six.b('').join(r)==e, (size, r)
+
+def test_recover():
+    s = '<p>\n<q>\n</r>\n<s a=1 a=2><br>x</br><a><a>y</a></a>'
+    e = ('<p>\n<q>\n\n<s a="1" ><br />x<a></a><a>y</a></s></q></p>')
+    r = _xhtmlify(s, recover=True)
+    assert isinstance(r, XHTMLifyResult), r
+    assert r.output==e, r.output
+    r = [(exc.message, exc.line, exc.offset) for exc in r.errors]
+    e = [('Unexpected closing tag </r>', 3, 1),
+         ('Repeated attribute "a"', 4, 8),
+         ('Self-closing tag <br/> is not empty', 4, 12),
+         ('XHTML <a> elements must not contain other <a> elements', 4, 25),
+         ('Unexpected closing tag </a>', 4, 33)]
+    assert r==e, r
+    output, errors = _xhtmlify('<p>&lt;</p>', recover=True)
+    assert output=='<p>&lt;</p>' and errors==[], (output, errors)
+
+def test_prohibitions_deeply_nested():
+    # The outermost prohibited ancestor is reported, whatever its case
+    s = '<FORM><div>' * 300 + '<Button><p><label><form>'
+    r = [exc.message for exc in _xhtmlify(s, recover=True).errors]
+    e = ['XHTML <form> elements must not contain other <form> elements'] * 299
+    e += ['XHTML <button> elements must not contain <label> elements',
+          'XHTML <form> elements must not contain other <form> elements']
+    assert r==e, r
+
+def test_xhtmlify_out():
+    s = '<script>a<b</script>' + '<p>x & y<br>\n' * 20000
+    e = _xhtmlify(s)
+    out = io.StringIO()
+    r = _xhtmlify(s, out=out)
+    assert r is None, r
+    assert out.getvalue()==e
+    writes = []
+    r = _xhtmlify(s.encode('utf-16'), 'utf-16', out=Writer(writes),
+                  recover=True)
+    assert r==(None, []), r
+    assert len(writes) > 1, len(writes)
+    r = six.b('').join(writes)
+    assert r.decode('utf-16')==e
+
+class Writer(object):
+    def __init__(self, writes):
+        self.write = writes.append
+
+def test_xhtmlify_handler():
+    class Handler(object):
+        def __init__(self):
+            self.events = []
+        def startElement(self, name, attrs):
+            self.events.append(('start', name, dict(attrs)))
+        def endElement(self, name):
+            self.events.append(('end', name))
+        def characters(self, content):
+            self.events.append(('chars', content))
+        def comment(self, content):
+            self.events.append(('comment', content))
+    s = ('<P Class="a&amp;b\tc"><!-- x -->&nbsp;<br>\n</br>'
+         '<A href=x&y>1<![CDATA[<2>]]><p>')
+    handler = Handler()
+    _xhtmlify(s, handler=handler)
+    r = handler.events
+    e = [('start', 'p', {'class': 'a&b c'}), ('comment', ' x '),
+         ('chars', six.u('\xa0')), ('start', 'br', {}), ('end', 'br'),
+         ('start', 'a', {'href': 'x&y'}), ('chars', '1<2>'),
+         ('start', 'p', {}), ('end', 'p'), ('end', 'a'), ('end', 'p')]
+    assert r==e, r
+
+def test_xhtmlify_verify():
+    s = '<p class="x">a &amp; b<br /></p>\n' * 5000
+    r = _xhtmlify(s, verify=True)
+    assert r is s
+    b = s.encode('utf-16')
+    r = _xhtmlify(b, 'utf-16', verify=True)
+    assert r is b
+    r = _xhtmlify(b, 'utf-16', verify=True, recover=True)
+    assert r.output is b and r.errors==[], r.errors
+    r = _xhtmlify(s + '<br>', verify=True)
+    assert r==s + '<br />', r[-20:]
+    # Output which differs is collected in the same pass
+    s = '<p class=x>a &amp; b<br> </br></p>\n' * 5000
+    e = _xhtmlify(s)
+    r = _xhtmlify(s, verify=True)
+    assert r==e, r[-40:]
+    r = _xhtmlify(s.encode('utf-8'), verify=True, recover=True)
+    assert r==(e.encode('utf-8'), []), r.errors
+    stats = XHTMLifyStats()
+    _xhtmlify('<p>a<br>b</p>' * 1000, verify=True, stats=stats)
+    r = dict((stage, (counts['calls'], counts['bytes']))
+             for stage, counts in stats.as_dict().items())
+    assert r['tags']==(1, 13000) and r['ampfix']==(2000, 2000), r
+
+def test_xhtmlify_stats():
+    stats = XHTMLifyStats()
+    _xhtmlify(six.b('<p a=1>x&y<script>a<b</script>'), stats=stats)
+    r = dict((stage, (counts['calls'], counts['bytes']))
+             for stage, counts in stats.as_dict().items())
+    e = {'fix_xmldecl': (1, 30), 'sniff_encoding': (1, 30),
+         'decode': (2, 30), 'fix_doctype': (1, 30), 'tags': (1, 30),
+         'split_attrs': (1, 4), 'fix_attrs': (2, 6), 'ampfix': (1, 3),
+         'cdatafix': (1, 3), 'encode': (1, 62)}
+    assert r==e, r
+    total = XHTMLifyStats()
+    total.merge(stats)
+    total.merge(stats.as_dict())
+    r = total.as_dict()['ampfix']
+    assert r['calls']==2 and r['bytes']==6, r
+
+def test_xhtmlify_deadline():
+    html = '<p>x<br>' * 100
+    ticks = iter(range(1000))
+    deadline = Deadline(2, clock=lambda: next(ticks))
+    try:
+        _xhtmlify(html, deadline=deadline)
+    except DeadlineExceeded:
+        pass
+    else:
+        assert False, 'DeadlineExceeded not raised'
+    r = next(ticks)
+    assert r==3, r  # the deadline was checked every 64 tokens
+    r = _xhtmlify(html, deadline=60)
+    assert r==_xhtmlify(html), r
+
+def test_cached_xhtmlifier():
+    cache = CachedXHTMLifier(max_bytes=35)
+    r = cache('<p>one')
+    assert r=='<p>one</p>', r
+    r = _xhtmlify('<p>one', cache=cache)
+    assert r=='<p>one</p>', r
+    r = cache(six.b('<p>one'))
+    assert r==six.b('<p>one</p>'), r
+    assert (cache.hits, cache.misses, cache.evictions)==(1, 2, 0)
+    profile = XHTMLifyProfile(cdata_tags=['script', 'style', 'textarea'])
+    r = cache('<p>one', profile=profile)
+    assert (cache.hits, cache.misses, cache.evictions)==(1, 3, 0)
+    assert cache.size==30 and len(cache)==3, (cache.size, len(cache))
+    cache('<p>one')  # now the most recently used
+    cache('<p>two')
+    assert cache.evictions==1 and len(cache)==3, cache.evictions
+    cache('<p>one')
+    assert cache.hits==3, cache.hits
+    cache(six.b('<p>one'))
+    assert cache.misses==5, cache.misses  # was evicted
+    try:
+        cache('</p>')
+    except ValidationError:
+        pass
+    else:
+        assert False, "no error"
+    cache.clear()
+    assert cache.size==0 and len(cache)==0
+
+def test_ampfix():
+    s = 'plain text'
+    assert ampfix(s) is s
+    s = 'a & b &nbsp;&amp;&#X41;&#1;&foo; <!-- & --> <![CDATA[ & ]]> <'
+    e = ('a &amp; b &#xa0;&amp;&#x41;&amp;#1;&amp;foo; '
+         '<!-- & --> <![CDATA[ & ]]> &lt;')
+    r = ampfix(s)
+    assert r==e, r
+    r = ampfix('&#99999999999999999999;')
+    assert r=='&amp;#99999999999999999999;', r
+    r = ampfix_values(['a&b', 'c', '<x>', '&lt;'])
+    assert r==['a&amp;b', 'c', '&lt;x&gt;', '&lt;'], r
+    r = ampfix_values(['<!-- a', '&', 'b -->'])
+    assert r==['&lt;!-- a', '&amp;', 'b --&gt;'], r
+
+def test_cdatafix():
+    s = 'var x = {"a": [1, 2]};  /* no escaping needed */'
+    assert cdatafix(s) is s
+    s = 'if (a<b) { s = "<\\/p>"; } /* a & b */ ]]>'
+    e = ('if (a/*<![CDATA[*/ < /*]]>*/b) { s = "\\x3c\\/p\\x3e"; } '
+         '/* a <![CDATA[&]]> b */ ]]/*<![CDATA[*/ > /*]]>*/')
+    r = cdatafix(s)
+    assert r==e, r
+    r = cdatafix('<![CDATA[ a < b ]]> c < d; s = "\\')
+    assert r=='<![CDATA[ a < b ]]> c /*<![CDATA[*/ < /*]]>*/ d; s = "\\', r
+
+def test_fix_doctype_known():
+    for s in [DOCTYPE_XHTML1_STRICT, '<!DOCTYPE html>\n']:
+        html = ' ' + s + '<html/>'
+        r = fix_doctype(html)
+        assert r==(' ' + s.strip(), len(s.strip()) + 1), r
+    r = fix_doctype('<!doctype html><p>')
+    assert r==('<!DOCTYPE html>', 15), r
+    r = fix_doctype('<! doctype html\n><p>')
+    assert r==('<!DOCTYPE html\n>', 17), r